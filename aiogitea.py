@@ -0,0 +1,588 @@
+import asyncio
+import json
+
+import httpx
+
+import filters
+import metrics
+import patch
+import settings
+from gitea import ConflictError, GiteaUser, GiteaOrg, DEFAULT_TEAM_NEW_ORG_PERMISSIONS, member_ref, page_plan, resource_version
+from transport import FAILURE_STATUSES, CircuitBreaker
+
+
+class AsyncGiteaAPI:
+    """
+    asyncio counterpart of GiteaAPI.
+
+    Methods mirror GiteaAPI and return httpx responses, which expose the same
+    status_code/json() used by the SCIM wrapper. In-flight calls to the
+    upstream are bounded by a semaphore, and a circuit breaker fails calls
+    fast while Gitea is unhealthy.
+    """
+
+    def __init__(self, base_url, token, max_concurrency=None) -> None:
+        self._HEADERS = {
+            'accept': 'application/json',
+            'Content-Type': 'application/json',
+            'Authorization': f'token {token}'
+        }
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency or settings.GITEA_MAX_CONCURRENCY
+        self._semaphore = None
+        self._client = None
+        self.breaker = CircuitBreaker() if settings.GITEA_LIMITER_ENABLED else None
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=self._HEADERS,
+                timeout=httpx.Timeout(settings.GITEA_READ_TIMEOUT, connect=settings.GITEA_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=settings.GITEA_POOL_SIZE, max_keepalive_connections=settings.GITEA_POOL_SIZE),
+                transport=httpx.AsyncHTTPTransport(retries=settings.GITEA_RETRIES),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def _request(self, call: str, method: str, path: str, **kwargs):
+        """Send one Gitea call; `call` names the API method making it and labels the upstream metrics."""
+        client = self._get_client()
+        breaker = self.breaker
+        if breaker is not None:
+            breaker.before()  # Raises without claiming the probe; nothing can cancel us between it and the try
+        sent = failed = False
+        try:
+            async with self._semaphore:
+                sent = failed = True
+                with metrics.timed_call(call, method, path, (kwargs.get('params') or {}).get('page')) as timing:
+                    timing.response = await client.request(method, path, **kwargs)
+                failed = timing.response.status_code in FAILURE_STATUSES
+            return timing.response
+        finally:
+            if breaker is not None:
+                if sent:
+                    breaker.record(failed)
+                else:  # Cancelled waiting for the semaphore, release the probe slot
+                    breaker.cancel()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def get_user(self, username):
+        return await self._request('get_user', 'GET', f'users/{username}')
+
+    async def get_users(self, page=None, limit=None):
+        params = {}
+        if page:
+            params['page'] = page
+        if limit:
+            params['limit'] = limit
+        return await self._request('get_users', 'GET', 'admin/users', params=params)
+
+    async def _get_range(self, fetch_page, start_index: int, count: int):
+        """See GiteaAPI._get_range."""
+        if count is None:
+            count = settings.SCIM_MAX_PAGE_SIZE
+        limit, page, offset = page_plan(start_index, max(count, 1), settings.GITEA_MAX_PAGE_SIZE)
+        items = []
+        total = None
+        while True:
+            r = await fetch_page(page=page, limit=limit)
+            if r.status_code != 200:
+                return None, None
+            batch = r.json()
+            if 'X-Total-Count' in r.headers:
+                total = int(r.headers['X-Total-Count'])
+            items.extend(batch[offset:])
+            offset = 0
+            if len(items) >= count or len(batch) < limit:
+                break
+            page += 1
+        items = items[:count]
+        if total is None:
+            total = start_index - 1 + len(items)
+        return items, total
+
+    async def _iter_range(self, fetch_page, start_index: int, key=None):
+        """See GiteaAPI._iter_range; the pages come from an async generator."""
+        page_size = settings.GITEA_MAX_PAGE_SIZE
+        limit, page, offset = page_plan(start_index, page_size, page_size)
+        first = await fetch_page(page=page, limit=limit)
+        if first.status_code != 200:
+            return None, None
+        first_batch = first.json() if key is None else first.json()[key]
+        total = int(first.headers.get('X-Total-Count', -1))
+
+        async def pages():
+            nonlocal page
+            batch = first_batch
+            yield batch[offset:]
+            while len(batch) == limit:
+                page += 1
+                r = await fetch_page(page=page, limit=limit)
+                if r.status_code != 200:
+                    return
+                batch = r.json() if key is None else r.json()[key]
+                yield batch
+
+        return (total if total >= 0 else None), pages()
+
+    async def iter_users(self, start_index=1):
+        return await self._iter_range(self.get_users, start_index)
+
+    async def iter_search_users(self, q: str):
+        return await self._iter_range(lambda page, limit: self.search_users(q, page=page, limit=limit), 1, key='data')
+
+    async def iter_orgs(self, start_index=1):
+        return await self._iter_range(self.get_orgs, start_index)
+
+    async def get_users_range(self, start_index=1, count=None):
+        return await self._get_range(self.get_users, start_index, count)
+
+    async def search_users(self, q: str, page=None, limit=None):
+        params = {'q': q}
+        if page:
+            params['page'] = page
+        if limit:
+            params['limit'] = limit
+        return await self._request('search_users', 'GET', 'users/search', params=params)  # Matches login and full name
+
+    async def create_user(self, email: str, full_name: str, username: str, password: str, login_name: str, source_id: int, must_change_password=False, send_notify=False, visibility='limited'):
+        body = {
+            "email": email,
+            "full_name": full_name,
+            "login_name": login_name,
+            "must_change_password": must_change_password,
+            "password": password,
+            "send_notify": send_notify,
+            "source_id": source_id,
+            "username": username,
+            "visibility": visibility,
+        }
+        return await self._request('create_user', 'POST', 'admin/users', content=json.dumps(body))
+
+    async def edit_user(self, username: str, **kwargs):
+        return await self._request('edit_user', 'PATCH', f'admin/users/{username}', content=json.dumps(kwargs))
+
+    async def delete_user(self, username: str):
+        return await self._request('delete_user', 'DELETE', f'admin/users/{username}')
+
+    async def get_orgs(self, page=None, limit=None):
+        params = {}
+        if page:
+            params['page'] = page
+        if limit:
+            params['limit'] = limit
+        return await self._request('get_orgs', 'GET', 'orgs', params=params)
+
+    async def get_orgs_range(self, start_index=1, count=None):
+        return await self._get_range(self.get_orgs, start_index, count)
+
+    async def get_org(self, org: str):
+        return await self._request('get_org', 'GET', f'orgs/{org}')
+
+    async def get_org_members(self, org: str, page=None, limit=None):
+        params = {}
+        if page:
+            params['page'] = page
+        if limit:
+            params['limit'] = limit
+        return await self._request('get_org_members', 'GET', f'orgs/{org}/members', params=params)
+
+    async def iter_org_members(self, org: str):
+        return await self._iter_range(lambda page, limit: self.get_org_members(org, page=page, limit=limit), 1)
+
+    async def get_team_members(self, team_id: int, page=None, limit=None):
+        params = {}
+        if page:
+            params['page'] = page
+        if limit:
+            params['limit'] = limit
+        return await self._request('get_team_members', 'GET', f'teams/{team_id}/members', params=params)
+
+    async def iter_team_members(self, team_id: int):
+        return await self._iter_range(lambda page, limit: self.get_team_members(team_id, page=page, limit=limit), 1)
+
+    async def get_org_teams(self, org: str):
+        return await self._request('get_org_teams', 'GET', f'orgs/{org}/teams')
+
+    async def create_team(self, org: str, name: str, description: str, can_create_org_repo: bool, includes_all_repositories: bool, permission: str, units: list, units_map=None):
+        body = {
+            "name": name,
+            "description": description,
+            "can_create_org_repo": can_create_org_repo,
+            "includes_all_repositories": includes_all_repositories,
+            "permission": permission,  # read,write,admin
+            "units": units,
+            "units_map": units_map,
+        }
+        return await self._request('create_team', 'POST', f'orgs/{org}/teams', content=json.dumps(body))
+
+    async def add_team_member(self, team_id: int, username: str):
+        return await self._request('add_team_member', 'PUT', f'teams/{team_id}/members/{username}')
+
+    async def remove_team_member(self, team_id: int, username: str):
+        return await self._request('remove_team_member', 'DELETE', f'teams/{team_id}/members/{username}')
+
+    async def create_org(self, username, visibility, full_name=None, description=None, location=None, website=None):
+        body = {
+            "username": username,
+            "visibility": visibility,
+            "full_name": full_name,
+            "description": description,
+            "location": location,
+            "website": website,
+        }
+        return await self._request('create_org', 'POST', 'orgs', content=json.dumps(body))
+
+    async def edit_org(self, org: str, **kwargs):
+        return await self._request('edit_org', 'PATCH', f'orgs/{org}', content=json.dumps(kwargs))
+
+
+class AsyncGiteaSCIMWrapper(AsyncGiteaAPI):
+    """
+    asyncio counterpart of GiteaSCIMWrapper with the same scim_* surface.
+
+    Filters, PATCH and versions go through the same filters/patch modules;
+    there is no lookup cache, shadow store or write journal behind it.
+    """
+
+    def __init__(self, base_url, token, max_concurrency=None) -> None:
+        super().__init__(base_url, token, max_concurrency=max_concurrency)
+        self._team_index = {}  # org -> {'ids': [...], 'default': id}, as in GiteaSCIMWrapper
+        self._team_locks = {}  # org -> asyncio.Lock, so concurrent adds create one Default team
+
+    # ETags: every resource served gets meta.version. Nothing is cached, so
+    # If-Match/If-None-Match are answered from a fresh read.
+    @staticmethod
+    def _stamp(resource):
+        if resource:
+            resource['meta'].pop('version', None)
+            resource['meta']['version'] = resource_version(resource)
+        return resource
+
+    async def current_version(self, kind: str, name: str):
+        """Version of the full resource, from one fetch."""
+        resource = await self.scim_get_user(name) if kind == 'user' else await self.scim_get_org(name)
+        return resource['meta']['version'] if resource else None
+
+    async def _lookup(self, kind: str, name: str):
+        """A user/org payload by name, or None."""
+        r = await self.get_user(name) if kind == 'user' else await self.get_org(name)
+        return r.json() if r.status_code == 200 else None
+
+    async def scim_create_user(self, email: str, full_name: str, username: str, password: str, login_name: str, source_id: int, must_change_password=False, send_notify=False, visibility='limited'):
+        create_response = await self.create_user(
+            email=email,
+            full_name=full_name,
+            username=username,
+            login_name=login_name,
+            source_id=source_id,
+            password=password
+        )
+        if create_response.status_code == 422:
+            raise ConflictError(f'User {username} already exists')
+        if create_response.status_code == 201:
+            return self._stamp(GiteaUser.from_json(create_response.json()).serialize())
+
+    async def scim_edit_user(self, username: str, **kwargs):
+        edit_response = await self.edit_user(username, **kwargs)
+        if edit_response.status_code == 200:
+            return self._stamp(GiteaUser.from_json(edit_response.json()).serialize())
+
+    async def scim_diff_user(self, username: str, operations):
+        """See GiteaSCIMWrapper.scim_diff_user. Raises patch.PatchError."""
+        current = await self.scim_get_user(username)
+        if not current:
+            return None, None
+        return current, patch.diff(patch.USER_FIELDS, current, patch.apply(current, operations))
+
+    async def scim_get_user(self, username: str):
+        user = await self._lookup('user', username)
+        if user:
+            return self._stamp(GiteaUser.from_json(user).serialize())
+
+    async def scim_get_users(self, start_index=1, count=None):
+        users, total = await self.get_users_range(start_index, count)
+        if users is not None:
+            return [self._stamp(GiteaUser.from_json(u).serialize()) for u in users], total
+
+    async def scim_create_org(self, username, visibility, full_name=None, description=None, location=None, website=None):
+        create_response = await self.create_org(username=username, visibility=visibility, full_name=full_name, description=description, location=location, website=website)
+        if create_response.status_code == 422:
+            raise ConflictError(f'Group {username} already exists')
+        if create_response.status_code == 201:  # Default team is created by _get_org_default_team on the first member add
+            created_org = create_response.json()
+            created_org['members'] = []
+            return self._stamp(GiteaOrg.from_json(created_org).serialize())
+
+    async def scim_get_org(self, org: str, members=True):
+        if members:  # The member walk doesn't wait for the org, a missing org just lists nobody
+            org_json, refs = await asyncio.gather(self._lookup('org', org), self.scim_get_org_member_refs(org))
+        else:
+            org_json = await self._lookup('org', org)
+        if org_json:
+            if members:
+                org_json['members'] = refs
+            return self._stamp(GiteaOrg.from_json(org_json).serialize())
+
+    async def scim_get_orgs(self, start_index=1, count=None, members=True):
+        orgs, total = await self.get_orgs_range(start_index, count)
+        if orgs is not None:
+            return await self._with_members([GiteaOrg.from_json(o).serialize() for o in orgs], members), total
+
+    @staticmethod
+    def _page_size(count):
+        """See GiteaSCIMWrapper._page_size."""
+        return settings.SCIM_MAX_PAGE_SIZE if count is None else min(count, settings.SCIM_MAX_PAGE_SIZE)
+
+    @staticmethod
+    async def _take(resources, start_index: int, count: int):
+        """See GiteaSCIMWrapper._take."""
+        page = []
+        total = 0
+        async for resource in resources:
+            total += 1
+            if start_index <= total < start_index + count:
+                page.append(resource)
+        return page, total
+
+    async def _filter_candidates(self, plan, lookup, search, scan):
+        """See GiteaSCIMWrapper._filter_candidates; lookups by name run concurrently."""
+        seen = set()
+
+        async def pages():
+            if plan.source == 'lookup':
+                for item in await asyncio.gather(*map(lookup, dict.fromkeys(plan.values))):
+                    if item:
+                        yield [item]
+                return
+            listings = [search(q) for q in dict.fromkeys(plan.values)] if plan.source == 'search' else [scan()]
+            for listing in listings:
+                _, listed = await listing
+                if listed is not None:
+                    async for page in listed:
+                        yield page
+
+        async for page in pages():
+            for item in page:
+                name = item['username'].lower()
+                if name in seen:
+                    continue
+                seen.add(name)
+                yield item
+
+    async def scim_filter_users(self, filter_expr: str, start_index=1, count=None):
+        """Evaluate a SCIM filter against users, planned as in GiteaSCIMWrapper.scim_filter_users. Raises filters.FilterError."""
+        node = filters.parse(filter_expr)
+        candidates = self._filter_candidates(filters.plan_users(node), lambda name: self._lookup('user', name), self.iter_search_users, self.iter_users)
+
+        async def matching():
+            async for user in candidates:
+                resource = self._stamp(GiteaUser.from_json(user).serialize())
+                if filters.matches(node, resource):
+                    yield resource
+
+        return await self._take(matching(), start_index, self._page_size(count))
+
+    async def scim_filter_orgs(self, filter_expr: str, start_index=1, count=None, members=True):
+        """Evaluate a SCIM filter against orgs; see scim_filter_users."""
+        node = filters.parse(filter_expr)
+        candidates = self._filter_candidates(filters.plan_groups(node), lambda name: self._lookup('org', name), None, self.iter_orgs)
+        load = members and filters.references(node, 'members')
+
+        async def matching():
+            async for org in candidates:
+                resource = GiteaOrg.from_json(org).serialize()
+                if load:
+                    await self._with_members([resource])
+                if filters.matches(node, resource):
+                    yield resource
+
+        page, total = await self._take(matching(), start_index, self._page_size(count))
+        return await self._with_members(page, members and not load), total
+
+    # Org -> team ID index, see GiteaSCIMWrapper
+    async def _index_org_teams(self, org: str):
+        get_org_teams_response = await self.get_org_teams(org)
+        if get_org_teams_response.status_code != 200:
+            return None
+        teams = get_org_teams_response.json()
+        team_ids = [team['id'] for team in teams]
+        default_team_id = next((team['id'] for team in teams if team['name'] == 'Default'), None)
+        self._team_index[org.lower()] = {'ids': team_ids, 'default': default_team_id}
+        return team_ids
+
+    def _forget_org_teams(self, org: str):
+        self._team_index.pop(org.lower(), None)
+
+    async def _get_org_team_ids(self, org: str):
+        entry = self._team_index.get(org.lower())
+        if entry is None:
+            return await self._index_org_teams(org)
+        return entry['ids']
+
+    async def _get_org_default_team(self, org: str, create=True):
+        entry = self._team_index.get(org.lower())
+        if entry is not None and entry['default'] is not None:
+            return entry['default']
+        async with self._team_locks.setdefault(org.lower(), asyncio.Lock()):
+            entry = self._team_index.get(org.lower())
+            if entry is None or entry['default'] is None:
+                if await self._index_org_teams(org) is None:
+                    return None
+            team_id = self._team_index[org.lower()]['default']
+            if team_id is None and create:
+                r = await self.create_team(org, 'Default', 'Default group created by SCIM provisioning', False, True, 'read', DEFAULT_TEAM_NEW_ORG_PERMISSIONS)
+                if r.status_code == 201:
+                    team_id = r.json()['id']
+                    entry = self._team_index[org.lower()]
+                    self._team_index[org.lower()] = {'ids': entry['ids'] + [team_id], 'default': team_id}
+                elif r.status_code == 422:  # Another worker created it first
+                    await self._index_org_teams(org)
+                    team_id = (self._team_index.get(org.lower()) or {}).get('default')
+            return team_id
+
+    @staticmethod
+    async def _map_members(func, members):
+        """Run func for every member concurrently; the upstream semaphore bounds the calls in flight."""
+        return dict(zip(members, await asyncio.gather(*map(func, members))))
+
+    async def _add_members(self, org: str, members):
+        team_id = await self._get_org_default_team(org, create=True)
+        if not team_id:
+            return {member: 404 for member in members}
+
+        async def add_to(team_id, member):
+            return (await self.add_team_member(team_id, member)).status_code
+
+        statuses = await self._map_members(lambda m: add_to(team_id, m), members)
+        missing = [m for m, status in statuses.items() if status == 404]
+        if missing:  # Team may have been deleted behind our back, repair the index
+            self._forget_org_teams(org)
+            repaired_team_id = await self._get_org_default_team(org, create=True)
+            if repaired_team_id and repaired_team_id != team_id:
+                statuses.update(await self._map_members(lambda m: add_to(repaired_team_id, m), missing))
+        return statuses
+
+    async def _remove_members(self, org: str, members):
+        team_ids = await self._get_org_team_ids(org)
+        if team_ids is None:
+            return {member: 404 for member in members}
+
+        def remove_from_teams(ids):
+            async def remove(member):
+                responses = await asyncio.gather(*[self.remove_team_member(team_id, member) for team_id in ids])
+                return max((r.status_code for r in responses), default=204)
+            return remove
+
+        statuses = await self._map_members(remove_from_teams(team_ids), members)
+        if any(status == 404 for status in statuses.values()):  # Re-list and retry any teams we didn't know about
+            self._forget_org_teams(org)
+            new_team_ids = set(await self._get_org_team_ids(org) or []) - set(team_ids)
+            retried = [m for m, status in statuses.items() if status == 404]
+            if new_team_ids:
+                statuses.update(await self._map_members(remove_from_teams(new_team_ids), retried))
+        return statuses
+
+    async def scim_update_org_members(self, org: str, add=(), remove=()):
+        """
+        Apply membership changes to an org in one batch; see
+        GiteaSCIMWrapper.scim_update_org_members. Returns one
+        {"value", "op", "status"} entry per member.
+        """
+        add, remove = list(dict.fromkeys(add)), list(dict.fromkeys(remove))
+        added, removed = await asyncio.gather(
+            self._add_members(org, add) if add else asyncio.sleep(0, {}),
+            self._remove_members(org, remove) if remove else asyncio.sleep(0, {}),
+        )
+        return [{"value": m, "op": "add", "status": status} for m, status in added.items()] + \
+            [{"value": m, "op": "remove", "status": status} for m, status in removed.items()]
+
+    async def scim_add_org_member(self, org: str, member: str):
+        result = (await self.scim_update_org_members(org, add=[member]))[0]
+        if result["status"] in (201, 204):
+            return await self.scim_get_org(org=org)
+
+    async def scim_remove_org_member(self, org: str, member):
+        await self.scim_update_org_members(org, remove=[member])
+        return await self.scim_get_org(org=org)
+
+    async def scim_edit_org(self, org: str, members=True, **kwargs):
+        edit_org_response = await self.edit_org(org, **kwargs)
+        if edit_org_response.status_code == 200:
+            org = edit_org_response.json()
+            if members:
+                org['members'] = await self.scim_get_org_member_refs(org['username'])
+            return self._stamp(GiteaOrg.from_json(org).serialize())
+
+    async def scim_diff_org(self, org: str, operations):
+        """See GiteaSCIMWrapper.scim_diff_org. Raises patch.PatchError."""
+        named = patch.member_operations(operations)
+        if named is None:
+            current = await self.scim_get_org(org, members=True)
+            if not current:
+                return None, None, [], []
+            patched = patch.apply(current, operations)
+            return (current, patch.diff(patch.GROUP_FIELDS, current, patched)) + patch.member_changes(current, patched)
+        add, remove, rest = named
+        current = await self.scim_get_org(org, members=False)
+        if not current:
+            return None, None, [], []
+        return current, patch.diff(patch.GROUP_FIELDS, current, patch.apply(current, rest)), add, remove
+
+    async def scim_patch_org(self, org: str, current: dict, delta: dict, add=(), remove=()):
+        """
+        Write a diffed PATCH (see scim_diff_org) to Gitea. Returns (resource,
+        member results) like GiteaSCIMWrapper.scim_patch_org; the field edit
+        and the member changes go out concurrently.
+        """
+        edit = self.scim_edit_org(org, members=current.get('members') is not None, **delta) if delta else asyncio.sleep(0, current)
+        changes = self.scim_update_org_members(org, add=add, remove=remove) if add or remove else asyncio.sleep(0, [])
+        resource, results = await asyncio.gather(edit, changes)
+        if resource is None:
+            return None, results
+        if results and resource.get('members') is not None:
+            added = [r['value'] for r in results if r['op'] == 'add' and r['status'] < 400]
+            removed = {r['value'].lower() for r in results if r['op'] == 'remove' and r['status'] < 400}
+            members = [m for m in resource.get('members') or [] if m['value'].lower() not in removed]
+            present = {m['value'].lower() for m in members}
+            members += [member_ref({'username': name}) for name in added if name.lower() not in present]
+            resource = self._stamp({**resource, 'members': members, 'meta': dict(resource['meta'])})
+        return resource, results
+
+    @staticmethod
+    async def _walk(listing):
+        _, pages = await listing
+        return [item async for page in pages for item in page] if pages is not None else []
+
+    async def _org_member_users(self, org: str):
+        """Every member of an org, from the org member listing and each team's members, walked concurrently."""
+        team_ids = await self._get_org_team_ids(org) or []
+        walks = await asyncio.gather(self._walk(self.iter_org_members(org)), *[self._walk(self.iter_team_members(team_id)) for team_id in team_ids])
+        users = {}
+        for walk in walks:
+            for user in walk:
+                users.setdefault(user['username'].lower(), user)
+        return sorted(users.values(), key=lambda u: u['username'].lower())
+
+    async def scim_get_org_member_refs(self, org: str):
+        """SCIM Group members ({value, display, $ref}) for an org."""
+        return [member_ref(user) for user in await self._org_member_users(org)]
+
+    async def _with_members(self, resources, members=True):
+        if members:
+            refs = await asyncio.gather(*[self.scim_get_org_member_refs(resource['id']) for resource in resources])
+            for resource, member_refs in zip(resources, refs):
+                resource['members'] = member_refs
+        for resource in resources:
+            self._stamp(resource)
+        return resources
+
+    async def scim_get_org_members(self, org: str):
+        get_members_response = await self.get_org_members(org)
+        if get_members_response.status_code == 200:
+            return get_members_response.json()
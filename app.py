@@ -1,439 +1,855 @@
-from flask import Flask, jsonify, abort, make_response, request
-from functools import wraps
-from gitea import BASE_URL, TOKEN, GiteaSCIMWrapper
-import helpers
-
-G = GiteaSCIMWrapper(BASE_URL, TOKEN)
-
-def create_app():
-    """
-    Instantiate Flask
-
-    Implemented as a factory method to avoid a circular import error.
-    """
-    app = Flask(__name__)
-    # app.config["SQLALCHEMY_DATABASE_URI"] = "postgresql://localhost/scim"
-    # app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    # db.init_app(app)
-    return app
-
-
-app = create_app()
-
-
-def auth_required(func):
-    """Flask decorator to require the presence of a valid Authorization header."""
-
-    @wraps(func)
-    def check_auth(*args, **kwargs):
-        if request.headers["Authorization"].split("Bearer ")[1] == "123456789":
-            return func(*args, **kwargs)
-        else:
-            return make_response(jsonify({"error": "Unauthorized"}), 403)
-
-    return check_auth
-
-
-@app.route("/scim/v2/Users", methods=["GET"])
-@auth_required
-def get_users():
-    """Get SCIM Users"""
-    start_index = 1
-    count = None
-    users = None
-
-    if "start_index" in request.args:
-        start_index = int(request.args["startIndex"])
-
-    if "count" in request.args:
-        count = int(request.args["count"])
-
-    if "filter" in request.args:
-        single_filter = request.args["filter"].split(" ")
-        filter_value = single_filter[2].strip('"')
-
-        users = G.scim_get_user(username=filter_value)
-
-        if not users:
-            users = []
-        else:
-            users = [users]
-
-    else:
-        users = G.scim_get_users(page=start_index, limit=count)
-
-    serialized_users = users
-
-    return make_response(
-        jsonify(
-            {
-                "schemas": ["urn:ietf:params:scim:api:messages:2.0:ListResponse"],
-                "totalResults": len(users),
-                "startIndex": start_index,
-                "itemsPerPage": len(users),
-                "Resources": serialized_users,
-            }
-        ),
-        200,
-    )
-
-
-@app.route("/scim/v2/Users/<string:user_id>", methods=["GET"])
-@auth_required
-def get_user(user_id):
-    """Get SCIM User"""
-    user = G.scim_get_user(username=user_id)
-    if not user:
-        return make_response(
-            jsonify(
-                {
-                    "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
-                    "detail": "User not found",
-                    "status": "404",
-                }
-            ),
-            404,
-        )
-    return jsonify(user)
-
-
-@app.route("/scim/v2/Users", methods=["POST"])
-@auth_required
-def create_user():
-    """Create SCIM User"""
-    active = request.json.get("active")
-    description = request.json.get("description")
-    custom_Attributes = request.json.get("urn:ietf:params:scim:schemas:extension:Gitea:2.0:User")
-    full_name = custom_Attributes.get("full_name")
-    password = request.json.get("password", helpers.generate_password())
-    userName = request.json.get("userName")
-    source_id = custom_Attributes.get("source_id") # HMM
-    visibility = custom_Attributes.get("visibility")
-    email = request.json.get('emails')[0]['value']
-    # location = request.json.get("location")
-    print(request.json)
-
-    existing_user = G.get_user(username=userName)
-
-    if existing_user.status_code != 404:  ## Need specific codes & messages
-        return make_response(
-            jsonify(
-                {
-                    "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
-                    "detail": "User already exists in the database.",
-                    "status": 409,
-                }
-            ),
-            409,
-        )
-    else:
-        create_user = G.scim_create_user(email=email, full_name=full_name, username=userName, login_name=userName, source_id=source_id, visibility=visibility, password=password)
-        return make_response(jsonify(create_user), 201)
-        # db.session.add(user)
-
-        # if groups:
-        #     for group in groups:
-        #         existing_group = Group.query.get(group["value"])
-
-        #         if existing_group:
-        #             existing_group.users.append(user)
-        #         else:
-        #             new_group = Group(displayName=group["displayName"])
-        #             # db.session.add(new_group)
-        #             new_group.users.append(user)
-
-        # db.session.commit()
-
-
-# @app.route("/scim/v2/Users/<string:user_id>", methods=["PUT"])
-# @auth_required
-# def update_user(user_id):
-#     """Update SCIM User"""
-#     user = G.get_user(username=user_id).json()
-#     user = GiteaUser(**user)
-
-#     if not user:
-#         return make_response(
-#             jsonify(
-#                 {
-#                     "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
-#                     "detail": "User not found",
-#                     "status": 404,
-#                 }
-#             ),
-#             404,
-#         )
-#     else:
-#         groups = request.json.get("groups")
-#         active = request.json.get("active")
-#         displayName = request.json.get("displayName")
-#         emails = request.json.get("emails")
-#         externalId = request.json.get("externalId")
-#         locale = request.json.get("locale")
-#         name = request.json.get("name")
-#         # user.familyName = request.json["name"].get("familyName")
-#         # user.middleName = request.json["name"].get("middleName")
-#         # user.givenName = request.json["name"].get("givenName")
-#         password = request.json.get("password")
-#         schemas = request.json.get("schemas")
-#         userName = request.json.get("userName")
-
-#         resp = G.edit_user(userName, active=active, full_name=displayName, login_name=userName, email=emails[0]['value'], source_id=2)
-#         print(resp.json())
-#         updated_user = G.get_user(username=userName).json()
-#         updated_user = GiteaUser(**updated_user)
-
-#         # db.session.commit()
-#         return make_response(jsonify(updated_user.serialize()), 200)
-
-
-@app.route("/scim/v2/Users/<string:user_id>", methods=["PATCH"])
-@auth_required
-def patch_user(user_id):
-    """PATCH SCIM User"""
-    updates = {}
-    for operation in request.json["Operations"]:  # Really need a consistent attribute listing to re-use
-        print(operation)
-        if operation['path'] == 'urn:ietf:params:scim:schemas:extension:Gitea:2.0:User:full_name':
-            updates['full_name'] = operation['value']
-        if operation['path'] == 'description':
-            updates['description'] = operation['value']
-        if operation['path'] == 'urn:ietf:params:scim:schemas:extension:Gitea:2.0:User:visibility':
-            updates['visibility'] = operation['value']
-        if operation['path'] == 'urn:ietf:params:scim:schemas:extension:Gitea:2.0:User:location':
-            updates['location'] = operation['value']
-        if operation['path'] == 'active':
-            if operation['value'] == 'False':
-                updates['active'] = False
-            elif operation['value'] == 'True':
-                updates['active'] = True
-        if operation['path'] == 'emails[type eq "work"].value':
-            updates['email'] = operation['value']
-    updated_user = G.scim_edit_user(user_id, login_name=user_id, **updates)
-    return make_response(jsonify(updated_user), 200)
-    # return make_response("", 204)
-
-
-@app.route("/scim/v2/Users/<string:user_id>", methods=["DELETE"])
-@auth_required
-def delete_user(user_id):
-    """Delete SCIM User"""
-    G.delete_user(username=user_id)
-    return make_response("", 204)
-
-
-@app.route("/scim/v2/Groups", methods=["GET"])
-@auth_required
-def get_groups():
-    """Get SCIM Groups"""
-    start_index = 1
-    count = None
-    groups = None
-
-    if "start_index" in request.args:
-        start_index = int(request.args["startIndex"])
-
-    if "count" in request.args:
-        count = int(request.args["count"])
-
-    if "filter" in request.args:
-        single_filter = request.args["filter"].split(" ")
-        filter_value = single_filter[2].strip('"')
-
-        groups = G.scim_get_org(org=filter_value)
-
-        if not groups:
-            groups = []
-        else:
-            groups = [groups]
-
-    else:
-        groups = G.scim_get_orgs(page=start_index, limit=count)
-
-    serialized_groups = groups
-
-
-    return make_response(
-    jsonify(
-        {
-            "schemas": ["urn:ietf:params:scim:api:messages:2.0:ListResponse"],
-            "totalResults": len(groups),
-            "startIndex": start_index,
-            "itemsPerPage": len(groups),
-            "Resources": serialized_groups,
-        }
-    ),
-    200,
-)
-
-
-@app.route("/scim/v2/Groups/<string:group_id>", methods=["GET"])
-# @auth_required
-def get_group(group_id):
-    """Get SCIM Group"""
-    group = G.scim_get_org(org=group_id)
-    if not group:
-        abort(404)
-    return jsonify(group)
-
-
-@app.route("/scim/v2/Groups", methods=["POST"])
-@auth_required
-def create_group():
-    """Create SCIM Group"""
-    # username = request.json["urn:ietf:params:scim:schemas:extension:Gitea:2.0:Group:organization_name"]
-    username = request.json["displayName"]
-    description = request.json.get('description')
-    # members = request.json["members"]
-    custom_attributes = request.json.get('urn:ietf:params:scim:schemas:extension:Gitea:2.0:Group')
-    full_name = custom_attributes.get('full_name')
-    visiblity = custom_attributes.get('visibility')
-    # print(request.json)
-
-    try:
-        group = G.scim_create_org(username=username, full_name=full_name, description=description, visibility=visiblity)
-        return make_response(jsonify(group), 201)
-    except Exception as e:
-        return str(e)
-
-
-@app.route("/scim/v2/Groups/<string:group_id>", methods=["PATCH", "PUT"])
-@auth_required
-def update_group(group_id):
-    """
-    Update SCIM Group
-
-    Accounts for the different requests sent by Okta depending
-    on if the group was created via template or app wizard integration.
-    """
-    print(request.json)
-    group = None
-    members_to_add = []
-    members_to_remove = []
-    updates = {}
-    for operation in request.json["Operations"]:
-        action = operation.get('op')
-        if operation["path"] == 'members':
-            if action == 'Add':
-                members_to_add = operation["value"]
-            elif action == 'Remove':
-                members_to_remove = operation["value"]
-        if operation["path"] == 'description':
-            updates['description'] = operation["value"]
-        if operation["path"] == 'urn:ietf:params:scim:schemas:extension:Gitea:2.0:Group:visibility':
-            updates['visibility'] = operation["value"]
-        if operation["path"] == 'urn:ietf:params:scim:schemas:extension:Gitea:2.0:Group:full_name':
-            updates['full_name'] = operation["value"]
-        if operation["op"] == "replace":
-            return make_response("", 204)
-
-    if updates:
-        group = G.scim_edit_org(org=group_id, **updates)
-
-    for member in members_to_add:
-        existing_user = G.get_user(username=member["value"])
-        if existing_user:
-            group = G.scim_add_org_member(org=group_id, member=member["value"])
-    for member in members_to_remove:
-        existing_user = G.get_user(username=member["value"])
-        if existing_user:
-            group = G.scim_remove_org_member(org=group_id, member=member["value"])
-
-    if not group:
-        group = G.scim_get_org(org=group_id)
-
-    return make_response(jsonify(group), 200)
-
-
-# @app.route("/scim/v2/Groups/<string:group_id>", methods=["DELETE"])
-# @auth_required
-# def delete_group(group_id):
-#     """Delete SCIM Group"""
-#     group = Group.query.get(group_id)
-#     db.session.delete(group)
-#     db.session.commit()
-#     return make_response("", 204)
-
-
-# @app.route("/scim/v2/Schemas", methods=["GET"])
-# @auth_required
-# def get_schema():
-#     user_schema = {
-#         "schemas": ["urn:ietf:params:scim:schemas:core:2.0:Schema"],
-#         "id" : "urn:ietf:params:scim:schemas:core:2.0:User",
-#         "name" : "User",
-#         "description" : "User Account",
-#         "attributes" : [
-#         {
-#             "name" : "username",
-#             "type" : "string",
-#             "multiValued" : False,
-#             "description" : """Unique identifier for the User, typically
-#     used by the user to directly authenticate to the service provider.
-#     Each User MUST include a non-empty userName value.  This identifier
-#     MUST be unique across the service provider's entire set of Users.
-#     REQUIRED.""",
-#             "required" : True,
-#             "caseExact" : False,
-#             "mutability" : "readWrite",
-#             "returned" : "default",
-#             "uniqueness" : "server"
-#         },
-#         {
-#             "name" : "email",
-#             "type" : "string",
-#             "multiValued" : False,
-#             "description" : "Email Address",
-#             "required" : True,
-#             "caseExact" : False,
-#             "mutability" : "readWrite",
-#             "returned" : "default",
-#             "uniqueness" : "None"
-#         },
-#         {
-#             "name" : "full_name",
-#             "type" : "string",
-#             "multiValued" : False,
-#             "description" : "Full Name",
-#             "required" : False,
-#             "caseExact" : True,
-#             "mutability" : "readWrite",
-#             "returned" : "default",
-#             "uniqueness" : "None"
-#         },
-#         {
-#             "name" : "active",
-#             "type" : "boolean",
-#             "multiValued" : False,
-#             "description" : "Active Status",
-#             "required" : False,
-#             "caseExact" : False,
-#             "mutability" : "readWrite",
-#             "returned" : "default",
-#             "uniqueness" : "None"
-#         },
-#         ],
-#         "meta" : {
-#         "resourceType" : "Schema",
-#         "location" :
-#             "/v2/Schemas/urn:ietf:params:scim:schemas:core:2.0:User"
-#         }
-#     }
-#     schemas = [user_schema]
-#     return make_response(
-#         jsonify(
-#             {
-#                 "schemas": ["urn:ietf:params:scim:api:messages:2.0:ListResponse"],
-#                 "totalResults": len(schemas),
-#                 "startIndex": 1,
-#                 "itemsPerPage": len(schemas),
-#                 "Resources": schemas,
-#             }
-#         ),
-#         200,
-#     )
-#     # return jsonify(user_schema, 200)
-
-
-if __name__ == "__main__":
-    app.run(debug=True, host='0.0.0.0')
+import json
+import time
+
+from flask import Flask, Response, jsonify, abort, make_response, request, stream_with_context
+from functools import wraps
+from werkzeug.exceptions import HTTPException, MethodNotAllowed
+from bulk import BulkProcessor, bulk_error
+from cache import SharedCache
+from filters import FilterError
+from patch import PatchError
+from projection import Projection
+import serializer
+from gitea import BASE_URL, TOKEN, ConflictError, GiteaSCIMWrapper, GiteaUnavailable
+import helpers
+import metrics
+import settings
+import tracing
+from journal import WriteJournal
+from store import ShadowStore
+
+# Under serve.py every worker imports this module; worker 0 alone syncs the store and applies the journal
+primary = settings.WORKER_ID == 0
+cache = SharedCache(settings.SHARED_CACHE_PATH) if settings.SHARED_CACHE_PATH else None
+store = ShadowStore(settings.SHADOW_STORE_PATH) if settings.SHADOW_STORE_PATH else None
+journal = WriteJournal(settings.JOURNAL_PATH, recover=primary) if settings.JOURNAL_PATH else None
+G = GiteaSCIMWrapper(BASE_URL, TOKEN, cache=cache, store=store, journal=journal)
+if store is not None and primary:
+    store.start_sync(G)
+if journal is not None and primary:
+    journal.start(G)
+if settings.METRICS_ENABLED:
+    metrics.register_stats('scim_cache', G.cache.stats, {
+        'size': 'Entries in the user/org lookup cache.',
+        'hits': 'Lookups answered from the cache.',
+        'misses': 'Lookups that went to Gitea.',
+        'evictions': 'Entries dropped to stay under CACHE_MAXSIZE.',
+        'hit_ratio': 'Share of lookups answered from the cache.',
+    }, kinds={'hits': 'counter', 'misses': 'counter', 'evictions': 'counter'})
+    metrics.register_stats('gitea_transport', G.transport.stats, {
+        'in_flight': 'Requests holding a pooled Gitea connection.',
+        'requests': 'Requests sent through the pool.',
+    }, kinds={'requests': 'counter'})
+    if G.guard is not None:
+        metrics.register_stats('gitea_limiter', G.guard.stats, {
+            'limit': 'Gitea calls allowed in flight, adjusted to its latency and errors.',
+            'in_flight': 'Gitea calls holding a slot under the limit.',
+            'breaker_state': 'Circuit breaker in front of Gitea: 0 closed, 1 half-open (probing), 2 open.',
+            'breaker_opened': 'Times the breaker opened.',
+            'rejected': 'Gitea calls failed fast by the breaker or the limiter.',
+        }, kinds={'breaker_opened': 'counter', 'rejected': 'counter'})
+    if G.single_flight is not None:
+        metrics.register_stats('gitea_single_flight', G.single_flight.stats, {
+            'executed': 'GETs sent to Gitea.',
+            'coalesced': 'GETs that shared an identical in-flight call.',
+        }, kinds={'executed': 'counter', 'coalesced': 'counter'})
+    if journal is not None:
+        metrics.register_stats('scim_journal', journal.stats, {
+            'pending': 'Queued writes not yet applied to Gitea.',
+            'running': 'Writes being applied.',
+            'failed': 'Writes that gave up.',
+            'oldest_pending_age': 'Seconds the oldest open write has waited.',
+        })
+
+def create_app():
+    """
+    Instantiate Flask
+
+    Implemented as a factory method to avoid a circular import error.
+    """
+    app = Flask(__name__)
+    # app.config["SQLALCHEMY_DATABASE_URI"] = "postgresql://localhost/scim"
+    # app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # db.init_app(app)
+    return app
+
+
+app = create_app()
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+@app.before_request
+def start_request():
+    if settings.METRICS_ENABLED:
+        request.environ["scim.started"] = time.perf_counter()
+        metrics.scim_in_flight.inc()
+    if settings.TRACE_ENABLED:
+        # A chunked body has no Content-Length to bound it by, it is left for the route to read
+        body = request.get_json(silent=True) if request.content_length is not None else None
+        units = tracing.payload_units(body, request.args.get("count", type=int))
+        request.environ["scim.trace"] = tracing.begin(request.method, _route(), request.path, units)
+
+
+@app.after_request
+def record_status(response):
+    request.environ["scim.status"] = response.status_code
+    trace = request.environ.get("scim.trace")
+    if trace is not None and settings.TRACE_SERVER_TIMING:
+        response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+
+@app.teardown_request
+def finish_request(exc):
+    status = request.environ.pop("scim.status", 500)  # after_request never ran when the view raised
+    started = request.environ.pop("scim.started", None)
+    if started is not None:
+        metrics.scim_in_flight.dec()
+        metrics.scim_requests.observe(time.perf_counter() - started, request.method, _route(), str(status))
+    trace = request.environ.pop("scim.trace", None)
+    if trace is not None and tracing.finish(trace, status) and settings.METRICS_ENABLED:
+        metrics.scim_fanout.inc(request.method, _route())
+
+
+def auth_required(func):
+    """Flask decorator to require the presence of a valid Authorization header."""
+
+    @wraps(func)
+    def check_auth(*args, **kwargs):
+        if request.headers["Authorization"].split("Bearer ")[1] == "123456789":
+            return func(*args, **kwargs)
+        else:
+            return make_response(jsonify({"error": "Unauthorized"}), 403)
+
+    return check_auth
+
+
+def stream_list_response(total_results, start_index, pages):
+    """
+    Stream a ListResponse one Gitea page at a time.
+
+    Used when the client omits count and wants the whole directory, so memory
+    stays proportional to a single page rather than every resource.
+    """
+
+    def generate():
+        header = {
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:ListResponse"],
+            "startIndex": start_index,
+        }
+        if total_results is not None:
+            header["totalResults"] = total_results
+        yield serializer.dumps(header)[:-1] + b',"Resources":['
+        items = 0
+        for page in pages:
+            if not page:
+                continue
+            yield (b"," if items else b"") + b",".join(serializer.dumps(resource) for resource in page)
+            items += len(page)
+        trailer = {"itemsPerPage": items}
+        if total_results is None:  # Gitea didn't send X-Total-Count, we only know once the walk is done
+            trailer["totalResults"] = start_index - 1 + items
+        yield b"]," + serializer.dumps(trailer)[1:]
+
+    return Response(stream_with_context(generate()), status=200, mimetype="application/json")
+
+
+def invalid_filter(error):
+    return make_response(
+        jsonify(
+            {
+                "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+                "scimType": "invalidFilter",
+                "detail": str(error),
+                "status": "400",
+            }
+        ),
+        400,
+    )
+
+
+def invalid_patch(error):
+    return make_response(
+        jsonify(
+            {
+                "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+                "scimType": error.scim_type,
+                "detail": str(error),
+                "status": "400",
+            }
+        ),
+        400,
+    )
+
+
+def user_not_found():
+    return make_response(
+        jsonify(
+            {
+                "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+                "detail": "User not found",
+                "status": "404",
+            }
+        ),
+        404,
+    )
+
+
+def uniqueness_error(detail):
+    return make_response(
+        jsonify(
+            {
+                "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+                "scimType": "uniqueness",
+                "detail": detail,
+                "status": "409",
+            }
+        ),
+        409,
+    )
+
+
+def upstream_error(detail):
+    return make_response(
+        jsonify(
+            {
+                "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+                "detail": detail,
+                "status": "502",
+            }
+        ),
+        502,
+    )
+
+
+@app.errorhandler(GiteaUnavailable)
+def service_unavailable(error):
+    """503 with Retry-After while the breaker or limiter keeps calls away from Gitea."""
+    return make_response(
+        jsonify(
+            {
+                "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+                "detail": str(error),
+                "status": "503",
+            }
+        ),
+        503,
+        {"Retry-After": str(error.retry_after)},
+    )
+
+
+def _etags(header):
+    return {tag.strip().removeprefix("W/") for tag in header.split(",")} if header else set()
+
+
+def not_modified(kind, resource_id, members=False):
+    """304 for an If-None-Match hit on a fresh cached fingerprint, answered without calling Gitea."""
+    tags = _etags(request.headers.get("If-None-Match"))
+    if tags:
+        version = G.cached_version(kind, resource_id, members)
+        if version and ("*" in tags or version.removeprefix("W/") in tags):
+            return make_response("", 304, {"ETag": version})
+
+
+def precondition_failed(kind, resource_id, headers):
+    """412 when If-Match names a version other than the resource's current one."""
+    tags = _etags(headers.get("If-Match"))
+    if tags and "*" not in tags:
+        version = G.current_version(kind, resource_id)
+        if version is None or version.removeprefix("W/") not in tags:
+            return make_response(
+                jsonify(
+                    {
+                        "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+                        "detail": "Resource version does not match If-Match",
+                        "status": "412",
+                    }
+                ),
+                412,
+            )
+
+
+def with_etag(response, resource, if_none_match=None):
+    """Set the ETag header from meta.version; GETs pass If-None-Match to turn hits into 304s."""
+    version = ((resource or {}).get("meta") or {}).get("version")
+    if version:
+        if version.removeprefix("W/") in _etags(if_none_match):
+            return make_response("", 304, {"ETag": version})
+        response.headers["ETag"] = version
+    return response
+
+
+def idempotency_key(headers, action):
+    # One request can queue several entries (a group PATCH edits and changes members), scope the client's key per action
+    key = headers.get("Idempotency-Key")
+    return f"{key}:{action}" if key else None
+
+
+def journaled(kind, resource_id, action, payload, headers):
+    """
+    Queue a write on the journal and wait up to JOURNAL_ACK_TIMEOUT for Gitea to take it.
+
+    Returns an error response if Gitea rejected it, else None; the caller then
+    answers from a read, which folds in the write if it is still queued.
+    """
+    entry = journal.wait(journal.submit(kind, resource_id, action, payload, idempotency_key(headers, action)))
+    if not entry.failed:
+        return None
+    status = entry.error_status if entry.error_status in (400, 403, 404, 409) else 409 if entry.error_status == 422 else 503
+    error = {
+        "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+        "detail": entry.error,
+        "status": str(status),
+    }
+    if status == 409:
+        error["scimType"] = "uniqueness"
+    return make_response(jsonify(error), status)
+
+
+def parse_paging():
+    """Read SCIM startIndex/count, clamping count to SCIM_MAX_PAGE_SIZE."""
+    start_index = max(request.args.get("startIndex", 1, type=int), 1)
+    count = request.args.get("count", settings.SCIM_MAX_PAGE_SIZE, type=int)
+    count = min(max(count, 0), settings.SCIM_MAX_PAGE_SIZE)
+    return start_index, count
+
+
+@app.route("/scim/v2/Users", methods=["GET"])
+@auth_required
+def get_users():
+    """Get SCIM Users"""
+    start_index, count = parse_paging()
+    projection = Projection.from_args(request.args)
+    users = None
+    total_results = 0
+
+    if "filter" in request.args:
+        try:
+            users, total_results = G.scim_filter_users(request.args["filter"], start_index=start_index, count=count)
+        except FilterError as e:
+            return invalid_filter(e)
+
+    elif "count" not in request.args and settings.SCIM_STREAM_UNPAGINATED:
+        total_results, pages = G.scim_iter_users(start_index=start_index) or (0, iter(()))
+        return stream_list_response(total_results, start_index, ([projection.apply(r) for r in page] for page in pages))
+
+    else:
+        users, total_results = G.scim_get_users(start_index=start_index, count=count) or ([], 0)
+
+    serialized_users = [projection.apply(user) for user in users]
+
+    return Response(serializer.list_response(serialized_users, start_index, total_results), status=200, mimetype="application/json")
+
+
+@app.route("/scim/v2/Users/<string:user_id>", methods=["GET"])
+@auth_required
+def get_user(user_id):
+    """Get SCIM User"""
+    cached = not_modified("user", user_id)
+    if cached:
+        return cached
+    user = G.scim_get_user(username=user_id)
+    if not user:
+        return make_response(
+            jsonify(
+                {
+                    "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+                    "detail": "User not found",
+                    "status": "404",
+                }
+            ),
+            404,
+        )
+    return with_etag(jsonify(Projection.from_args(request.args).apply(user)), user, request.headers.get("If-None-Match"))
+
+
+@app.route("/scim/v2/Users", methods=["POST"])
+@auth_required
+def create_user():
+    """Create SCIM User"""
+    app.logger.debug("create_user %s", request.json)
+    return _create_user(request.json, request.headers)
+
+
+# The write logic of each route takes the body and headers explicitly, Bulk calls it directly
+
+def _create_user(body, headers):
+    active = body.get("active")
+    description = body.get("description")
+    custom_Attributes = body.get("urn:ietf:params:scim:schemas:extension:Gitea:2.0:User")
+    full_name = custom_Attributes.get("full_name")
+    password = body.get("password", helpers.generate_password())
+    userName = body.get("userName")
+    source_id = custom_Attributes.get("source_id") # HMM
+    visibility = custom_Attributes.get("visibility")
+    email = body.get('emails')[0]['value']
+    # location = body.get("location")
+
+    if journal is not None:
+        queued = any(entry.action == "create_user" for entry in journal.pending("user", userName))  # Gitea hasn't seen it yet
+        if queued and not journal.get_by_key(idempotency_key(headers, "create_user")):
+            return uniqueness_error(f"User {userName} already exists")
+        failed = journaled("user", userName, "create_user", dict(email=email, full_name=full_name, username=userName, login_name=userName, source_id=source_id, visibility=visibility, password=password), headers)
+        if failed:
+            return failed
+        created_user = G.scim_get_user(userName)
+        return with_etag(make_response(jsonify(created_user), 201), created_user)
+
+    try:
+        created_user = G.scim_create_user(email=email, full_name=full_name, username=userName, login_name=userName, source_id=source_id, visibility=visibility, password=password)
+    except ConflictError as e:
+        return uniqueness_error(str(e))
+    if not created_user:
+        return upstream_error("Gitea could not create the user")
+    return with_etag(make_response(jsonify(created_user), 201), created_user)
+    # db.session.add(user)
+
+    # if groups:
+    #     for group in groups:
+    #         existing_group = Group.query.get(group["value"])
+
+    #         if existing_group:
+    #             existing_group.users.append(user)
+    #         else:
+    #             new_group = Group(displayName=group["displayName"])
+    #             # db.session.add(new_group)
+    #             new_group.users.append(user)
+
+    # db.session.commit()
+
+
+# @app.route("/scim/v2/Users/<string:user_id>", methods=["PUT"])
+# @auth_required
+# def update_user(user_id):
+#     """Update SCIM User"""
+#     user = G.get_user(username=user_id).json()
+#     user = GiteaUser(**user)
+
+#     if not user:
+#         return make_response(
+#             jsonify(
+#                 {
+#                     "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+#                     "detail": "User not found",
+#                     "status": 404,
+#                 }
+#             ),
+#             404,
+#         )
+#     else:
+#         groups = request.json.get("groups")
+#         active = request.json.get("active")
+#         displayName = request.json.get("displayName")
+#         emails = request.json.get("emails")
+#         externalId = request.json.get("externalId")
+#         locale = request.json.get("locale")
+#         name = request.json.get("name")
+#         # user.familyName = request.json["name"].get("familyName")
+#         # user.middleName = request.json["name"].get("middleName")
+#         # user.givenName = request.json["name"].get("givenName")
+#         password = request.json.get("password")
+#         schemas = request.json.get("schemas")
+#         userName = request.json.get("userName")
+
+#         resp = G.edit_user(userName, active=active, full_name=displayName, login_name=userName, email=emails[0]['value'], source_id=2)
+#         print(resp.json())
+#         updated_user = G.get_user(username=userName).json()
+#         updated_user = GiteaUser(**updated_user)
+
+#         # db.session.commit()
+#         return make_response(jsonify(updated_user.serialize()), 200)
+
+
+@app.route("/scim/v2/Users/<string:user_id>", methods=["PATCH"])
+@auth_required
+def patch_user(user_id):
+    """PATCH SCIM User"""
+    return _patch_user(user_id, request.json, request.headers)
+
+
+def _patch_user(user_id, body, headers):
+    failed = precondition_failed("user", user_id, headers)
+    if failed:
+        return failed
+    try:
+        current, delta = G.scim_diff_user(user_id, body["Operations"])
+    except PatchError as e:
+        return invalid_patch(e)
+    if current is None:
+        return user_not_found()
+
+    if not delta:  # Nothing changed, Gitea isn't called at all
+        updated_user = current
+    elif journal is not None:
+        failed = journaled("user", user_id, "edit_user", {"fields": dict(login_name=user_id, **delta)}, headers)
+        if failed:
+            return failed
+        updated_user = G.scim_get_user(user_id)
+    else:
+        updated_user = G.scim_edit_user(user_id, login_name=user_id, **delta)
+        if not updated_user:
+            return upstream_error("Gitea could not update the user")
+    return with_etag(make_response(jsonify(updated_user), 200), updated_user)
+    # return make_response("", 204)
+
+
+@app.route("/scim/v2/Users/<string:user_id>", methods=["DELETE"])
+@auth_required
+def delete_user(user_id):
+    """Delete SCIM User"""
+    return _delete_user(user_id, request.headers)
+
+
+def _delete_user(user_id, headers):
+    failed = precondition_failed("user", user_id, headers)
+    if failed:
+        return failed
+    if journal is not None:
+        return journaled("user", user_id, "delete_user", {}, headers) or make_response("", 204)
+    G.delete_user(username=user_id)
+    return make_response("", 204)
+
+
+@app.route("/scim/v2/Groups", methods=["GET"])
+@auth_required
+def get_groups():
+    """Get SCIM Groups"""
+    start_index, count = parse_paging()
+    projection = Projection.from_args(request.args)
+    groups = None
+    total_results = 0
+
+    if "filter" in request.args:
+        try:
+            groups, total_results = G.scim_filter_orgs(request.args["filter"], start_index=start_index, count=count, members=projection.needs("members"))
+        except FilterError as e:
+            return invalid_filter(e)
+
+    elif "count" not in request.args and settings.SCIM_STREAM_UNPAGINATED:
+        total_results, pages = G.scim_iter_orgs(start_index=start_index, members=projection.needs("members")) or (0, iter(()))
+        return stream_list_response(total_results, start_index, ([projection.apply(r) for r in page] for page in pages))
+
+    else:
+        groups, total_results = G.scim_get_orgs(start_index=start_index, count=count, members=projection.needs("members")) or ([], 0)
+
+    serialized_groups = [projection.apply(group) for group in groups]
+
+    return Response(serializer.list_response(serialized_groups, start_index, total_results), status=200, mimetype="application/json")
+
+
+@app.route("/scim/v2/Groups/<string:group_id>", methods=["GET"])
+# @auth_required
+def get_group(group_id):
+    """Get SCIM Group"""
+    projection = Projection.from_args(request.args)
+    cached = not_modified("org", group_id, projection.needs("members"))
+    if cached:
+        return cached
+    group = G.scim_get_org(org=group_id, members=projection.needs("members"))
+    if not group:
+        abort(404)
+    return with_etag(jsonify(projection.apply(group)), group, request.headers.get("If-None-Match"))
+
+
+@app.route("/scim/v2/Groups", methods=["POST"])
+@auth_required
+def create_group():
+    """Create SCIM Group"""
+    return _create_group(request.json, request.headers)
+
+
+def _create_group(body, headers):
+    # username = body["urn:ietf:params:scim:schemas:extension:Gitea:2.0:Group:organization_name"]
+    username = body["displayName"]
+    description = body.get('description')
+    # members = body["members"]
+    custom_attributes = body.get('urn:ietf:params:scim:schemas:extension:Gitea:2.0:Group')
+    full_name = custom_attributes.get('full_name')
+    visiblity = custom_attributes.get('visibility')
+    # print(body)
+
+    if journal is not None:
+        failed = journaled("org", username, "create_org", dict(username=username, full_name=full_name, description=description, visibility=visiblity), headers)
+        if failed:
+            return failed
+        group = G.scim_get_org(org=username)
+        return with_etag(make_response(jsonify(group), 201), group)
+
+    try:
+        group = G.scim_create_org(username=username, full_name=full_name, description=description, visibility=visiblity)
+    except ConflictError as e:
+        return uniqueness_error(str(e))
+    except GiteaUnavailable as e:
+        return service_unavailable(e)
+    except Exception as e:
+        return str(e)
+    if not group:
+        return upstream_error("Gitea could not create the group")
+    return with_etag(make_response(jsonify(group), 201), group)
+
+
+@app.route("/scim/v2/Groups/<string:group_id>", methods=["PATCH", "PUT"])
+@auth_required
+def update_group(group_id):
+    """
+    Update SCIM Group
+
+    Accounts for the different requests sent by Okta depending
+    on if the group was created via template or app wizard integration.
+    """
+    app.logger.debug("update_group %s %s", group_id, request.json)
+    return _update_group(group_id, request.json, request.headers)
+
+
+def _update_group(group_id, body, headers):
+    failed = precondition_failed("org", group_id, headers)
+    if failed:
+        return failed
+    try:
+        group, delta, add, remove = G.scim_diff_org(group_id, body["Operations"])
+    except PatchError as e:
+        return invalid_patch(e)
+    if group is None:
+        abort(404)
+
+    member_results = []
+    if journal is not None:
+        if delta:
+            failed = journaled("org", group_id, "edit_org", {"fields": delta}, headers)
+            if failed:
+                return failed
+        if add or remove:
+            entry = journal.submit("org", group_id, "update_members", {"add": add, "remove": remove}, idempotency_key(headers, "update_members"))
+            member_results = journal.wait(entry).result or []  # What has reached Gitea so far, the rest is still queued
+        if delta or add or remove:
+            group = G.scim_get_org(org=group_id, members=group.get("members") is not None)
+
+    elif delta or add or remove:
+        group, member_results = G.scim_patch_org(group_id, group, delta, add, remove)
+        if group is None:
+            return upstream_error("Gitea could not update the group")
+
+    # A member named for removal that Gitea doesn't know isn't a member either
+    failed = [result for result in member_results if result["status"] >= 400 and not (result["op"] == "remove" and result["status"] == 404)]
+    if failed:
+        return make_response(
+            jsonify(
+                {
+                    "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+                    "detail": "Some membership changes failed: " + ", ".join(f'{r["op"]} {r["value"]} ({r["status"]})' for r in failed),
+                    "status": "400",
+                    "scimType": "invalidValue",
+                }
+            ),
+            400,
+        )
+
+    if group.get("members") is None:  # Members were changed by name without reading the list, RFC 7644 allows 204 here
+        return make_response("", 204)
+    return with_etag(make_response(jsonify(group), 200), group)
+
+
+# Routes a bulk operation may target, by endpoint: (view args, data, headers) -> response
+BULK_WRITES = {
+    "create_user": lambda args, data, headers: _create_user(data, headers),
+    "patch_user": lambda args, data, headers: _patch_user(args["user_id"], data, headers),
+    "delete_user": lambda args, data, headers: _delete_user(args["user_id"], headers),
+    "create_group": lambda args, data, headers: _create_group(data, headers),
+    "update_group": lambda args, data, headers: _update_group(args["group_id"], data, headers),
+}
+
+
+def _dispatch_bulk_operation(url_root):
+    """Run one bulk operation through the write logic of the matching SCIM route; `version` becomes its If-Match."""
+    urls = app.url_map.bind("")
+
+    def dispatch(method, path, data, version=None):
+        headers = {"If-Match": version} if version else {}
+        with app.app_context():  # Pool threads have no request, the routes only need the app for jsonify
+            try:
+                endpoint, args = urls.match(f"/scim/v2{path}", method)
+                write = BULK_WRITES.get(endpoint)
+                if write is None:
+                    raise MethodNotAllowed()
+                response = app.make_response(write(args, data, headers))
+            except HTTPException as e:
+                response = e.get_response()
+            except GiteaUnavailable as e:
+                response = service_unavailable(e)
+            body = response.get_json(silent=True)
+        if response.status_code >= 400 and not (isinstance(body, dict) and "schemas" in body):
+            body = bulk_error(response.status_code, response.status)
+        location = None
+        if response.status_code < 300 and isinstance(body, dict) and body.get("id"):
+            resource_type = path.strip("/").split("/")[0]
+            location = f"{url_root}scim/v2/{resource_type}/{body['id']}"
+        return response.status_code, body, location
+
+    return dispatch
+
+
+def read_body(limit):
+    """
+    The raw request body, or None if it is longer than `limit` bytes. A
+    chunked body has no Content-Length to refuse up front, so at most
+    limit + 1 bytes of it are read.
+    """
+    if request.content_length is not None and request.content_length > limit:
+        return None
+    data = request.get_data(cache=True) if request.content_length is not None else request.stream.read(limit + 1)
+    return data if len(data) <= limit else None
+
+
+@app.route("/scim/v2/Bulk", methods=["POST"])
+@auth_required
+def bulk():
+    """SCIM Bulk (RFC 7644 section 3.7)"""
+    data = read_body(settings.BULK_MAX_PAYLOAD_SIZE)
+    if data is None:
+        return make_response(jsonify(bulk_error(413, f"The size of the bulk operation exceeds the maxPayloadSize ({settings.BULK_MAX_PAYLOAD_SIZE}).")), 413)
+    try:
+        body = json.loads(data)
+    except ValueError as e:
+        return make_response(jsonify(bulk_error(400, f"Invalid JSON: {e}", "invalidSyntax")), 400)
+    if not isinstance(body, dict):
+        return make_response(jsonify(bulk_error(400, "A BulkRequest must be a JSON object.", "invalidSyntax")), 400)
+    operations = body.get("Operations", [])
+    if len(operations) > settings.BULK_MAX_OPERATIONS:
+        return make_response(jsonify(bulk_error(413, f"The number of operations exceeds the maxOperations ({settings.BULK_MAX_OPERATIONS}).")), 413)
+
+    processor = BulkProcessor(_dispatch_bulk_operation(request.url_root))
+    result = processor.process(operations, fail_on_errors=body.get("failOnErrors"))
+    return make_response(jsonify(result), 200)
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Prometheus metrics"""
+    if not settings.METRICS_ENABLED:
+        abort(404)
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route("/scim/v2/ServiceProviderConfig", methods=["GET"])
+def get_service_provider_config():
+    """SCIM ServiceProviderConfig"""
+    return jsonify(
+        {
+            "schemas": ["urn:ietf:params:scim:schemas:core:2.0:ServiceProviderConfig"],
+            "patch": {"supported": True},
+            "bulk": {
+                "supported": True,
+                "maxOperations": settings.BULK_MAX_OPERATIONS,
+                "maxPayloadSize": settings.BULK_MAX_PAYLOAD_SIZE,
+            },
+            "filter": {"supported": True, "maxResults": settings.SCIM_MAX_PAGE_SIZE},
+            "changePassword": {"supported": False},
+            "sort": {"supported": False},
+            "etag": {"supported": True},
+            "authenticationSchemes": [
+                {
+                    "type": "oauthbearertoken",
+                    "name": "OAuth Bearer Token",
+                    "description": "Authentication scheme using the OAuth Bearer Token Standard",
+                }
+            ],
+            "meta": {"resourceType": "ServiceProviderConfig"},
+        }
+    )
+
+
+# @app.route("/scim/v2/Groups/<string:group_id>", methods=["DELETE"])
+# @auth_required
+# def delete_group(group_id):
+#     """Delete SCIM Group"""
+#     group = Group.query.get(group_id)
+#     db.session.delete(group)
+#     db.session.commit()
+#     return make_response("", 204)
+
+
+# @app.route("/scim/v2/Schemas", methods=["GET"])
+# @auth_required
+# def get_schema():
+#     user_schema = {
+#         "schemas": ["urn:ietf:params:scim:schemas:core:2.0:Schema"],
+#         "id" : "urn:ietf:params:scim:schemas:core:2.0:User",
+#         "name" : "User",
+#         "description" : "User Account",
+#         "attributes" : [
+#         {
+#             "name" : "username",
+#             "type" : "string",
+#             "multiValued" : False,
+#             "description" : """Unique identifier for the User, typically
+#     used by the user to directly authenticate to the service provider.
+#     Each User MUST include a non-empty userName value.  This identifier
+#     MUST be unique across the service provider's entire set of Users.
+#     REQUIRED.""",
+#             "required" : True,
+#             "caseExact" : False,
+#             "mutability" : "readWrite",
+#             "returned" : "default",
+#             "uniqueness" : "server"
+#         },
+#         {
+#             "name" : "email",
+#             "type" : "string",
+#             "multiValued" : False,
+#             "description" : "Email Address",
+#             "required" : True,
+#             "caseExact" : False,
+#             "mutability" : "readWrite",
+#             "returned" : "default",
+#             "uniqueness" : "None"
+#         },
+#         {
+#             "name" : "full_name",
+#             "type" : "string",
+#             "multiValued" : False,
+#             "description" : "Full Name",
+#             "required" : False,
+#             "caseExact" : True,
+#             "mutability" : "readWrite",
+#             "returned" : "default",
+#             "uniqueness" : "None"
+#         },
+#         {
+#             "name" : "active",
+#             "type" : "boolean",
+#             "multiValued" : False,
+#             "description" : "Active Status",
+#             "required" : False,
+#             "caseExact" : False,
+#             "mutability" : "readWrite",
+#             "returned" : "default",
+#             "uniqueness" : "None"
+#         },
+#         ],
+#         "meta" : {
+#         "resourceType" : "Schema",
+#         "location" :
+#             "/v2/Schemas/urn:ietf:params:scim:schemas:core:2.0:User"
+#         }
+#     }
+#     schemas = [user_schema]
+#     return make_response(
+#         jsonify(
+#             {
+#                 "schemas": ["urn:ietf:params:scim:api:messages:2.0:ListResponse"],
+#                 "totalResults": len(schemas),
+#                 "startIndex": 1,
+#                 "itemsPerPage": len(schemas),
+#                 "Resources": schemas,
+#             }
+#         ),
+#         200,
+#     )
+#     # return jsonify(user_schema, 200)
+
+
+if __name__ == "__main__":
+    app.run(debug=True, host='0.0.0.0')
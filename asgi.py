@@ -0,0 +1,397 @@
+"""
+asyncio SCIM app over AsyncGiteaSCIMWrapper, served by `serve.py --asgi`.
+
+Users and Groups behave as in app.py: filters, PATCH, attributes /
+excludedAttributes and ETags go through the same filters, patch and
+projection modules, and Groups carry their members. What app.py layers on
+top of Gitea is not here: no lookup cache, shadow store (SHADOW_STORE_PATH),
+write journal (JOURNAL_PATH), Bulk or streamed unpaginated listings.
+Deployments that rely on those serve app.py.
+"""
+import time
+from functools import wraps
+
+from quart import Quart, Response, jsonify, abort, make_response, request
+
+from aiogitea import AsyncGiteaSCIMWrapper
+from filters import FilterError
+from gitea import BASE_URL, TOKEN, ConflictError, GiteaUnavailable
+import helpers
+import metrics
+from patch import PatchError
+from projection import Projection
+import serializer
+import settings
+import tracing
+
+if settings.JOURNAL_PATH:  # Acknowledging writes the journal was meant to hold would lose them silently
+    raise RuntimeError("asgi.py has no write journal, serve app.py when JOURNAL_PATH is set")
+
+G = AsyncGiteaSCIMWrapper(BASE_URL, TOKEN)
+if settings.METRICS_ENABLED and G.breaker is not None:
+    metrics.register_stats('gitea_limiter', lambda: {'breaker_state': G.breaker.state, 'breaker_opened': G.breaker.opened, 'rejected': G.breaker.rejected}, {
+        'breaker_state': 'Circuit breaker in front of Gitea: 0 closed, 1 half-open (probing), 2 open.',
+        'breaker_opened': 'Times the breaker opened.',
+        'rejected': 'Gitea calls failed fast by the breaker.',
+    }, kinds={'breaker_opened': 'counter', 'rejected': 'counter'})
+
+app = Quart(__name__)
+
+
+@app.after_serving
+async def close_gitea_client():
+    await G.aclose()
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+@app.before_request
+async def start_request():
+    if settings.METRICS_ENABLED:
+        request.scope["scim.started"] = time.perf_counter()
+        metrics.scim_in_flight.inc()
+    if settings.TRACE_ENABLED:
+        body = await request.get_json(silent=True)
+        units = tracing.payload_units(body, request.args.get("count", type=int))
+        request.scope["scim.trace"] = tracing.begin(request.method, _route(), request.path, units)
+
+
+@app.after_request
+async def record_status(response):
+    request.scope["scim.status"] = response.status_code
+    trace = request.scope.get("scim.trace")
+    if trace is not None and settings.TRACE_SERVER_TIMING:
+        response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+
+@app.teardown_request
+async def finish_request(exc):
+    status = request.scope.pop("scim.status", 500)  # after_request never ran when the view raised
+    started = request.scope.pop("scim.started", None)
+    if started is not None:
+        metrics.scim_in_flight.dec()
+        metrics.scim_requests.observe(time.perf_counter() - started, request.method, _route(), str(status))
+    trace = request.scope.pop("scim.trace", None)
+    if trace is not None and tracing.finish(trace, status) and settings.METRICS_ENABLED:
+        metrics.scim_fanout.inc(request.method, _route())
+
+
+@app.errorhandler(GiteaUnavailable)
+async def service_unavailable(error):
+    """503 with Retry-After while the breaker keeps calls away from Gitea."""
+    response = jsonify(
+        {
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+            "detail": str(error),
+            "status": "503",
+        }
+    )
+    return response, 503, {"Retry-After": str(error.retry_after)}
+
+
+@app.route("/metrics", methods=["GET"])
+async def get_metrics():
+    """Prometheus metrics"""
+    if not settings.METRICS_ENABLED:
+        abort(404)
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def auth_required(func):
+    """Quart decorator to require the presence of a valid Authorization header."""
+
+    @wraps(func)
+    async def check_auth(*args, **kwargs):
+        if request.headers["Authorization"].split("Bearer ")[1] == "123456789":
+            return await func(*args, **kwargs)
+        else:
+            return await make_response(jsonify({"error": "Unauthorized"}), 403)
+
+    return check_auth
+
+
+def _etags(header):
+    return {tag.strip().removeprefix("W/") for tag in header.split(",")} if header else set()
+
+
+async def precondition_failed(kind, resource_id):
+    """412 when If-Match names a version other than the resource's current one."""
+    tags = _etags(request.headers.get("If-Match"))
+    if tags and "*" not in tags:
+        version = await G.current_version(kind, resource_id)
+        if version is None or version.removeprefix("W/") not in tags:
+            return await make_response(
+                jsonify(
+                    {
+                        "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+                        "detail": "Resource version does not match If-Match",
+                        "status": "412",
+                    }
+                ),
+                412,
+            )
+
+
+async def with_etag(response, resource):
+    """Set the ETag header from meta.version, turning If-None-Match hits into 304s."""
+    version = ((resource or {}).get("meta") or {}).get("version")
+    if version:
+        if request.method == "GET" and version.removeprefix("W/") in _etags(request.headers.get("If-None-Match")):
+            return await make_response("", 304, {"ETag": version})
+        response.headers["ETag"] = version
+    return response
+
+
+def parse_paging():
+    """Read SCIM startIndex/count, clamping count to SCIM_MAX_PAGE_SIZE."""
+    start_index = max(request.args.get("startIndex", 1, type=int), 1)
+    count = request.args.get("count", settings.SCIM_MAX_PAGE_SIZE, type=int)
+    count = min(max(count, 0), settings.SCIM_MAX_PAGE_SIZE)
+    return start_index, count
+
+
+def list_response(resources, start_index, total_results):
+    return Response(serializer.list_response(resources, start_index, total_results), mimetype="application/json")
+
+
+def uniqueness_error(detail):
+    return jsonify(
+        {
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+            "scimType": "uniqueness",
+            "detail": detail,
+            "status": "409",
+        }
+    )
+
+
+def invalid_filter(error):
+    return jsonify(
+        {
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+            "scimType": "invalidFilter",
+            "detail": str(error),
+            "status": "400",
+        }
+    )
+
+
+def invalid_patch(error):
+    return jsonify(
+        {
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+            "scimType": error.scim_type,
+            "detail": str(error),
+            "status": "400",
+        }
+    )
+
+
+def not_found(detail):
+    return jsonify(
+        {
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+            "detail": detail,
+            "status": "404",
+        }
+    )
+
+
+def upstream_error(detail):
+    return jsonify(
+        {
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+            "detail": detail,
+            "status": "502",
+        }
+    )
+
+
+@app.route("/scim/v2/Users", methods=["GET"])
+@auth_required
+async def get_users():
+    """Get SCIM Users"""
+    start_index, count = parse_paging()
+    projection = Projection.from_args(request.args)
+
+    if "filter" in request.args:
+        try:
+            users, total_results = await G.scim_filter_users(request.args["filter"], start_index=start_index, count=count)
+        except FilterError as e:
+            return await make_response(invalid_filter(e), 400)
+    else:
+        users, total_results = await G.scim_get_users(start_index=start_index, count=count) or ([], 0)
+
+    return await make_response(list_response([projection.apply(user) for user in users], start_index, total_results), 200)
+
+
+@app.route("/scim/v2/Users/<string:user_id>", methods=["GET"])
+@auth_required
+async def get_user(user_id):
+    """Get SCIM User"""
+    user = await G.scim_get_user(username=user_id)
+    if not user:
+        return await make_response(not_found("User not found"), 404)
+    return await with_etag(jsonify(Projection.from_args(request.args).apply(user)), user)
+
+
+@app.route("/scim/v2/Users", methods=["POST"])
+@auth_required
+async def create_user():
+    """Create SCIM User"""
+    body = await request.get_json()
+    custom_attributes = body.get("urn:ietf:params:scim:schemas:extension:Gitea:2.0:User")
+    userName = body.get("userName")
+
+    try:
+        user = await G.scim_create_user(
+            email=body.get('emails')[0]['value'],
+            full_name=custom_attributes.get("full_name"),
+            username=userName,
+            login_name=userName,
+            source_id=custom_attributes.get("source_id"),
+            visibility=custom_attributes.get("visibility"),
+            password=body.get("password", helpers.generate_password()),
+        )
+    except ConflictError as e:
+        return await make_response(uniqueness_error(str(e)), 409)
+    if not user:
+        return await make_response(upstream_error("Gitea could not create the user"), 502)
+    return await with_etag(await make_response(jsonify(user), 201), user)
+
+
+@app.route("/scim/v2/Users/<string:user_id>", methods=["PATCH"])
+@auth_required
+async def patch_user(user_id):
+    """PATCH SCIM User"""
+    body = await request.get_json()
+    failed = await precondition_failed("user", user_id)
+    if failed:
+        return failed
+    try:
+        current, delta = await G.scim_diff_user(user_id, body["Operations"])
+    except PatchError as e:
+        return await make_response(invalid_patch(e), 400)
+    if current is None:
+        return await make_response(not_found("User not found"), 404)
+    if not delta:  # Nothing changed, Gitea isn't called at all
+        updated_user = current
+    else:
+        updated_user = await G.scim_edit_user(user_id, login_name=user_id, **delta)
+        if not updated_user:
+            return await make_response(upstream_error("Gitea could not update the user"), 502)
+    return await with_etag(await make_response(jsonify(updated_user), 200), updated_user)
+
+
+@app.route("/scim/v2/Users/<string:user_id>", methods=["DELETE"])
+@auth_required
+async def delete_user(user_id):
+    """Delete SCIM User"""
+    failed = await precondition_failed("user", user_id)
+    if failed:
+        return failed
+    await G.delete_user(username=user_id)
+    return await make_response("", 204)
+
+
+@app.route("/scim/v2/Groups", methods=["GET"])
+@auth_required
+async def get_groups():
+    """Get SCIM Groups"""
+    start_index, count = parse_paging()
+    projection = Projection.from_args(request.args)
+
+    if "filter" in request.args:
+        try:
+            groups, total_results = await G.scim_filter_orgs(request.args["filter"], start_index=start_index, count=count, members=projection.needs("members"))
+        except FilterError as e:
+            return await make_response(invalid_filter(e), 400)
+    else:
+        groups, total_results = await G.scim_get_orgs(start_index=start_index, count=count, members=projection.needs("members")) or ([], 0)
+
+    return await make_response(list_response([projection.apply(group) for group in groups], start_index, total_results), 200)
+
+
+@app.route("/scim/v2/Groups/<string:group_id>", methods=["GET"])
+@auth_required
+async def get_group(group_id):
+    """Get SCIM Group"""
+    projection = Projection.from_args(request.args)
+    group = await G.scim_get_org(org=group_id, members=projection.needs("members"))
+    if not group:
+        abort(404)
+    return await with_etag(jsonify(projection.apply(group)), group)
+
+
+@app.route("/scim/v2/Groups", methods=["POST"])
+@auth_required
+async def create_group():
+    """Create SCIM Group"""
+    body = await request.get_json()
+    custom_attributes = body.get('urn:ietf:params:scim:schemas:extension:Gitea:2.0:Group')
+    try:
+        group = await G.scim_create_org(
+            username=body["displayName"],
+            full_name=custom_attributes.get('full_name'),
+            description=body.get('description'),
+            visibility=custom_attributes.get('visibility'),
+        )
+    except ConflictError as e:
+        return await make_response(uniqueness_error(str(e)), 409)
+    if not group:
+        return await make_response(upstream_error("Gitea could not create the group"), 502)
+    return await with_etag(await make_response(jsonify(group), 201), group)
+
+
+@app.route("/scim/v2/Groups/<string:group_id>", methods=["PATCH", "PUT"])
+@auth_required
+async def update_group(group_id):
+    """
+    Update SCIM Group
+
+    Member changes go to Gitea as one batch alongside any field edit, each
+    membership reported back on its own; the upstream semaphore in
+    AsyncGiteaAPI bounds how many calls are in flight.
+    """
+    body = await request.get_json()
+    failed = await precondition_failed("org", group_id)
+    if failed:
+        return failed
+    try:
+        group, delta, add, remove = await G.scim_diff_org(group_id, body["Operations"])
+    except PatchError as e:
+        return await make_response(invalid_patch(e), 400)
+    if group is None:
+        abort(404)
+
+    member_results = []
+    if delta or add or remove:
+        group, member_results = await G.scim_patch_org(group_id, group, delta, add, remove)
+        if group is None:
+            return await make_response(upstream_error("Gitea could not update the group"), 502)
+
+    # A member named for removal that Gitea doesn't know isn't a member either
+    failed = [result for result in member_results if result["status"] >= 400 and not (result["op"] == "remove" and result["status"] == 404)]
+    if failed:
+        return await make_response(
+            jsonify(
+                {
+                    "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+                    "detail": "Some membership changes failed: " + ", ".join(f'{r["op"]} {r["value"]} ({r["status"]})' for r in failed),
+                    "status": "400",
+                    "scimType": "invalidValue",
+                }
+            ),
+            400,
+        )
+
+    if group.get("members") is None:  # Members were changed by name without reading the list, RFC 7644 allows 204 here
+        return await make_response("", 204)
+    return await with_etag(await make_response(jsonify(group), 200), group)
+
+
+if __name__ == "__main__":
+    app.run(host='0.0.0.0')
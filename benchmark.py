@@ -0,0 +1,315 @@
+"""
+Benchmarks for the SCIM serving path.
+
+    python benchmark.py serialize [--items 1000] [--rounds 20]
+    python benchmark.py provision [--users 1000] [--groups 20] [--members 200] [--cycles 3] [--latency 5]
+
+`serialize` times one ListResponse page of Users end to end: building the
+models from Gitea JSON, serializing to SCIM, stamping the ETag and encoding
+the response body. "before" is the old path (kwargs models, stdlib
+sort_keys fingerprint, Flask jsonify), "after" is the current one.
+
+`provision` replays Azure AD provisioning cycles against the app.py routes:
+an initial cycle creating the users and groups and filling the group
+memberships, then delta cycles updating and disabling a share of the users
+and churning memberships. Gitea is the in-repo stand-in (fakegitea.py)
+served on BASE_URL, or whatever BASE_URL points at with --external. Each
+SCIM operation reports its throughput, p50/p99 latency and the Gitea calls
+it made.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+os.environ.setdefault('TOKEN', 'benchmark')
+os.environ.setdefault('BASE_URL', 'http://127.0.0.1:3000/api/v1/')
+os.environ.setdefault('TRACE_SERVER_TIMING', 'true')  # provision reads the Gitea calls per operation from it
+
+from flask import Flask, jsonify
+
+import serializer
+from gitea import GiteaUser, resource_version
+
+
+class _DictUser:
+    """Same attributes as GiteaUser with a per-instance __dict__, the layout before __slots__."""
+
+    def __init__(self, **kwargs) -> None:
+        for name in GiteaUser.__slots__:
+            setattr(self, name, kwargs.get('username' if name == 'id' else name))
+
+
+def _gitea_users(n):
+    return [
+        {
+            'id': i, 'login': f'user{i:05}', 'username': f'user{i:05}', 'login_name': '', 'full_name': f'User Number {i}',
+            'email': f'user{i:05}@example.com', 'avatar_url': f'https://gitea.example.com/avatars/{i}', 'language': 'en-US',
+            'is_admin': False, 'last_login': '2022-07-01T12:00:00Z', 'created': '2022-01-01T12:00:00Z', 'restricted': False,
+            'active': True, 'prohibit_login': False, 'location': 'Remote', 'website': '', 'description': 'Provisioned by SCIM',
+            'visibility': 'public', 'source_id': 0,
+        }
+        for i in range(n)
+    ]
+
+
+def _before(app, users):
+    resources = []
+    for u in users:
+        resource = GiteaUser(**u).serialize()
+        digest = hashlib.sha1(json.dumps(resource, sort_keys=True, default=str).encode()).hexdigest()[:20]
+        resource['meta']['version'] = f'W/"{digest}"'
+        resources.append(resource)
+    with app.app_context():
+        return jsonify({
+            'schemas': [serializer.LIST_RESPONSE_SCHEMA],
+            'totalResults': len(resources),
+            'startIndex': 1,
+            'itemsPerPage': len(resources),
+            'Resources': resources,
+        }).get_data()
+
+
+def _after(app, users):
+    resources = []
+    for u in users:
+        resource = GiteaUser.from_json(u).serialize()
+        resource['meta']['version'] = resource_version(resource)
+        resources.append(resource)
+    return serializer.list_response(resources, 1, len(resources))
+
+
+def _unversioned(body):
+    # The fingerprint encodings differ between the paths, everything else must match
+    body = json.loads(body)
+    for resource in body['Resources']:
+        del resource['meta']['version']
+    return body
+
+
+def _time(fn, rounds):
+    best = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def bench_serialize(args):
+    app = Flask(__name__)
+    users = _gitea_users(args.items)
+    assert _unversioned(_before(app, users)) == _unversioned(_after(app, users)), 'paths disagree'
+
+    before = _time(lambda: _before(app, users), args.rounds)
+    after = _time(lambda: _after(app, users), args.rounds)
+    encoder = 'orjson' if serializer.orjson is not None else 'stdlib json'
+    print(f'{args.items} users per page, best of {args.rounds} rounds, encoder: {encoder}')
+    print(f'  before  {before * 1e6 / args.items:8.2f} us/item  {before * 1e3:8.2f} ms/page')
+    print(f'  after   {after * 1e6 / args.items:8.2f} us/item  {after * 1e3:8.2f} ms/page  ({before / after:.1f}x)')
+
+    plain, slotted = _DictUser(**users[0]), GiteaUser.from_json(users[0])
+    print(f'  model size  __dict__ {sys.getsizeof(plain) + sys.getsizeof(plain.__dict__)} B, __slots__ {sys.getsizeof(slotted)} B')
+
+
+_SERVER_TIMING_CALLS = re.compile(r'gitea;desc="(\d+) calls"')
+
+
+class _Recorder:
+    """Latency and Gitea calls per SCIM operation name."""
+
+    def __init__(self) -> None:
+        self.latencies = defaultdict(list)
+        self.upstream = defaultdict(int)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, name, elapsed, calls, ok):
+        with self._lock:
+            self.latencies[name].append(elapsed)
+            self.upstream[name] += calls
+            if not ok:
+                self.errors[name] += 1
+
+    def report(self, title, wall):
+        total = sum(len(v) for v in self.latencies.values())
+        print(f'{title}: {total} SCIM operations in {wall:.2f} s, {total / wall:.1f} ops/s')
+        print(f'  {"operation":<16} {"count":>7} {"errors":>7} {"ops/s":>9} {"p50 ms":>9} {"p99 ms":>9} {"gitea/op":>9}')
+        for name, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            p50 = latencies[len(latencies) // 2]
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            print(
+                f'  {name:<16} {len(latencies):>7} {self.errors[name]:>7} {len(latencies) / wall:>9.1f} '
+                f'{p50 * 1e3:>9.2f} {p99 * 1e3:>9.2f} {self.upstream[name] / len(latencies):>9.2f}'
+            )
+
+
+class _Provisioner:
+    """Sends SCIM requests shaped like Azure AD's through the Flask test client."""
+
+    def __init__(self, app, recorder) -> None:
+        self.client = app.test_client(use_cookies=False)
+        self.recorder = recorder
+        self.headers = {'Authorization': 'Bearer 123456789'}
+
+    def call(self, name, method, path, ok=(200, 201, 204), **kwargs):
+        started = time.perf_counter()
+        response = self.client.open(path, method=method, headers=self.headers, **kwargs)
+        elapsed = time.perf_counter() - started
+        timing = _SERVER_TIMING_CALLS.search(response.headers.get('Server-Timing', ''))
+        self.recorder.add(name, elapsed, int(timing.group(1)) if timing else 0, response.status_code in ok)
+        return response
+
+    # Azure AD looks a resource up by its matching attribute before deciding to create or update it
+
+    def sync_user(self, user):
+        found = self.call('user.lookup', 'GET', '/scim/v2/Users', query_string={'filter': f'userName eq "{user["userName"]}"'})
+        resources = (found.get_json() or {}).get('Resources') or []
+        if not resources:
+            self.call('user.create', 'POST', '/scim/v2/Users', json=user)
+        else:
+            self.call('user.update', 'PATCH', f'/scim/v2/Users/{resources[0]["id"]}', json={
+                'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'],
+                'Operations': [
+                    {'op': 'Replace', 'path': 'emails[type eq "work"].value', 'value': user['emails'][0]['value']},
+                    {'op': 'Replace', 'path': f'{USER_EXTENSION}:full_name', 'value': user[USER_EXTENSION]['full_name']},
+                ],
+            })
+
+    def disable_user(self, name):
+        self.call('user.disable', 'PATCH', f'/scim/v2/Users/{name}', json={
+            'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'],
+            'Operations': [{'op': 'Replace', 'path': 'active', 'value': 'False'}],
+        })
+
+    def sync_group(self, group, add, remove, batch):
+        found = self.call('group.lookup', 'GET', '/scim/v2/Groups', query_string={
+            'filter': f'displayName eq "{group["displayName"]}"', 'excludedAttributes': 'members',
+        })
+        if not (found.get_json() or {}).get('Resources'):
+            self.call('group.create', 'POST', '/scim/v2/Groups', json=group)
+        for op, names in (('Add', add), ('Remove', remove)):
+            for i in range(0, len(names), batch):
+                self.call('group.members', 'PATCH', f'/scim/v2/Groups/{group["displayName"]}', json={
+                    'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'],
+                    'Operations': [{'op': op, 'path': 'members', 'value': [{'value': name} for name in names[i:i + batch]]}],
+                })
+
+
+USER_EXTENSION = 'urn:ietf:params:scim:schemas:extension:Gitea:2.0:User'
+GROUP_EXTENSION = 'urn:ietf:params:scim:schemas:extension:Gitea:2.0:Group'
+
+
+def _scim_user(i, generation=0):
+    suffix = f'.v{generation}' if generation else ''
+    return {
+        'schemas': ['urn:ietf:params:scim:schemas:core:2.0:User', USER_EXTENSION],
+        'userName': f'bench{i:06}',
+        'active': True,
+        'emails': [{'primary': True, 'type': 'work', 'value': f'bench{i:06}{suffix}@example.com'}],
+        USER_EXTENSION: {'full_name': f'Bench User {i}{suffix}', 'visibility': 'private', 'source_id': 0},
+    }
+
+
+def _scim_group(i):
+    return {
+        'schemas': ['urn:ietf:params:scim:schemas:core:2.0:Group', GROUP_EXTENSION],
+        'displayName': f'bench-group-{i:04}',
+        GROUP_EXTENSION: {'full_name': f'Bench Group {i}', 'visibility': 'private'},
+    }
+
+
+def bench_provision(args):
+    gitea = server = None
+    werkzeug_log = logging.getLogger('werkzeug')
+    werkzeug_level = werkzeug_log.level
+    if not args.external:
+        import fakegitea
+
+        base = urlsplit(os.environ['BASE_URL'])
+        gitea = fakegitea.FakeGitea(args.latency / 1000, args.jitter / 1000, args.error_rate, args.seed)
+        werkzeug_log.setLevel(logging.ERROR)  # An access log line per stand-in call would bury the report
+        gitea, server = fakegitea.serve(base.hostname, base.port or 80, gitea)
+
+    import app as scim  # Reads settings, so only once BASE_URL is being served
+
+    rng = random.Random(args.seed)
+    names = [f'bench{i:06}' for i in range(args.users)]
+    memberships = {i: sorted(rng.sample(names, min(args.members, len(names)))) for i in range(args.groups)}
+    print(f'{args.users} users, {args.groups} groups of {args.members} members, {args.workers} workers, '
+          f'Gitea {"at " + os.environ["BASE_URL"] if args.external else f"stand-in with {args.latency} ms latency"}')
+
+    def run(title, jobs):
+        recorder = _Recorder()
+        provisioner = _Provisioner(scim.app, recorder)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            for future in [pool.submit(job, provisioner) for job in jobs]:
+                future.result()
+        recorder.report(title, time.perf_counter() - started)
+        if gitea is not None:
+            print(f'  stand-in Gitea answered {sum(gitea.calls.values())} calls')
+            gitea.reset_calls()
+
+    try:
+        run('initial cycle, users', [lambda p, i=i: p.sync_user(_scim_user(i)) for i in range(args.users)])
+        run('initial cycle, groups', [
+            lambda p, i=i: p.sync_group(_scim_group(i), memberships[i], [], args.batch) for i in range(args.groups)
+        ])
+        for cycle in range(1, args.cycles + 1):
+            changed = rng.sample(range(args.users), int(args.users * args.churn))
+            disabled = rng.sample(names, int(args.users * args.churn / 5))
+            jobs = [lambda p, i=i: p.sync_user(_scim_user(i, cycle)) for i in changed]
+            jobs += [lambda p, name=name: p.disable_user(name) for name in disabled]
+            for i in range(args.groups):
+                leaving = rng.sample(memberships[i], int(len(memberships[i]) * args.churn))
+                joining = [n for n in rng.sample(names, int(len(memberships[i]) * args.churn)) if n not in memberships[i]]
+                memberships[i] = sorted(set(memberships[i]) - set(leaving) | set(joining))
+                jobs.append(lambda p, i=i, joining=joining, leaving=leaving: p.sync_group(_scim_group(i), joining, leaving, args.batch))
+            run(f'delta cycle {cycle}', jobs)
+    finally:
+        if server is not None:
+            server.shutdown()
+            werkzeug_log.setLevel(werkzeug_level)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serialize = commands.add_parser('serialize', help='per-item cost of building a Users ListResponse')
+    serialize.add_argument('--items', type=int, default=1000)
+    serialize.add_argument('--rounds', type=int, default=20)
+    serialize.set_defaults(func=bench_serialize)
+
+    provision = commands.add_parser('provision', help='Azure AD provisioning cycles against app.py and a stand-in Gitea')
+    provision.add_argument('--users', type=int, default=1000)
+    provision.add_argument('--groups', type=int, default=20)
+    provision.add_argument('--members', type=int, default=200, help='members per group')
+    provision.add_argument('--batch', type=int, default=10, help='members per group PATCH')
+    provision.add_argument('--cycles', type=int, default=3, help='delta cycles after the initial one')
+    provision.add_argument('--churn', type=float, default=0.05, help='share of users and memberships changed per delta cycle')
+    provision.add_argument('--workers', type=int, default=8, help='concurrent SCIM requests')
+    provision.add_argument('--latency', type=float, default=5, help='stand-in Gitea latency, milliseconds')
+    provision.add_argument('--jitter', type=float, default=1, help='milliseconds')
+    provision.add_argument('--error-rate', type=float, default=0, help='share of stand-in Gitea calls answering 503')
+    provision.add_argument('--seed', type=int, default=1)
+    provision.add_argument('--external', action='store_true', help='benchmark against the Gitea at BASE_URL instead of the stand-in')
+    provision.set_defaults(func=bench_provision)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import settings
+import tracing
+
+BULK_ID_RE = re.compile(r'bulkId:([^/"\s]+)')
+
+
+def _find_bulk_refs(value, refs):
+    if isinstance(value, str):
+        refs.update(BULK_ID_RE.findall(value))
+    elif isinstance(value, dict):
+        for v in value.values():
+            _find_bulk_refs(v, refs)
+    elif isinstance(value, list):
+        for v in value:
+            _find_bulk_refs(v, refs)
+    return refs
+
+
+def _resolve_bulk_refs(value, resolved):
+    if isinstance(value, str):
+        return BULK_ID_RE.sub(lambda m: resolved[m.group(1)], value)
+    if isinstance(value, dict):
+        return {k: _resolve_bulk_refs(v, resolved) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_resolve_bulk_refs(v, resolved) for v in value]
+    return value
+
+
+def bulk_error(status, detail, scim_type=None):
+    error = {
+        "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+        "detail": detail,
+        "status": str(status),
+    }
+    if scim_type:
+        error["scimType"] = scim_type
+    return error
+
+
+class BulkOperation:
+    def __init__(self, index, method, path, bulk_id=None, data=None, version=None) -> None:
+        self.index = index
+        self.method = method.upper()
+        self.path = path
+        self.bulk_id = bulk_id
+        self.data = data
+        self.version = version
+        self.depends_on = set()  # Indexes of operations that must finish first
+        self.result = None
+
+    @property
+    def resource_path(self):
+        # "/Users/alice" and "/Users/bulkId:x" identify the resource an operation touches
+        return self.path.rstrip('/')
+
+
+class BulkProcessor:
+    """
+    Executes the Operations of a SCIM BulkRequest (RFC 7644 section 3.7).
+
+    Operations run concurrently on a bounded pool as soon as the operations
+    they reference by bulkId, and any earlier operation on the same resource,
+    have completed. `dispatch(method, path, data, version)` performs one
+    operation, `version` being the If-Match it is conditional on, and
+    returns (status, body, location).
+    """
+
+    def __init__(self, dispatch, max_workers=None) -> None:
+        self.dispatch = dispatch
+        self.max_workers = max_workers or settings.BULK_MAX_WORKERS
+
+    def parse(self, operations):
+        parsed = []
+        by_bulk_id = {}
+        last_on_resource = {}
+        for index, op in enumerate(operations):
+            operation = BulkOperation(index, op.get('method', ''), op.get('path', ''), op.get('bulkId'), op.get('data'), op.get('version'))
+            if operation.bulk_id:
+                by_bulk_id[operation.bulk_id] = index
+            parsed.append(operation)
+        for operation in parsed:
+            for ref in _find_bulk_refs([operation.path, operation.data], set()):
+                if ref not in by_bulk_id:
+                    operation.result = self._result(operation, 409, bulk_error(409, f"Unknown bulkId reference '{ref}'", 'invalidValue'))
+                elif by_bulk_id[ref] != operation.index:
+                    operation.depends_on.add(by_bulk_id[ref])
+            previous = last_on_resource.get(operation.resource_path)
+            if previous is not None and operation.method != 'POST':
+                operation.depends_on.add(previous)
+            last_on_resource[operation.resource_path] = operation.index
+        return parsed
+
+    def _result(self, operation, status, body, location=None):
+        result = {"method": operation.method, "status": str(status)}
+        if operation.bulk_id:
+            result["bulkId"] = operation.bulk_id
+        if operation.version:
+            result["version"] = operation.version
+        if location:
+            result["location"] = location
+        if status >= 400:
+            result["response"] = body
+        return result
+
+    def _run(self, operation, resolved):
+        try:
+            path = _resolve_bulk_refs(operation.path, resolved)
+            data = _resolve_bulk_refs(operation.data, resolved)
+        except KeyError as e:
+            return 409, bulk_error(409, f"bulkId {e} did not produce a resource", 'invalidValue'), None
+        status, body, location = self.dispatch(operation.method, path, data, operation.version)
+        return status, body, location
+
+    def process(self, operations, fail_on_errors=None):
+        parsed = self.parse(operations)
+        resolved = {}
+        lock = threading.Lock()
+        errors = sum(1 for op in parsed if op.result is not None)
+        pending = {op.index: op for op in parsed if op.result is None}
+        running = {}
+
+        def ready(op):
+            return all(parsed[dep].result is not None for dep in op.depends_on)
+
+        def failed_dependency(op):
+            return any(int(parsed[dep].result['status']) >= 400 for dep in op.depends_on)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                stop = fail_on_errors and errors >= fail_on_errors
+                if not stop:
+                    for index, op in list(pending.items()):
+                        if len(running) >= self.max_workers:
+                            break  # Submit lazily so failOnErrors can stop queued work
+                        if not ready(op):
+                            continue
+                        del pending[index]
+                        if failed_dependency(op):
+                            op.result = self._result(op, 409, bulk_error(409, 'A referenced operation failed', 'invalidValue'))
+                            errors += 1
+                            continue
+                        with lock:
+                            snapshot = dict(resolved)
+                        running[pool.submit(tracing.bind(self._run), op, snapshot)] = op
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    op = running.pop(future)
+                    try:
+                        status, body, location = future.result()
+                    except Exception as e:
+                        status, body, location = 500, bulk_error(500, str(e)), None
+                    if status >= 400:
+                        errors += 1
+                    elif op.bulk_id and isinstance(body, dict) and body.get('id'):
+                        with lock:
+                            resolved[op.bulk_id] = body['id']
+                    op.result = self._result(op, status, body, location)
+
+        if not (fail_on_errors and errors >= fail_on_errors):
+            for op in pending.values():  # Left over only when references are circular
+                op.result = self._result(op, 409, bulk_error(409, 'Circular bulkId reference', 'invalidValue'))
+
+        return {
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:BulkResponse"],
+            "Operations": [op.result for op in parsed if op.result is not None],
+        }
@@ -0,0 +1,276 @@
+import json
+import os
+import pickle
+import sqlite3
+import stat
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import settings
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after `ttl` seconds.
+
+    A ttl or maxsize of 0 disables caching entirely.
+    """
+
+    def __init__(self, maxsize=None, ttl=None) -> None:
+        self.maxsize = settings.CACHE_MAXSIZE if maxsize is None else maxsize
+        self.ttl = settings.CACHE_TTL if ttl is None else ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+    def index(self, name: str):
+        """A dict for long-lived lookups next to the cache, e.g. team IDs per org. Private to this process."""
+        return {}
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    expires REAL NOT NULL,
+    value BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires);
+CREATE TABLE IF NOT EXISTS indexes (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+# A Response without its .request, which carries the Authorization header
+_StoredResponse = namedtuple('_StoredResponse', 'status_code headers content url encoding')
+
+
+def _encode(value):
+    if isinstance(value, requests.Response):
+        value = _StoredResponse(value.status_code, dict(value.headers), value.content, value.url, value.encoding)
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def _decode(blob):
+    value = pickle.loads(blob)
+    if isinstance(value, _StoredResponse):
+        response = requests.Response()
+        response.status_code = value.status_code
+        response.headers = CaseInsensitiveDict(value.headers)
+        response._content = value.content
+        response.url = value.url
+        response.encoding = value.encoding
+        return response
+    return value
+
+
+class SharedCache:
+    """
+    TTLCache counterpart kept in a SQLite file, shared by every process that opens it.
+
+    Meant for the pre-fork server: all workers read and write the same
+    entries, so one worker's lookup warms the others and a delete or
+    overwrite is seen by every worker on its next read, with no per-process
+    copy to go stale. Entries past `ttl` are skipped on read and purged, with
+    the oldest beyond `maxsize`, every PURGE_EVERY writes. Values are pickled,
+    so the file is created with mode 0600 and an existing one is only opened
+    if this user owns it and nobody else can read or write it.
+    """
+
+    PURGE_EVERY = 256
+
+    def __init__(self, path=None, maxsize=None, ttl=None) -> None:
+        self.path = path or settings.SHARED_CACHE_PATH
+        self.maxsize = settings.CACHE_MAXSIZE if maxsize is None else maxsize
+        self.ttl = settings.CACHE_TTL if ttl is None else ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._check_file()
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+
+    def _check_file(self):
+        """Create the file 0600, or raise PermissionError if it (or its WAL) could hold another user's pickles."""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            files = [(self.path, os.fstat(fd))]
+        finally:
+            os.close(fd)
+        for suffix in ('-wal', '-shm'):
+            try:
+                files.append((self.path + suffix, os.lstat(self.path + suffix)))
+            except FileNotFoundError:
+                pass
+        for path, st in files:
+            if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+                raise PermissionError(f'{path} must be a regular file owned by uid {os.getuid()} with mode 0600, '
+                                      f'found uid {st.st_uid} mode {stat.filemode(st.st_mode)}')
+
+    def _conn(self):
+        # Connections don't survive fork(), a worker opens its own on first use
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')  # Losing the tail of a cache on a crash is harmless
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @staticmethod
+    def _key(key):
+        return json.dumps(key)
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key, default=None):
+        row = self._conn().execute('SELECT value FROM entries WHERE key = ? AND expires > ?', (self._key(key), time.time())).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return _decode(row[0]) if row is not None else default
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        with self._conn() as conn:
+            conn.execute('INSERT OR REPLACE INTO entries (key, expires, value) VALUES (?, ?, ?)', (self._key(key), time.time() + self.ttl, _encode(value)))
+        with self._lock:
+            self._writes += 1
+            purge = self._writes % self.PURGE_EVERY == 0
+        if purge:
+            self._purge()
+
+    def _purge(self):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM entries WHERE expires <= ?', (time.time(),))
+            over = conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0] - self.maxsize
+            if over > 0:
+                conn.execute('DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY expires LIMIT ?)', (over,))
+                with self._lock:
+                    self.evictions += over
+
+    def delete(self, key):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM entries WHERE key = ?', (self._key(key),))
+
+    def clear(self):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM entries')
+            conn.execute('DELETE FROM indexes')
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM entries WHERE expires > ?', (time.time(),)).fetchone()[0]
+
+    def stats(self):
+        """Like TTLCache.stats(); size counts every worker's entries, hits and misses only this process's lookups."""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        """Close this thread's connection, e.g. before fork()."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def index(self, name: str):
+        """A dict-like for long-lived lookups next to the cache, shared like its entries and never expired."""
+        return SharedIndex(self, name)
+
+
+class SharedIndex:
+    """get/[]=/pop over one named table of a SharedCache. Values round-trip through JSON."""
+
+    def __init__(self, cache, name: str) -> None:
+        self.cache = cache
+        self.name = name
+
+    def get(self, key, default=None):
+        row = self.cache._conn().execute('SELECT value FROM indexes WHERE name = ? AND key = ?', (self.name, key)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def __setitem__(self, key, value):
+        with self.cache._conn() as conn:
+            conn.execute('INSERT OR REPLACE INTO indexes (name, key, value) VALUES (?, ?, ?)', (self.name, key, json.dumps(value)))
+
+    def pop(self, key, default=None):
+        with self.cache._conn() as conn:
+            row = conn.execute('SELECT value FROM indexes WHERE name = ? AND key = ?', (self.name, key)).fetchone()
+            conn.execute('DELETE FROM indexes WHERE name = ? AND key = ?', (self.name, key))
+        return json.loads(row[0]) if row is not None else default
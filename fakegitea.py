@@ -0,0 +1,301 @@
+"""
+In-memory stand-in for the parts of the Gitea API that GiteaAPI uses.
+
+    python fakegitea.py [--port 3000] [--latency 20] [--jitter 5] [--error-rate 0.01]
+
+Meant for load tests and benchmarks, not correctness: state lives in
+memory, any `token` is accepted and only the fields the connector reads
+are returned. Latency is added to every call, and `error_rate` of the
+calls answer 503 before touching any state.
+"""
+import argparse
+import itertools
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from flask import Flask, jsonify, make_response, request
+from werkzeug.serving import make_server
+
+MAX_PAGE_SIZE = 50  # Gitea's [api] MAX_RESPONSE_ITEMS
+DEFAULT_PAGE_SIZE = 30  # Gitea's [api] DEFAULT_PAGING_NUM
+
+
+class FakeGitea:
+    """Users, orgs and teams keyed by lowercase name, like Gitea's case-insensitive lookups."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None) -> None:
+        self.latency = latency  # Seconds added to every call
+        self.jitter = jitter  # Seconds, uniform +/- around latency
+        self.error_rate = error_rate
+        self.users = {}
+        self.orgs = {}
+        self.teams = {}
+        self.calls = Counter()  # (method, route) -> count
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+    def next_id(self):
+        return next(self._ids)
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    # Payloads
+
+    def user_json(self, user):
+        return dict(user)
+
+    def org_json(self, org):
+        return dict(org)
+
+    def team_json(self, team):
+        return {k: v for k, v in team.items() if k != 'members'}
+
+    def org_members(self, org_name):
+        names = {name for team in self.teams.values() if team['org'] == org_name for name in team['members']}
+        return [self.users[name] for name in sorted(names) if name in self.users]
+
+
+def _now():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _error(status, message):
+    return make_response(jsonify({'message': message, 'url': request.url}), status)
+
+
+def _page(items, wrapped=False):
+    """Slice a listing the way Gitea does, with the total in X-Total-Count."""
+    page = max(request.args.get('page', 1, type=int), 1)
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    window = items[(page - 1) * limit:page * limit]
+    response = jsonify({'ok': True, 'data': window} if wrapped else window)
+    response.headers['X-Total-Count'] = str(len(items))
+    return response
+
+
+def create_app(gitea=None):
+    """Flask app serving `gitea` (a FakeGitea) under /api/v1."""
+    gitea = gitea or FakeGitea()
+    app = Flask(__name__)
+    app.config['gitea'] = gitea
+
+    @app.before_request
+    def inject():
+        if not request.headers.get('Authorization', '').startswith('token '):
+            return _error(401, 'token is required')
+        with gitea._lock:
+            gitea.calls[(request.method, request.url_rule.rule if request.url_rule else request.path)] += 1
+            delay = gitea.latency + gitea._random.uniform(-gitea.jitter, gitea.jitter) if gitea.latency or gitea.jitter else 0
+            fail = gitea.error_rate and gitea._random.random() < gitea.error_rate
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            return _error(503, 'injected error')
+        return None
+
+    # Users
+
+    @app.route('/api/v1/users/<name>', methods=['GET'])
+    def get_user(name):
+        user = gitea.users.get(name.lower())
+        if user is None:
+            return _error(404, 'user does not exist')
+        return jsonify(gitea.user_json(user))
+
+    @app.route('/api/v1/users/search', methods=['GET'])
+    def search_users():
+        q = request.args.get('q', '').lower()
+        with gitea._lock:
+            found = [
+                gitea.user_json(u) for u in sorted(gitea.users.values(), key=lambda u: u['id'])
+                if q in u['username'].lower() or q in (u['full_name'] or '').lower()  # Like Gitea: login and full name, not email
+            ]
+        return _page(found, wrapped=True)
+
+    @app.route('/api/v1/admin/users', methods=['GET'])
+    def list_users():
+        with gitea._lock:
+            users = [gitea.user_json(u) for u in sorted(gitea.users.values(), key=lambda u: u['id'])]
+        return _page(users)
+
+    @app.route('/api/v1/admin/users', methods=['POST'])
+    def create_user():
+        body = request.get_json(force=True)
+        username, email = body.get('username'), body.get('email')
+        if not username or not email:
+            return _error(422, 'username and email are required')
+        with gitea._lock:
+            if username.lower() in gitea.users or username.lower() in gitea.orgs:
+                return _error(422, f'user already exists [name: {username}]')
+            user = {
+                'id': gitea.next_id(), 'login': username, 'username': username, 'login_name': body.get('login_name') or '',
+                'source_id': body.get('source_id') or 0, 'full_name': body.get('full_name') or '', 'email': email,
+                'avatar_url': '', 'language': '', 'is_admin': False, 'last_login': '0001-01-01T00:00:00Z',
+                'created': _now(), 'restricted': False, 'active': True, 'prohibit_login': False, 'location': '',
+                'website': '', 'description': '', 'visibility': body.get('visibility') or 'public',
+            }
+            gitea.users[username.lower()] = user
+        return make_response(jsonify(gitea.user_json(user)), 201)
+
+    @app.route('/api/v1/admin/users/<name>', methods=['PATCH'])
+    def edit_user(name):
+        body = request.get_json(force=True)
+        with gitea._lock:
+            user = gitea.users.get(name.lower())
+            if user is None:
+                return _error(404, 'user does not exist')
+            for field in ('email', 'full_name', 'description', 'active', 'location', 'website', 'visibility', 'prohibit_login', 'restricted', 'admin'):
+                if body.get(field) is not None:
+                    user['is_admin' if field == 'admin' else field] = body[field]
+            return jsonify(gitea.user_json(user))
+
+    @app.route('/api/v1/admin/users/<name>', methods=['DELETE'])
+    def delete_user(name):
+        with gitea._lock:
+            if gitea.users.pop(name.lower(), None) is None:
+                return _error(404, 'user does not exist')
+            for team in gitea.teams.values():
+                team['members'].discard(name.lower())
+        return make_response('', 204)
+
+    # Orgs
+
+    @app.route('/api/v1/orgs', methods=['GET'])
+    def list_orgs():
+        with gitea._lock:
+            orgs = [gitea.org_json(o) for o in sorted(gitea.orgs.values(), key=lambda o: o['id'])]
+        return _page(orgs)
+
+    @app.route('/api/v1/orgs', methods=['POST'])
+    def create_org():
+        body = request.get_json(force=True)
+        username = body.get('username')
+        if not username:
+            return _error(422, 'username is required')
+        with gitea._lock:
+            if username.lower() in gitea.orgs or username.lower() in gitea.users:
+                return _error(422, f'user already exists [name: {username}]')
+            org = {
+                'id': gitea.next_id(), 'username': username, 'full_name': body.get('full_name') or '', 'avatar_url': '',
+                'description': body.get('description') or '', 'website': body.get('website') or '',
+                'location': body.get('location') or '', 'visibility': body.get('visibility') or 'public',
+                'repo_admin_change_team_access': False,
+            }
+            gitea.orgs[username.lower()] = org
+            # Gitea gives every new org an Owners team holding its creator. The fake doesn't
+            # know which user a token belongs to, so its Owners team starts out empty.
+            team_id = gitea.next_id()
+            gitea.teams[team_id] = {'id': team_id, 'name': 'Owners', 'description': '', 'org': username.lower(), 'permission': 'owner', 'members': set()}
+        return make_response(jsonify(gitea.org_json(org)), 201)
+
+    @app.route('/api/v1/orgs/<org>', methods=['GET'])
+    def get_org(org):
+        found = gitea.orgs.get(org.lower())
+        if found is None:
+            return _error(404, 'org does not exist')
+        return jsonify(gitea.org_json(found))
+
+    @app.route('/api/v1/orgs/<org>', methods=['PATCH'])
+    def edit_org(org):
+        body = request.get_json(force=True)
+        with gitea._lock:
+            found = gitea.orgs.get(org.lower())
+            if found is None:
+                return _error(404, 'org does not exist')
+            for field in ('full_name', 'description', 'website', 'location', 'visibility'):
+                if body.get(field) is not None:
+                    found[field] = body[field]
+            return jsonify(gitea.org_json(found))
+
+    @app.route('/api/v1/orgs/<org>/members', methods=['GET'])
+    def list_org_members(org):
+        with gitea._lock:
+            if org.lower() not in gitea.orgs:
+                return _error(404, 'org does not exist')
+            members = [gitea.user_json(u) for u in gitea.org_members(org.lower())]
+        return _page(members)
+
+    # Teams
+
+    @app.route('/api/v1/orgs/<org>/teams', methods=['GET'])
+    def list_teams(org):
+        with gitea._lock:
+            if org.lower() not in gitea.orgs:
+                return _error(404, 'org does not exist')
+            teams = [gitea.team_json(t) for t in gitea.teams.values() if t['org'] == org.lower()]
+        return _page(teams)
+
+    @app.route('/api/v1/orgs/<org>/teams', methods=['POST'])
+    def create_team(org):
+        body = request.get_json(force=True)
+        with gitea._lock:
+            if org.lower() not in gitea.orgs:
+                return _error(404, 'org does not exist')
+            if any(t['org'] == org.lower() and t['name'].lower() == str(body.get('name', '')).lower() for t in gitea.teams.values()):
+                return _error(422, f'team already exists [name: {body.get("name")}]')
+            team_id = gitea.next_id()
+            team = {
+                'id': team_id, 'name': body.get('name'), 'description': body.get('description') or '', 'org': org.lower(),
+                'permission': body.get('permission') or 'read', 'units': body.get('units') or [],
+                'includes_all_repositories': bool(body.get('includes_all_repositories')),
+                'can_create_org_repo': bool(body.get('can_create_org_repo')), 'members': set(),
+            }
+            gitea.teams[team_id] = team
+        return make_response(jsonify(gitea.team_json(team)), 201)
+
+    @app.route('/api/v1/teams/<int:team_id>/members', methods=['GET'])
+    def list_team_members(team_id):
+        with gitea._lock:
+            team = gitea.teams.get(team_id)
+            if team is None:
+                return _error(404, 'team does not exist')
+            members = [gitea.user_json(gitea.users[name]) for name in sorted(team['members']) if name in gitea.users]
+        return _page(members)
+
+    @app.route('/api/v1/teams/<int:team_id>/members/<name>', methods=['PUT', 'DELETE'])
+    def team_member(team_id, name):
+        with gitea._lock:
+            team = gitea.teams.get(team_id)
+            if team is None or name.lower() not in gitea.users:
+                return _error(404, 'team or user does not exist')
+            if request.method == 'PUT':
+                team['members'].add(name.lower())
+            else:
+                team['members'].discard(name.lower())
+        return make_response('', 204)
+
+    return app
+
+
+def serve(host='127.0.0.1', port=3000, gitea=None):
+    """Serve a FakeGitea from a daemon thread. Returns (gitea, server); server.shutdown() stops it."""
+    gitea = gitea or FakeGitea()
+    server = make_server(host, port, create_app(gitea), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return gitea, server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3000)
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to every call')
+    parser.add_argument('--jitter', type=float, default=0, help='milliseconds, uniform +/- around --latency')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of calls answering 503, 0..1')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    gitea = FakeGitea(args.latency / 1000, args.jitter / 1000, args.error_rate, args.seed)
+    print(f'Fake Gitea on http://{args.host}:{args.port}/api/v1/')
+    make_server(args.host, args.port, create_app(gitea), threaded=True).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
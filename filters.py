@@ -0,0 +1,348 @@
+import json
+import re
+
+COMPARE_OPS = frozenset(['eq', 'ne', 'co', 'sw', 'ew', 'gt', 'lt', 'ge', 'le'])
+
+TOKEN_RE = re.compile(r'''\s*(?:
+    (?P<lparen>\() |
+    (?P<rparen>\)) |
+    (?P<lbracket>\[) |
+    (?P<rbracket>\]) |
+    (?P<string>"(?:[^"\\]|\\.)*") |
+    (?P<word>[^\s()\[\]"]+)
+)''', re.X)
+
+
+class FilterError(ValueError):
+    """Raised for filters that can't be parsed; maps to SCIM 400 invalidFilter."""
+
+
+class Compare:
+    def __init__(self, attr, op, value) -> None:
+        self.attr = attr
+        self.op = op
+        self.value = value
+
+    def __repr__(self):
+        return f'Compare({self.attr!r}, {self.op!r}, {self.value!r})'
+
+
+class Present:
+    def __init__(self, attr) -> None:
+        self.attr = attr
+
+    def __repr__(self):
+        return f'Present({self.attr!r})'
+
+
+class And:
+    def __init__(self, left, right) -> None:
+        self.left = left
+        self.right = right
+
+    def __repr__(self):
+        return f'And({self.left!r}, {self.right!r})'
+
+
+class Or:
+    def __init__(self, left, right) -> None:
+        self.left = left
+        self.right = right
+
+    def __repr__(self):
+        return f'Or({self.left!r}, {self.right!r})'
+
+
+class Not:
+    def __init__(self, expr) -> None:
+        self.expr = expr
+
+    def __repr__(self):
+        return f'Not({self.expr!r})'
+
+
+class ValuePath:
+    """attr[filter] with an optional .subAttr, e.g. emails[type eq "work"].value"""
+
+    def __init__(self, attr, filter, sub_attr=None) -> None:
+        self.attr = attr
+        self.filter = filter
+        self.sub_attr = sub_attr
+
+    def __repr__(self):
+        return f'ValuePath({self.attr!r}, {self.filter!r}, {self.sub_attr!r})'
+
+
+def tokenize(text: str):
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        m = TOKEN_RE.match(text, pos)
+        if not m or m.end() == pos:
+            raise FilterError(f'Unexpected character at position {pos}')
+        pos = m.end()
+        kind = m.lastgroup
+        tokens.append((kind, m.group(kind)))
+    return tokens
+
+
+class _Parser:
+    def __init__(self, text: str) -> None:
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise FilterError('Unexpected end of filter')
+        self.pos += 1
+        return token
+
+    def expect(self, kind):
+        token = self.next()
+        if token[0] != kind:
+            raise FilterError(f'Expected {kind}, got {token[1]!r}')
+        return token
+
+    def keyword(self, *words):
+        kind, value = self.peek()
+        return kind == 'word' and value.lower() in words
+
+    def parse(self):
+        node = self.parse_or()
+        if self.peek()[0] is not None:
+            raise FilterError(f'Unexpected token {self.peek()[1]!r}')
+        return node
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.keyword('or'):
+            self.next()
+            node = Or(node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_unary()
+        while self.keyword('and'):
+            self.next()
+            node = And(node, self.parse_unary())
+        return node
+
+    def parse_unary(self):
+        if self.keyword('not'):
+            self.next()
+            return Not(self.parse_unary())
+        if self.peek()[0] == 'lparen':
+            self.next()
+            node = self.parse_or()
+            self.expect('rparen')
+            return node
+        return self.parse_attr_expr()
+
+    def parse_attr_expr(self):
+        kind, attr = self.next()
+        if kind != 'word' or attr.lower() in ('and', 'or', 'not'):
+            raise FilterError(f'Expected attribute, got {attr!r}')
+        if self.peek()[0] == 'lbracket':
+            self.next()
+            inner = self.parse_or()
+            self.expect('rbracket')
+            sub_attr = None
+            kind, value = self.peek()
+            if kind == 'word' and value.startswith('.'):
+                self.next()
+                sub_attr = value[1:]
+            return ValuePath(attr, inner, sub_attr)
+        kind, op = self.next()
+        op = op.lower() if kind == 'word' else op
+        if op == 'pr':
+            return Present(attr)
+        if op not in COMPARE_OPS:
+            raise FilterError(f'Unknown operator {op!r}')
+        return Compare(attr, op, self.parse_value())
+
+    def parse_value(self):
+        kind, raw = self.next()
+        if kind == 'string':
+            return json.loads(raw)
+        if kind == 'word':
+            lowered = raw.lower()
+            if lowered in ('true', 'false'):
+                return lowered == 'true'
+            if lowered == 'null':
+                return None
+            try:
+                return json.loads(raw)
+            except ValueError:
+                pass
+        raise FilterError(f'Invalid comparison value {raw!r}')
+
+
+def parse(text: str):
+    """Compile a SCIM filter expression (RFC 7644 section 3.4.2.2) into an AST."""
+    if not text or not text.strip():
+        raise FilterError('Empty filter')
+    return _Parser(text).parse()
+
+
+# Local evaluation over serialized SCIM resources
+
+def _lookup_key(mapping: dict, name: str):
+    lowered = name.lower()
+    for key in mapping:
+        if key.lower() == lowered:
+            return key
+    return None
+
+
+def resolve(resource: dict, path: str):
+    """Return every value at `path` in a resource, flattening multi-valued attributes."""
+    if path.lower().startswith('urn:'):
+        for key in sorted(resource, key=len, reverse=True):
+            if path.lower().startswith(key.lower() + ':'):
+                return resolve(resource[key] or {}, path[len(key) + 1:])
+        key = _lookup_key(resource, path)
+        return [] if key is None else _flatten(resource[key])
+    values = [resource]
+    for part in path.split('.'):
+        next_values = []
+        for value in values:
+            if isinstance(value, dict):
+                key = _lookup_key(value, part)
+                if key is not None:
+                    next_values.extend(_flatten(value[key]))
+        values = next_values
+    return values
+
+
+def _flatten(value):
+    if isinstance(value, list):
+        return list(value)
+    return [value]
+
+
+def _present(value):
+    return value not in (None, '', [], {})
+
+
+def _compare(actual, op, expected):
+    if isinstance(actual, dict):  # Multi-valued complex attribute compared directly, e.g. emails co "x"
+        actual = actual.get('value')
+    if actual is None:
+        return op == 'ne' and expected is not None
+    if isinstance(actual, str) and isinstance(expected, str):
+        actual, expected = actual.lower(), expected.lower()
+    if op == 'eq':
+        return actual == expected
+    if op == 'ne':
+        return actual != expected
+    if op in ('co', 'sw', 'ew'):
+        if not isinstance(actual, str) or not isinstance(expected, str):
+            return False
+        return (expected in actual) if op == 'co' else actual.startswith(expected) if op == 'sw' else actual.endswith(expected)
+    try:
+        if op == 'gt':
+            return actual > expected
+        if op == 'ge':
+            return actual >= expected
+        if op == 'lt':
+            return actual < expected
+        if op == 'le':
+            return actual <= expected
+    except TypeError:
+        return False
+    return False
+
+
+def matches(node, resource: dict) -> bool:
+    if isinstance(node, And):
+        return matches(node.left, resource) and matches(node.right, resource)
+    if isinstance(node, Or):
+        return matches(node.left, resource) or matches(node.right, resource)
+    if isinstance(node, Not):
+        return not matches(node.expr, resource)
+    if isinstance(node, Present):
+        return any(_present(v) for v in resolve(resource, node.attr))
+    if isinstance(node, ValuePath):
+        return any(isinstance(v, dict) and matches(node.filter, v) for v in resolve(resource, node.attr))
+    values = resolve(resource, node.attr)
+    if node.op == 'ne':
+        return all(_compare(v, 'ne', node.value) for v in values) if values else node.value is not None
+    return any(_compare(v, node.op, node.value) for v in values)
+
+
+def references(node, attr: str) -> bool:
+    """True if the filter mentions `attr` (or one of its sub-attributes) anywhere."""
+    attr = attr.lower()
+    if isinstance(node, (And, Or)):
+        return references(node.left, attr) or references(node.right, attr)
+    if isinstance(node, Not):
+        return references(node.expr, attr)
+    name = node.attr.lower()
+    return name == attr or name.startswith(attr + '.')
+
+
+# Query planning: pick the cheapest Gitea call whose results are a superset of the matches
+
+class Plan:
+    """
+    How to fetch candidates for a filter.
+
+    source is 'lookup' (direct get by name for each of `values`), 'search'
+    (Gitea keyword search for each of `values`) or 'scan' (walk the whole
+    listing). The full filter is always re-checked locally on the candidates.
+    """
+    COST = {'lookup': 0, 'search': 1, 'scan': 2}
+
+    def __init__(self, source, values=()) -> None:
+        self.source = source
+        self.values = list(values)
+
+    def __repr__(self):
+        return f'Plan({self.source!r}, {self.values!r})'
+
+
+SCAN = Plan('scan')
+
+USER_LOOKUP_ATTRS = frozenset(['id', 'username'])
+# Gitea's users/search matches login and full name only, so email filters are scanned
+USER_SEARCH_ATTRS = frozenset([
+    'username',
+    'urn:ietf:params:scim:schemas:extension:gitea:2.0:user:full_name',
+])
+GROUP_LOOKUP_ATTRS = frozenset(['id', 'displayname'])
+
+
+def _plan(node, lookup_attrs, search_attrs):
+    if isinstance(node, Compare) and isinstance(node.value, str) and node.value:
+        attr = node.attr.lower()
+        if node.op == 'eq' and attr in lookup_attrs:
+            return Plan('lookup', [node.value])
+        if node.op in ('eq', 'co', 'sw', 'ew') and attr in search_attrs:
+            return Plan('search', [node.value])
+    if isinstance(node, And):
+        left = _plan(node.left, lookup_attrs, search_attrs)
+        right = _plan(node.right, lookup_attrs, search_attrs)
+        return left if Plan.COST[left.source] <= Plan.COST[right.source] else right
+    if isinstance(node, Or):
+        left = _plan(node.left, lookup_attrs, search_attrs)
+        right = _plan(node.right, lookup_attrs, search_attrs)
+        if left.source == right.source and left.source != 'scan':
+            return Plan(left.source, left.values + right.values)
+        if 'scan' not in (left.source, right.source) and search_attrs:  # Mixed lookup/search: name search covers both
+            return Plan('search', left.values + right.values)
+    return SCAN
+
+
+def plan_users(node):
+    return _plan(node, USER_LOOKUP_ATTRS, USER_SEARCH_ATTRS)
+
+
+def plan_groups(node):
+    return _plan(node, GROUP_LOOKUP_ATTRS, frozenset())
@@ -1,335 +1,951 @@
-import requests
-import json
-import settings
-
-TOKEN = settings.TOKEN
-BASE_URL = settings.BASE_URL
-
-DEFAULT_TEAM_NEW_ORG_PERMISSIONS = settings.DEFAULT_TEAM_NEW_ORG_PERMISSIONS
-
-
-class GiteaUser:
-    def __init__(self, **kwargs) -> None:
-        self.id = kwargs.get('username')
-        self.username = kwargs.get('username')
-        self.login_name = kwargs.get('login_name')
-        self.full_name = kwargs.get('full_name')
-        self.email = kwargs.get('email')
-        self.avatar_url = kwargs.get('avatar_url')
-        self.language = kwargs.get('language')
-        self.is_admin = kwargs.get('is_admin')
-        self.last_login = kwargs.get('last_login')
-        self.created = kwargs.get('created')
-        self.restricted = kwargs.get('restricted')
-        self.active = kwargs.get('active')
-        self.prohibit_login = kwargs.get('prohibit_login')
-        self.location = kwargs.get('location')
-        self.website = kwargs.get('website')
-        self.description = kwargs.get('description')
-        self.visibility = kwargs.get('visibility')
-        self.source_id = kwargs.get('source_id')
-
-    def serialize(self):
-        if self.id:
-            return {
-                "schemas": [
-                    "urn:ietf:params:scim:schemas:core:2.0:User",
-                ],
-                "id": self.id,
-                "userName": self.username,
-                "emails": [
-                    {
-                        "primary": True,
-                        "value": self.email,
-                        "type": "work",
-                    }
-                ],
-                "description": self.description,
-                "active": self.active,
-                "urn:ietf:params:scim:schemas:extension:Gitea:2.0:User": {
-                        "full_name": self.full_name,
-                        "visibility": self.visibility,
-                        "location": self.location,
-                        'source_id': self.source_id
-                },
-                "meta": {"resourceType": "User"},
-            }
-        return self.not_found()
-
-    def not_found(self):
-        return None
-
-
-class GiteaOrg:
-    def __init__(self, **kwargs) -> None:
-        self.id = kwargs.get('username')
-        self.username = kwargs.get('username')
-        self.full_name = kwargs.get('full_name')
-        self.avatar_url = kwargs.get('avatar_url')
-        self.created = kwargs.get('created')
-        self.location = kwargs.get('location')
-        self.website = kwargs.get('website')
-        self.description = kwargs.get('description')
-        self.visibility = kwargs.get('visibility')
-        self.members = kwargs.get('members')
-
-    def serialize(self):
-        if self.id:
-            return {
-                "schemas": [
-                    "urn:ietf:params:scim:schemas:core:2.0:Group",
-                ],
-                "id": self.id,
-                "displayName": self.username,
-                "members": self.members,
-                "description": self.description,
-                "urn:ietf:params:scim:schemas:extension:Gitea:2.0:Group": {
-                        "full_name": self.full_name,
-                        "visibility": self.visibility,
-                        "location": self.location,
-                },
-                "meta": {"resourceType": "Group"},
-            }
-        return self.not_found()
-
-    def not_found(self):
-        return None
-
-
-class GiteaAPI:
-    def __init__(self, base_url, token) -> None:
-        self._HEADERS = {
-            'accept': 'application/json',
-            'Content-Type': 'application/json',
-            'Authorization': f'token {token}'
-        }
-        self.base_url = base_url
-
-    def get_user(self, username):
-        r = requests.get(f'{self.base_url}users/{username}', headers=self._HEADERS)
-        return r
-
-    def get_users(self, page=None, limit=None):
-        params = {}
-        if page:
-            params['page'] = page
-        if limit:
-            params['limit'] = limit
-        url = f'{self.base_url}admin/users'
-        r = requests.get(url, params=params, headers=self._HEADERS) # limit = Page Size | page = number of results to return (1-based) | uid = ID of the user to search for | no query returns all
-        # Page = startindex | limit = count
-        return r
-
-    def create_user(self, email: str, full_name: str, username: str, password: str, login_name: str, source_id: int, must_change_password=False, send_notify=False, visibility='limited'):  # Email is mandatory ! FIX
-        body = {
-            "email": email,
-            "full_name": full_name,
-            "login_name": login_name,
-            "must_change_password": must_change_password,
-            "password": password,
-            "send_notify": send_notify,
-            "source_id": source_id,
-            "username": username,
-            "visibility": visibility,
-        }
-        r = requests.post(f'{self.base_url}admin/users', data=json.dumps(body), headers=self._HEADERS)
-        return r
-
-    def edit_user(self, username: str, **kwargs):
-        body = kwargs
-        r = requests.patch(f'{self.base_url}admin/users/{username}', data=json.dumps(body), headers=self._HEADERS)
-        return r
-
-    def delete_user(self, username: str):
-        r = requests.delete(f'{self.base_url}admin/users/{username}', headers=self._HEADERS)
-        return r
-
-    def get_orgs(self, page=None, limit=None):
-        params = {}
-        if page:
-            params['page'] = page
-        if limit:
-            params['limit'] = limit
-        url = f'{self.base_url}orgs'
-        r = requests.get(url, params=params, headers=self._HEADERS) # limit = Page Size | page = number of results to return (1-based) | uid = ID of the user to search for | no query returns all
-        # Page = startindex | limit = count
-        return r
-    
-    def get_org(self, org: str):
-        r = requests.get(f'{self.base_url}orgs/{org}', headers=self._HEADERS)
-        return r
-
-    def get_org_members(self, org: str):
-        r = requests.get(f'{self.base_url}orgs/{org}/members', headers=self._HEADERS)
-        return r
-
-    def get_org_teams(self, org: str):
-        r = requests.get(f'{self.base_url}orgs/{org}/teams', headers=self._HEADERS)
-        return r
-
-    def create_team(self, org: str, name: str, description: str, can_create_org_repo: bool, includes_all_repositories: bool, permission: str, units: list, units_map=None):
-        body = {
-            "name": name,
-            "description": description,
-            "can_create_org_repo": can_create_org_repo,
-            "includes_all_repositories": includes_all_repositories,
-            "permission": permission,  # read,write,admin
-            "units": units,
-            "units_map": units_map,
-        }
-        r = requests.post(f'{self.base_url}orgs/{org}/teams', data=json.dumps(body), headers=self._HEADERS)
-        return r
-
-    def add_team_member(self, team_id: int, username: str):
-        r = requests.put(f'{self.base_url}teams/{team_id}/members/{username}', headers=self._HEADERS)
-        return r
-
-    def remove_team_member(self, team_id: int, username: str):
-        r = requests.delete(f'{self.base_url}teams/{team_id}/members/{username}', headers=self._HEADERS)
-        return r
-
-    def add_org_member(self, org: str, username: str):
-        organization = self.get_org_teams(org)
-        if organization.status_code == 200:
-            for team in organization.json():
-                if team['name'] == 'Default':
-                    org_team_id = team['id']
-                    return self.add_team_member(org_team_id, username)
-            else:
-                units = DEFAULT_TEAM_NEW_ORG_PERMISSIONS
-                r = g.create_team(org, 'Default', 'Default group for SCIM provisioning', False, True, 'read', units)  # May need to revisit
-                if r.status_code == 201:
-                    org_team_id = r.json()['id']
-                    return self.add_team_member(org_team_id, username)
-                else:
-                    return None
-
-    def create_org(self, username, visibility, full_name=None, description=None, location=None, website=None):
-        body = {
-            "username": username,
-            "visibility": visibility,
-            "full_name": full_name,
-            "description": description,
-            "location": location,
-            "website": website,
-        }
-        r = requests.post(f'{self.base_url}orgs', data=json.dumps(body), headers=self._HEADERS)
-        return r
-
-    def edit_org(self, org: str, **kwargs):
-        body = kwargs
-        r = requests.patch(f'{self.base_url}orgs/{org}', data=json.dumps(body), headers=self._HEADERS)
-        return r
-
-
-
-class GiteaSCIMWrapper(GiteaAPI):  # Build in validation
-    def __init__(self, base_url, token) -> None:
-        super().__init__(base_url, token)
-
-    def scim_create_user(self, email: str, full_name: str, username: str, password: str, login_name: str, source_id: int, must_change_password=False, send_notify=False, visibility='limited'):
-        create_response = self.create_user(
-            email=email,
-            full_name=full_name,
-            username=username,
-            login_name=login_name,
-            source_id=source_id,
-            password=password
-        ) # review
-        if create_response.status_code == 201:
-            created_user = self.get_user(username=username).json()
-            return GiteaUser(**created_user).serialize()
-    
-    def scim_edit_user(self, username: str, **kwargs):
-        edit_response = self.edit_user(username, **kwargs)
-        if edit_response.status_code == 201:
-            edited_user = self.G.get_user(username=username).json()
-            return GiteaUser(**edited_user).serialize()
-
-    def scim_get_user(self, username: str):
-        user_response = self.get_user(username)
-        if user_response.status_code == 200:
-            user = user_response.json()
-            return GiteaUser(**user).serialize()
-
-    def scim_get_users(self, page=None, limit=None):
-        get_users_response = self.get_users(page, limit)
-        if get_users_response.status_code == 200:
-            users = get_users_response.json()
-            return [GiteaUser(**g).serialize() for g in users]
-
-    def scim_create_org(self, username, visibility, full_name=None, description=None, location=None, website=None):
-        create_response = self.create_org(username=username, visibility=visibility, full_name=full_name, description=description, location=location, website=website)
-        if create_response.status_code == 201:
-            created_org = create_response.json()
-            units =  DEFAULT_TEAM_NEW_ORG_PERMISSIONS
-            self.create_team(username, 'Default', 'Default group created by SCIM provisioning', False, True, 'read', units)
-            return GiteaOrg(**created_org).serialize()
-
-    def scim_get_org(self, org: str):
-        org_response = self.get_org(org=org)
-        if org_response.status_code == 200:
-            org_json = org_response.json()
-            return GiteaOrg(**org_json).serialize()
-
-    def scim_get_orgs(self, page=None, limit=None):
-        get_orgs_response = self.get_orgs(page, limit)
-        if get_orgs_response.status_code == 200:
-            orgs = get_orgs_response.json()
-            return [GiteaOrg(**o).serialize() for o in orgs]
-
-
-    def _get_org_default_team(self, org: str, create=True):
-        organization = self.get_org_teams(org)
-        if organization.status_code == 200:
-            for team in organization.json():
-                if team['name'] == 'Default':
-                    return team['id']
-            else:
-                if create:
-                    units =  [ "repo.code", "repo.issues", "repo.ext_issues", "repo.wiki", "repo.pulls", "repo.releases", "repo.projects", "repo.ext_wiki" ]
-                    r = self.create_team(org, 'Default', 'Default group created by SCIM provisioning', False, True, 'read', units)
-                    if r.status_code == 201:
-                        return r.json()['id']
-
-    def scim_add_org_member(self, org: str, member: str):
-        org_default_team_id = self._get_org_default_team(org, create=True)
-        if org_default_team_id:
-            add_member_response = self.add_team_member(org_default_team_id, member)
-            if add_member_response.status_code == 201:
-                return self.scim_get_org(org=org)
-
-    def scim_remove_org_member(self, org: str, member):
-        get_org_teams_response = self.get_org_teams(org)
-        if get_org_teams_response.status_code == 200:
-            for team in get_org_teams_response.json():
-                team_id = team['id']
-                self.remove_team_member(team_id, member)
-        return self.scim_get_org(org=org)
-
-
-    def scim_edit_org(self, org: str, **kwargs):
-        edit_org_response = self.edit_org(org, **kwargs)
-        if edit_org_response.status_code == 200:
-            org = edit_org_response.json()
-            return GiteaOrg(**org).serialize()
-
-    def scim_get_org_members(self, org: str):  # Don't need with MS? - Might need for intial cycle vs delta
-        get_members_response = self.get_org_members(org)
-        if get_members_response.status_code == 200:
-            return get_members_response.json()
-
-
-# Check what is needed for return values for efficiency
-
-
-if __name__ == '__main__':
-    g = GiteaSCIMWrapper(BASE_URL, TOKEN)
-    t = g.scim_get_org('Gitea', members=True)
-    print(t)
-
-    # o = g.add_org_member('testorg', 'renovate')
-    # print(o.status_code)
-
-    # o = g.get_org_members('testorg')
-    # print(o.json())
+import hashlib
+import itertools
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import settings
+import filters
+import metrics
+import patch
+import serializer
+import tracing
+from cache import TTLCache
+from journal import fold
+from transport import GiteaUnavailable, HTTPTransport, SingleFlight, UpstreamGuard
+
+TOKEN = settings.TOKEN
+BASE_URL = settings.BASE_URL
+
+DEFAULT_TEAM_NEW_ORG_PERMISSIONS = settings.DEFAULT_TEAM_NEW_ORG_PERMISSIONS
+
+
+class ConflictError(Exception):
+    """Raised when Gitea reports the user/org already exists; maps to SCIM 409 uniqueness."""
+
+
+def resource_version(resource: dict):
+    """
+    Weak ETag for a serialized SCIM resource, derived from its content.
+
+    Resources always come out of serialize() with the same key order, so the
+    plain encoding is stable without paying for sort_keys.
+    """
+    digest = hashlib.sha1(serializer.dumps(resource)).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+class GiteaUser:
+    __slots__ = (
+        'id', 'username', 'login_name', 'full_name', 'email', 'avatar_url', 'language', 'is_admin', 'last_login',
+        'created', 'restricted', 'active', 'prohibit_login', 'location', 'website', 'description', 'visibility',
+        'source_id',
+    )
+
+    def __init__(self, **kwargs) -> None:
+        self._load(kwargs)
+
+    @classmethod
+    def from_json(cls, data: dict):
+        """Build straight from a Gitea payload, skipping the **kwargs copy."""
+        user = cls.__new__(cls)
+        user._load(data)
+        return user
+
+    def _load(self, data: dict):
+        get = data.get
+        self.id = get('username')
+        self.username = get('username')
+        self.login_name = get('login_name')
+        self.full_name = get('full_name')
+        self.email = get('email')
+        self.avatar_url = get('avatar_url')
+        self.language = get('language')
+        self.is_admin = get('is_admin')
+        self.last_login = get('last_login')
+        self.created = get('created')
+        self.restricted = get('restricted')
+        self.active = get('active')
+        self.prohibit_login = get('prohibit_login')
+        self.location = get('location')
+        self.website = get('website')
+        self.description = get('description')
+        self.visibility = get('visibility')
+        self.source_id = get('source_id')
+
+    def serialize(self):
+        if self.id:
+            return {
+                "schemas": [
+                    "urn:ietf:params:scim:schemas:core:2.0:User",
+                ],
+                "id": self.id,
+                "userName": self.username,
+                "emails": [
+                    {
+                        "primary": True,
+                        "value": self.email,
+                        "type": "work",
+                    }
+                ],
+                "description": self.description,
+                "active": self.active,
+                "urn:ietf:params:scim:schemas:extension:Gitea:2.0:User": {
+                        "full_name": self.full_name,
+                        "visibility": self.visibility,
+                        "location": self.location,
+                        'source_id': self.source_id
+                },
+                "meta": {"resourceType": "User"},
+            }
+        return self.not_found()
+
+    def not_found(self):
+        return None
+
+
+class GiteaOrg:
+    __slots__ = ('id', 'username', 'full_name', 'avatar_url', 'created', 'location', 'website', 'description', 'visibility', 'members')
+
+    def __init__(self, **kwargs) -> None:
+        self._load(kwargs)
+
+    @classmethod
+    def from_json(cls, data: dict):
+        """Build straight from a Gitea payload, skipping the **kwargs copy."""
+        org = cls.__new__(cls)
+        org._load(data)
+        return org
+
+    def _load(self, data: dict):
+        get = data.get
+        self.id = get('username')
+        self.username = get('username')
+        self.full_name = get('full_name')
+        self.avatar_url = get('avatar_url')
+        self.created = get('created')
+        self.location = get('location')
+        self.website = get('website')
+        self.description = get('description')
+        self.visibility = get('visibility')
+        self.members = get('members')
+
+    def serialize(self):
+        if self.id:
+            return {
+                "schemas": [
+                    "urn:ietf:params:scim:schemas:core:2.0:Group",
+                ],
+                "id": self.id,
+                "displayName": self.username,
+                "members": self.members,
+                "description": self.description,
+                "urn:ietf:params:scim:schemas:extension:Gitea:2.0:Group": {
+                        "full_name": self.full_name,
+                        "visibility": self.visibility,
+                        "location": self.location,
+                },
+                "meta": {"resourceType": "Group"},
+            }
+        return self.not_found()
+
+    def not_found(self):
+        return None
+
+
+def member_ref(user: dict):
+    """SCIM Group member entry for a Gitea user payload."""
+    return {
+        "value": user['username'],
+        "display": user.get('full_name') or user['username'],
+        "$ref": f"{settings.SCIM_PUBLIC_URL}/scim/v2/Users/{user['username']}",
+    }
+
+
+def page_plan(start_index: int, count: int, max_page_size: int):
+    """
+    Map a 1-based SCIM item range onto Gitea's page/limit parameters.
+
+    Returns (limit, page, offset): the page size to request, the first page
+    to fetch and how many leading items of that page to skip. Ranges that are
+    aligned to their own size are fetched with a single exact call.
+    """
+    first = start_index - 1
+    if 0 < count <= max_page_size and first % count == 0:
+        return count, first // count + 1, 0
+    return max_page_size, first // max_page_size + 1, first % max_page_size
+
+
+class GiteaAPI:
+    def __init__(self, base_url, token, transport=None) -> None:
+        self._HEADERS = {
+            'accept': 'application/json',
+            'Content-Type': 'application/json',
+            'Authorization': f'token {token}'
+        }
+        self.base_url = base_url
+        self.transport = transport or HTTPTransport()
+        self.single_flight = SingleFlight() if settings.GITEA_COALESCE_READS else None
+        self.guard = UpstreamGuard() if settings.GITEA_LIMITER_ENABLED else None
+        self._write_seq = itertools.count(1)
+        self._write_epoch = 0
+
+    def _request(self, call: str, method: str, path: str, **kwargs):
+        """Send one Gitea call; `call` names the API method making it and labels the upstream metrics."""
+        url = f'{self.base_url}{path}'
+        if method == 'GET' and self.single_flight is not None:
+            # Keyed on the write epoch too, so a read issued after a write never joins one started before it
+            key = (url, tuple(sorted((kwargs.get('params') or {}).items())), self._write_epoch)
+            return self.single_flight.do(key, lambda: self._send(call, method, path, kwargs))
+        if method == 'GET':
+            return self._send(call, method, path, kwargs)
+        self._write_epoch = next(self._write_seq)
+        try:
+            return self._send(call, method, path, kwargs)
+        finally:
+            self._write_epoch = next(self._write_seq)  # Reads started while the write was in flight may predate it
+
+    def _send(self, call: str, method: str, path: str, kwargs):
+        page = (kwargs.get('params') or {}).get('page')
+        if self.guard is None:
+            with metrics.timed_call(call, method, path, page) as timing:
+                timing.response = self.transport.request(method, f'{self.base_url}{path}', headers=self._HEADERS, **kwargs)
+            return timing.response
+        with self.guard.slot(call) as slot, metrics.timed_call(call, method, path, page) as timing:
+            timing.response = slot.response = self.transport.request(method, f'{self.base_url}{path}', headers=self._HEADERS, **kwargs)
+        return timing.response
+
+    def stats(self):
+        """Upstream counters: the connection pool, how many reads were coalesced, the concurrency limit and breaker."""
+        return {
+            'transport': self.transport.stats(),
+            'single_flight': self.single_flight.stats() if self.single_flight is not None else None,
+            'guard': self.guard.stats() if self.guard is not None else None,
+        }
+
+    def get_user(self, username):
+        r = self._request('get_user', 'GET', f'users/{username}')
+        return r
+
+    def get_users(self, page=None, limit=None):
+        params = {}
+        if page:
+            params['page'] = page
+        if limit:
+            params['limit'] = limit
+        r = self._request('get_users', 'GET', 'admin/users', params=params) # limit = Page Size | page = number of results to return (1-based) | uid = ID of the user to search for | no query returns all
+        # Page = startindex | limit = count
+        return r
+
+    def _get_range(self, fetch_page, start_index: int, count: int):
+        """
+        Fetch items [start_index, start_index + count) from a paged listing.
+
+        Only the Gitea pages covering the range are requested. Returns
+        (items, total) where total comes from Gitea's X-Total-Count header,
+        or (None, None) if Gitea answered with an error.
+        """
+        if count is None:
+            count = settings.SCIM_MAX_PAGE_SIZE
+        limit, page, offset = page_plan(start_index, max(count, 1), settings.GITEA_MAX_PAGE_SIZE)
+        items = []
+        total = None
+        while True:
+            r = fetch_page(page=page, limit=limit)
+            if r.status_code != 200:
+                return None, None
+            batch = r.json()
+            if 'X-Total-Count' in r.headers:
+                total = int(r.headers['X-Total-Count'])
+            items.extend(batch[offset:])
+            offset = 0
+            if len(items) >= count or len(batch) < limit:
+                break
+            page += 1
+        items = items[:count]
+        if total is None:  # Older Gitea without X-Total-Count
+            total = start_index - 1 + len(items)
+        return items, total
+
+    def _iter_range(self, fetch_page, start_index: int, key=None):
+        """
+        Walk a paged listing lazily from start_index to the end.
+
+        The first page is fetched eagerly so the total is known up front.
+        Returns (total, iterator of pages) or (None, None) on error. `key`
+        picks the list out of wrapped payloads such as users/search.
+        """
+        page_size = settings.GITEA_MAX_PAGE_SIZE
+        limit, page, offset = page_plan(start_index, page_size, page_size)
+        first = fetch_page(page=page, limit=limit)
+        if first.status_code != 200:
+            return None, None
+        first_batch = first.json() if key is None else first.json()[key]
+        total = int(first.headers.get('X-Total-Count', -1))
+
+        def pages():
+            nonlocal page
+            batch = first_batch
+            yield batch[offset:]
+            while len(batch) == limit:
+                page += 1
+                r = fetch_page(page=page, limit=limit)
+                if r.status_code != 200:
+                    return
+                batch = r.json() if key is None else r.json()[key]
+                yield batch
+
+        return (total if total >= 0 else None), pages()
+
+    def iter_users(self, start_index=1):
+        return self._iter_range(self.get_users, start_index)
+
+    def iter_search_users(self, q: str):
+        return self._iter_range(lambda page, limit: self.search_users(q, page=page, limit=limit), 1, key='data')
+
+    def iter_orgs(self, start_index=1):
+        return self._iter_range(self.get_orgs, start_index)
+
+    def get_users_range(self, start_index=1, count=None):
+        return self._get_range(self.get_users, start_index, count)
+
+    def search_users(self, q: str, page=None, limit=None):
+        params = {'q': q}
+        if page:
+            params['page'] = page
+        if limit:
+            params['limit'] = limit
+        r = self._request('search_users', 'GET', 'users/search', params=params)  # Matches login and full name
+        return r
+
+    def create_user(self, email: str, full_name: str, username: str, password: str, login_name: str, source_id: int, must_change_password=False, send_notify=False, visibility='limited'):  # Email is mandatory ! FIX
+        body = {
+            "email": email,
+            "full_name": full_name,
+            "login_name": login_name,
+            "must_change_password": must_change_password,
+            "password": password,
+            "send_notify": send_notify,
+            "source_id": source_id,
+            "username": username,
+            "visibility": visibility,
+        }
+        r = self._request('create_user', 'POST', 'admin/users', data=json.dumps(body))
+        return r
+
+    def edit_user(self, username: str, **kwargs):
+        body = kwargs
+        r = self._request('edit_user', 'PATCH', f'admin/users/{username}', data=json.dumps(body))
+        return r
+
+    def delete_user(self, username: str):
+        r = self._request('delete_user', 'DELETE', f'admin/users/{username}')
+        return r
+
+    def get_orgs(self, page=None, limit=None):
+        params = {}
+        if page:
+            params['page'] = page
+        if limit:
+            params['limit'] = limit
+        r = self._request('get_orgs', 'GET', 'orgs', params=params) # limit = Page Size | page = number of results to return (1-based) | uid = ID of the user to search for | no query returns all
+        # Page = startindex | limit = count
+        return r
+    
+    def get_orgs_range(self, start_index=1, count=None):
+        return self._get_range(self.get_orgs, start_index, count)
+
+    def get_org(self, org: str):
+        r = self._request('get_org', 'GET', f'orgs/{org}')
+        return r
+
+    def get_org_members(self, org: str, page=None, limit=None):
+        params = {}
+        if page:
+            params['page'] = page
+        if limit:
+            params['limit'] = limit
+        r = self._request('get_org_members', 'GET', f'orgs/{org}/members', params=params)
+        return r
+
+    def iter_org_members(self, org: str):
+        return self._iter_range(lambda page, limit: self.get_org_members(org, page=page, limit=limit), 1)
+
+    def get_team_members(self, team_id: int, page=None, limit=None):
+        params = {}
+        if page:
+            params['page'] = page
+        if limit:
+            params['limit'] = limit
+        r = self._request('get_team_members', 'GET', f'teams/{team_id}/members', params=params)
+        return r
+
+    def iter_team_members(self, team_id: int):
+        return self._iter_range(lambda page, limit: self.get_team_members(team_id, page=page, limit=limit), 1)
+
+    def get_org_teams(self, org: str):
+        r = self._request('get_org_teams', 'GET', f'orgs/{org}/teams')
+        return r
+
+    def create_team(self, org: str, name: str, description: str, can_create_org_repo: bool, includes_all_repositories: bool, permission: str, units: list, units_map=None):
+        body = {
+            "name": name,
+            "description": description,
+            "can_create_org_repo": can_create_org_repo,
+            "includes_all_repositories": includes_all_repositories,
+            "permission": permission,  # read,write,admin
+            "units": units,
+            "units_map": units_map,
+        }
+        r = self._request('create_team', 'POST', f'orgs/{org}/teams', data=json.dumps(body))
+        return r
+
+    def add_team_member(self, team_id: int, username: str):
+        r = self._request('add_team_member', 'PUT', f'teams/{team_id}/members/{username}')
+        return r
+
+    def remove_team_member(self, team_id: int, username: str):
+        r = self._request('remove_team_member', 'DELETE', f'teams/{team_id}/members/{username}')
+        return r
+
+    def add_org_member(self, org: str, username: str):
+        organization = self.get_org_teams(org)
+        if organization.status_code == 200:
+            for team in organization.json():
+                if team['name'] == 'Default':
+                    org_team_id = team['id']
+                    return self.add_team_member(org_team_id, username)
+            else:
+                units = DEFAULT_TEAM_NEW_ORG_PERMISSIONS
+                r = g.create_team(org, 'Default', 'Default group for SCIM provisioning', False, True, 'read', units)  # May need to revisit
+                if r.status_code == 201:
+                    org_team_id = r.json()['id']
+                    return self.add_team_member(org_team_id, username)
+                else:
+                    return None
+
+    def create_org(self, username, visibility, full_name=None, description=None, location=None, website=None):
+        body = {
+            "username": username,
+            "visibility": visibility,
+            "full_name": full_name,
+            "description": description,
+            "location": location,
+            "website": website,
+        }
+        r = self._request('create_org', 'POST', 'orgs', data=json.dumps(body))
+        return r
+
+    def edit_org(self, org: str, **kwargs):
+        body = kwargs
+        r = self._request('edit_org', 'PATCH', f'orgs/{org}', data=json.dumps(body))
+        return r
+
+
+
+class GiteaSCIMWrapper(GiteaAPI):  # Build in validation
+    def __init__(self, base_url, token, transport=None, cache=None, store=None, journal=None) -> None:
+        super().__init__(base_url, token, transport=transport)
+        self.cache = cache if cache is not None else TTLCache()  # An empty cache is falsy
+        self.store = store  # Optional store.ShadowStore serving list/filter reads
+        self.journal = journal  # Optional journal.WriteJournal whose queued writes are folded into reads
+        self._team_index = self.cache.index('teams')  # org -> {'ids': [...], 'default': id}, shared when the cache is
+        self._team_index_lock = threading.Lock()
+        self._team_locks = {}  # org -> threading.Lock, so concurrent adds create one Default team
+
+    # Read-through cache for user and org lookups. Gitea names are case-insensitive,
+    # 404s are cached too so existence probes before a create don't hit Gitea twice.
+    def _cached_get(self, kind: str, name: str, fetch):
+        key = (kind, name.lower())
+        response = self.cache.get(key)
+        if response is None:
+            response = fetch(name)
+            if response.status_code in (200, 404):
+                self.cache.set(key, response)
+        return response
+
+    def _invalidate(self, kind: str, name: str, response=None):
+        if response is not None and response.status_code == 200:  # Edits return the updated resource
+            self.cache.set((kind, name.lower()), response)
+        else:
+            self.cache.delete((kind, name.lower()))
+        version_kind = 'org' if kind == 'members' else kind
+        for members in (True, False):
+            self.cache.delete(('version', version_kind, name.lower(), members))
+
+    # ETags: every resource served gets meta.version. Fingerprints of single resources
+    # fetched or written are kept so If-None-Match/If-Match can be answered without
+    # calling Gitea; list pages aren't, they would only push useful entries out.
+    def _stamp(self, kind: str, resource, remember=True):
+        if resource:
+            resource['meta'].pop('version', None)
+            version = resource_version(resource)
+            resource['meta']['version'] = version
+            if remember:
+                members = kind == 'org' and resource.get('members') is not None
+                self.cache.set(('version', kind, resource['id'].lower(), members), version)
+        return resource
+
+    def cached_version(self, kind: str, name: str, members=False):
+        return self.cache.get(('version', kind, name.lower(), members))
+
+    def current_version(self, kind: str, name: str):
+        """Version of the full resource, from the fingerprint cache or one fetch."""
+        members = kind == 'org'
+        version = self.cached_version(kind, name, members)
+        if version is None:
+            resource = self.scim_get_user(name) if kind == 'user' else self.scim_get_org(name)
+            version = resource['meta']['version'] if resource else None
+        return version
+
+    # Read-your-writes: fold journaled writes Gitea hasn't seen yet over its answer
+    def _pending(self, kind: str, name: str):
+        return self.journal.pending(kind, name) if self.journal is not None else []
+
+    @staticmethod
+    def _overlay(pending, payload):
+        for entry in pending:
+            payload = fold(entry, payload)
+        return payload
+
+    @staticmethod
+    def _overlay_members(pending, refs):
+        for entry in pending:
+            if entry.action == 'update_members':
+                removed = {m.lower() for m in entry.payload.get('remove', [])}
+                refs = [ref for ref in refs if ref['value'].lower() not in removed]
+                present = {ref['value'].lower() for ref in refs}
+                refs += [member_ref({'username': m}) for m in entry.payload.get('add', []) if m.lower() not in present]
+        return refs
+
+    def _lookup(self, kind: str, name: str):
+        """A user/org payload by name with queued writes applied, or None."""
+        r = self.get_user(name) if kind == 'user' else self.get_org(name)
+        return self._overlay(self._pending(kind, name), r.json() if r.status_code == 200 else None)
+
+    @property
+    def _shadow(self):
+        if self.store is not None and self.store.loaded:
+            return self.store
+
+    def get_user(self, username):
+        return self._cached_get('user', username, super().get_user)
+
+    def get_org(self, org: str):
+        return self._cached_get('org', org, super().get_org)
+
+    def create_user(self, email: str, full_name: str, username: str, password: str, login_name: str, source_id: int, must_change_password=False, send_notify=False, visibility='limited'):
+        r = super().create_user(email, full_name, username, password, login_name, source_id, must_change_password=must_change_password, send_notify=send_notify, visibility=visibility)
+        self._invalidate('user', username)
+        if self.store is not None and r.status_code == 201:
+            self.store.upsert_user(r.json())
+        return r
+
+    def edit_user(self, username: str, **kwargs):
+        r = super().edit_user(username, **kwargs)
+        self._invalidate('user', username, r)
+        if self.store is not None and r.status_code == 200:
+            self.store.upsert_user(r.json())
+        return r
+
+    def delete_user(self, username: str):
+        r = super().delete_user(username)
+        self._invalidate('user', username)
+        if self.store is not None and r.status_code == 204:
+            self.store.delete_user(username)
+        return r
+
+    def create_org(self, username, visibility, full_name=None, description=None, location=None, website=None):
+        r = super().create_org(username, visibility, full_name=full_name, description=description, location=location, website=website)
+        self._invalidate('org', username)
+        if self.store is not None and r.status_code == 201:
+            self.store.upsert_org(r.json())
+        return r
+
+    def edit_org(self, org: str, **kwargs):
+        r = super().edit_org(org, **kwargs)
+        self._invalidate('org', org, r)
+        if self.store is not None and r.status_code == 200:
+            self.store.upsert_org(r.json())
+        return r
+
+    def scim_create_user(self, email: str, full_name: str, username: str, password: str, login_name: str, source_id: int, must_change_password=False, send_notify=False, visibility='limited'):
+        """Create a user with a single POST, the SCIM resource is built from Gitea's 201 body. Raises ConflictError."""
+        create_response = self.create_user(
+            email=email,
+            full_name=full_name,
+            username=username,
+            login_name=login_name,
+            source_id=source_id,
+            password=password
+        )
+        if create_response.status_code == 422:
+            raise ConflictError(f'User {username} already exists')
+        if create_response.status_code == 201:
+            return self._stamp('user', GiteaUser.from_json(create_response.json()).serialize())
+
+    def scim_edit_user(self, username: str, **kwargs):
+        edit_response = self.edit_user(username, **kwargs)
+        if edit_response.status_code == 200:
+            return self._stamp('user', GiteaUser.from_json(edit_response.json()).serialize())
+
+    # PATCH engine: apply the operations to the current resource, then send
+    # Gitea only the fields that actually changed (nothing at all for no-ops).
+    def scim_diff_user(self, username: str, operations):
+        """(current resource, Gitea field delta), or (None, None) if the user doesn't exist. Raises patch.PatchError."""
+        current = self.scim_get_user(username)
+        if not current:
+            return None, None
+        return current, patch.diff(patch.USER_FIELDS, current, patch.apply(current, operations))
+
+    def scim_get_user(self, username: str):
+        user = self._lookup('user', username)
+        if user:
+            return self._stamp('user', GiteaUser.from_json(user).serialize())
+
+    def scim_get_users(self, start_index=1, count=None):
+        shadow = self._shadow
+        users, total = shadow.users_range(start_index, count) if shadow else self.get_users_range(start_index, count)
+        if users is not None:
+            return [self._stamp('user', GiteaUser.from_json(g).serialize(), remember=False) for g in users], total
+
+    def scim_iter_users(self, start_index=1):
+        shadow = self._shadow
+        total, pages = shadow.iter_users(start_index) if shadow else self.iter_users(start_index)
+        if pages is not None:
+            return total, ([self._stamp('user', GiteaUser.from_json(u).serialize(), remember=False) for u in page] for page in pages)
+
+    def scim_create_org(self, username, visibility, full_name=None, description=None, location=None, website=None):
+        """
+        Create an org with a single POST. Raises ConflictError.
+
+        The Default team isn't created here, _get_org_default_team creates it
+        when the first member is added.
+        """
+        create_response = self.create_org(username=username, visibility=visibility, full_name=full_name, description=description, location=location, website=website)
+        if create_response.status_code == 422:
+            raise ConflictError(f'Group {username} already exists')
+        if create_response.status_code == 201:
+            created_org = create_response.json()
+            created_org['members'] = []
+            return self._stamp('org', GiteaOrg.from_json(created_org).serialize())
+
+    def scim_get_org(self, org: str, members=True):
+        org_response = self.get_org(org=org)
+        pending = self._pending('org', org)
+        org_json = self._overlay(pending, org_response.json() if org_response.status_code == 200 else None)
+        if org_json:
+            if members:
+                org_json['members'] = self._overlay_members(pending, self.scim_get_org_member_refs(org_json['username']))
+            return self._stamp('org', GiteaOrg.from_json(org_json).serialize())
+
+    def scim_get_orgs(self, start_index=1, count=None, members=True):
+        shadow = self._shadow
+        orgs, total = shadow.orgs_range(start_index, count) if shadow else self.get_orgs_range(start_index, count)
+        if orgs is not None:
+            return self._with_members([GiteaOrg.from_json(o).serialize() for o in orgs], members), total
+
+    def scim_iter_orgs(self, start_index=1, members=True):
+        shadow = self._shadow
+        total, pages = shadow.iter_orgs(start_index) if shadow else self.iter_orgs(start_index)
+        if pages is not None:
+            return total, (self._with_members([GiteaOrg.from_json(o).serialize() for o in page], members) for page in pages)
+
+    @staticmethod
+    def _page_size(count):
+        """count=0 is a valid request for totalResults alone, only a missing count means a full page."""
+        return settings.SCIM_MAX_PAGE_SIZE if count is None else min(count, settings.SCIM_MAX_PAGE_SIZE)
+
+    @staticmethod
+    def _take(resources, start_index: int, count: int):
+        """Page through a stream of matches, counting the rest for totalResults."""
+        page = []
+        total = 0
+        for resource in resources:
+            total += 1
+            if start_index <= total < start_index + count:
+                page.append(resource)
+        return page, total
+
+    def _filter_candidates(self, plan, lookup, search, scan):
+        seen = set()
+        if plan.source == 'lookup':
+            pages = [[item] for item in map(lookup, dict.fromkeys(plan.values)) if item]
+        elif plan.source == 'search':
+            pages = (page for q in dict.fromkeys(plan.values) for page in (search(q)[1] or ()))
+        else:
+            pages = scan()[1] or ()
+        for page in pages:
+            for item in page:
+                name = item['username'].lower()
+                if name in seen:
+                    continue
+                seen.add(name)
+                yield item
+
+    def scim_filter_users(self, filter_expr: str, start_index=1, count=None):
+        """
+        Evaluate a SCIM filter against users.
+
+        The planner pushes what it can down to Gitea (userName eq -> get_user,
+        co/sw on userName or full name -> user search), or to indexed columns when a
+        shadow store is loaded, and the full filter is then checked locally over
+        the streamed candidates. Raises filters.FilterError.
+        """
+        node = filters.parse(filter_expr)
+        shadow = self._shadow
+        if shadow:
+            candidates = (user for page in shadow.filter_users(node) for user in page)
+        else:
+            candidates = self._filter_candidates(filters.plan_users(node), lambda name: self._lookup('user', name), self.iter_search_users, self.iter_users)
+        resources = (self._stamp('user', GiteaUser.from_json(u).serialize(), remember=False) for u in candidates)
+        return self._take((r for r in resources if filters.matches(node, r)), start_index, self._page_size(count))
+
+    def scim_filter_orgs(self, filter_expr: str, start_index=1, count=None, members=True):
+        """Evaluate a SCIM filter against orgs; see scim_filter_users."""
+        node = filters.parse(filter_expr)
+        shadow = self._shadow
+        if shadow:
+            candidates = (org for page in shadow.filter_orgs(node) for org in page)
+        else:
+            candidates = self._filter_candidates(filters.plan_groups(node), lambda name: self._lookup('org', name), None, self.iter_orgs)
+        resources = (GiteaOrg.from_json(o).serialize() for o in candidates)
+        if members and filters.references(node, 'members'):
+            resources = (self._with_members([r], True)[0] for r in resources)
+            members = False
+        page, total = self._take((r for r in resources if filters.matches(node, r)), start_index, self._page_size(count))
+        return self._with_members(page, members), total
+
+    # Org -> team ID index, filled lazily from get_org_teams and kept current by
+    # create_team so member changes don't re-list an org's teams every time.
+    def _index_org_teams(self, org: str):
+        get_org_teams_response = self.get_org_teams(org)
+        if get_org_teams_response.status_code != 200:
+            return None
+        teams = get_org_teams_response.json()
+        team_ids = [team['id'] for team in teams]
+        default_team_id = next((team['id'] for team in teams if team['name'] == 'Default'), None)
+        with self._team_index_lock:
+            self._team_index[org.lower()] = {'ids': team_ids, 'default': default_team_id}
+        return team_ids
+
+    def _forget_org_teams(self, org: str):
+        with self._team_index_lock:
+            self._team_index.pop(org.lower(), None)
+
+    def _get_org_team_ids(self, org: str):
+        entry = self._team_index.get(org.lower())
+        if entry is None:
+            return self._index_org_teams(org)
+        return entry['ids']
+
+    def org_teams(self, org: str):
+        """(team IDs, Default team ID or None) of an org, from the index."""
+        return self._get_org_team_ids(org) or [], self._get_org_default_team(org, create=False)
+
+    def create_team(self, org: str, name: str, description: str, can_create_org_repo: bool, includes_all_repositories: bool, permission: str, units: list, units_map=None):
+        r = super().create_team(org, name, description, can_create_org_repo, includes_all_repositories, permission, units, units_map=units_map)
+        if r.status_code == 201:
+            team_id = r.json()['id']
+            with self._team_index_lock:
+                entry = self._team_index.get(org.lower())
+                if entry is not None:
+                    self._team_index[org.lower()] = {
+                        'ids': entry['ids'] + [team_id],
+                        'default': team_id if name == 'Default' else entry['default'],
+                    }
+        return r
+
+    def _get_org_default_team(self, org: str, create=True):
+        entry = self._team_index.get(org.lower())
+        if entry is not None and entry['default'] is not None:
+            return entry['default']
+        with self._team_index_lock:
+            lock = self._team_locks.setdefault(org.lower(), threading.Lock())
+        with lock:
+            entry = self._team_index.get(org.lower())
+            if entry is None or entry['default'] is None:
+                if self._index_org_teams(org) is None:
+                    return None
+            team_id = (self._team_index.get(org.lower()) or {}).get('default')
+            if team_id is None and create:
+                r = self.create_team(org, 'Default', 'Default group created by SCIM provisioning', False, True, 'read', DEFAULT_TEAM_NEW_ORG_PERMISSIONS)
+                if r.status_code == 201:
+                    team_id = r.json()['id']
+                elif r.status_code == 422:  # Another process created it first
+                    self._index_org_teams(org)
+                    team_id = (self._team_index.get(org.lower()) or {}).get('default')
+            return team_id
+
+    def _map_members(self, func, members):
+        with ThreadPoolExecutor(max_workers=settings.GROUP_MEMBER_MAX_WORKERS) as pool:
+            return dict(zip(members, pool.map(tracing.bind(func), members)))
+
+    def _add_members(self, org: str, members):
+        team_id = self._get_org_default_team(org, create=True)
+        if not team_id:
+            return {member: 404 for member in members}
+        statuses = self._map_members(lambda m: self.add_team_member(team_id, m).status_code, members)
+        missing = [m for m, status in statuses.items() if status == 404]
+        if missing:  # Team may have been deleted behind our back, repair the index
+            self._forget_org_teams(org)
+            repaired_team_id = self._get_org_default_team(org, create=True)
+            if repaired_team_id and repaired_team_id != team_id:
+                statuses.update(self._map_members(lambda m: self.add_team_member(repaired_team_id, m).status_code, missing))
+        return statuses
+
+    def _remove_members(self, org: str, members):
+        team_ids = self._get_org_team_ids(org)
+        if team_ids is None:
+            return {member: 404 for member in members}
+
+        def remove_from_teams(ids):
+            def remove(member):
+                codes = [self.remove_team_member(team_id, member).status_code for team_id in ids]
+                return max(codes, default=204)
+            return remove
+
+        statuses = self._map_members(remove_from_teams(team_ids), members)
+        if any(status == 404 for status in statuses.values()):  # Re-list and retry any teams we didn't know about
+            self._forget_org_teams(org)
+            new_team_ids = set(self._get_org_team_ids(org) or []) - set(team_ids)
+            retried = [m for m, status in statuses.items() if status == 404]
+            if new_team_ids:
+                statuses.update(self._map_members(remove_from_teams(new_team_ids), retried))
+        return statuses
+
+    def scim_update_org_members(self, org: str, add=(), remove=()):
+        """
+        Apply membership changes to an org in one batch.
+
+        Teams are resolved once and the adds/removes fan out over a bounded
+        worker pool. Returns one {"value", "op", "status"} entry per member;
+        status is the Gitea response code.
+        """
+        results = []
+        if add:
+            results += [{"value": m, "op": "add", "status": status} for m, status in self._add_members(org, list(dict.fromkeys(add))).items()]
+        if remove:
+            results += [{"value": m, "op": "remove", "status": status} for m, status in self._remove_members(org, list(dict.fromkeys(remove))).items()]
+        self._invalidate('org', org)
+        self._invalidate('members', org)
+        if self.store is not None:
+            self.store.add_members(org, [r["value"] for r in results if r["op"] == "add" and r["status"] < 400])
+            self.store.remove_members(org, [r["value"] for r in results if r["op"] == "remove" and r["status"] < 400])
+        return results
+
+    def scim_add_org_member(self, org: str, member: str):
+        result = self.scim_update_org_members(org, add=[member])[0]
+        if result["status"] in (201, 204):
+            return self.scim_get_org(org=org)
+
+    def scim_remove_org_member(self, org: str, member):
+        self.scim_update_org_members(org, remove=[member])
+        return self.scim_get_org(org=org)
+
+    def scim_edit_org(self, org: str, members=True, **kwargs):
+        edit_org_response = self.edit_org(org, **kwargs)
+        if edit_org_response.status_code == 200:
+            org = edit_org_response.json()
+            if members:
+                org['members'] = self.scim_get_org_member_refs(org['username'])
+            return self._stamp('org', GiteaOrg.from_json(org).serialize())
+
+    def scim_diff_org(self, org: str, operations):
+        """
+        (current resource, Gitea field delta, members to add, members to
+        remove); current is None if the org doesn't exist.
+
+        Member changes that name their members are taken from the operations
+        as they are, and the current resource then has members None: only a
+        replace (or remove-all) of members pays for walking the member list.
+        """
+        named = patch.member_operations(operations)
+        if named is None:
+            current = self.scim_get_org(org, members=True)
+            if not current:
+                return None, None, [], []
+            patched = patch.apply(current, operations)
+            return (current, patch.diff(patch.GROUP_FIELDS, current, patched)) + patch.member_changes(current, patched)
+        add, remove, rest = named
+        current = self.scim_get_org(org, members=False)
+        if not current:
+            return None, None, [], []
+        return current, patch.diff(patch.GROUP_FIELDS, current, patch.apply(current, rest)), add, remove
+
+    def scim_patch_org(self, org: str, current: dict, delta: dict, add=(), remove=()):
+        """
+        Write a diffed PATCH (see scim_diff_org) to Gitea. Returns (resource,
+        member results); the resource is built from the edit response and the
+        member changes that went through rather than re-read, and is None if
+        the edit failed. It carries members only if `current` did.
+        """
+        resource = current
+        if delta:
+            resource = self.scim_edit_org(org, members=current.get('members') is not None, **delta)
+            if resource is None:
+                return None, []
+        results = []
+        if add or remove:
+            results = self.scim_update_org_members(org, add=add, remove=remove)
+        if results and resource.get('members') is not None:
+            added = [r['value'] for r in results if r['op'] == 'add' and r['status'] < 400]
+            removed = {r['value'].lower() for r in results if r['op'] == 'remove' and r['status'] < 400}
+            members = [m for m in resource.get('members') or [] if m['value'].lower() not in removed]
+            present = {m['value'].lower() for m in members}
+            members += [member_ref({'username': name}) for name in added if name.lower() not in present]
+            # Versioned but not cached, a later GET re-reads the real member list
+            meta = {key: value for key, value in resource['meta'].items() if key != 'version'}
+            resource = {**resource, 'members': members, 'meta': meta}
+            meta['version'] = resource_version(resource)
+        return resource, results
+
+    def _org_member_users(self, org: str):
+        """Every member of an org, from the org member listing and each team's members, walked concurrently."""
+        shadow = self._shadow
+        if shadow:
+            return shadow.org_member_users(org)
+        listings = [lambda: self.iter_org_members(org)]
+        listings += [lambda team_id=team_id: self.iter_team_members(team_id) for team_id in self._get_org_team_ids(org) or []]
+        with ThreadPoolExecutor(max_workers=settings.GROUP_MEMBER_MAX_WORKERS) as pool:
+            walks = pool.map(tracing.bind(lambda listing: [user for page in (listing()[1] or ()) for user in page]), listings)
+            users = {}
+            for walk in walks:
+                for user in walk:
+                    users.setdefault(user['username'].lower(), user)
+        return sorted(users.values(), key=lambda u: u['username'].lower())
+
+    def scim_get_org_member_refs(self, org: str):
+        """SCIM Group members ({value, display, $ref}) for an org, cached until membership changes."""
+        key = ('members', org.lower())
+        refs = self.cache.get(key)
+        if refs is None:
+            refs = [member_ref(user) for user in self._org_member_users(org)]
+            self.cache.set(key, refs)
+        return refs
+
+    def _with_members(self, resources, members=True):
+        for resource in resources:
+            if members:
+                resource['members'] = self.scim_get_org_member_refs(resource['id'])
+            self._stamp('org', resource, remember=False)
+        return resources
+
+    def scim_get_org_members(self, org: str):  # Don't need with MS? - Might need for intial cycle vs delta
+        get_members_response = self.get_org_members(org)
+        if get_members_response.status_code == 200:
+            return get_members_response.json()
+
+
+# Check what is needed for return values for efficiency
+
+
+if __name__ == '__main__':
+    g = GiteaSCIMWrapper(BASE_URL, TOKEN)
+    t = g.scim_get_org('Gitea', members=True)
+    print(t)
+
+    # o = g.add_org_member('testorg', 'renovate')
+    # print(o.status_code)
+
+    # o = g.get_org_members('testorg')
+    # print(o.json())
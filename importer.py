@@ -0,0 +1,336 @@
+import csv
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import patch
+import reconcile
+import settings
+from gitea import ConflictError
+
+CHECKPOINT_VERSION = 1
+
+
+def read_rows(path):
+    """
+    Stream (line number, SCIM resource, error) from a JSONL or CSV file;
+    rows that can't be read come back with the resource None and the error.
+
+    JSONL lines are SCIM Users and Groups. CSV rows with a userName column
+    become Users (email, full_name, description, visibility, location,
+    active) and rows with a displayName become Groups (full_name,
+    description, visibility, location). A `groups` or `members` column
+    holds names separated by ";".
+    """
+    with open(path, encoding='utf-8', newline='') as f:
+        if path.endswith('.csv'):
+            rows = ((number, row) for number, row in enumerate(csv.DictReader(f), start=2))  # Line 1 is the header
+            convert = lambda row: _csv_resource({k.strip(): (v or '').strip() for k, v in row.items() if k})
+        else:
+            rows = ((number, line) for number, line in enumerate(f, start=1) if line.strip())
+            convert = _json_resource
+        for number, row in rows:
+            try:
+                yield number, convert(row), None
+            except ValueError as e:
+                yield number, None, str(e)
+
+
+def _json_resource(line):
+    resource = json.loads(line)
+    if not isinstance(resource, dict):
+        raise ValueError(f'expected a JSON object, got {type(resource).__name__}')
+    return resource
+
+
+def _names(value):
+    return [name.strip() for name in (value or '').split(';') if name.strip()]
+
+
+def _csv_resource(row):
+    if row.get('userName'):
+        resource = {
+            'userName': row['userName'],
+            'emails': [{'primary': True, 'type': 'work', 'value': row.get('email')}],
+            patch.USER_EXTENSION: {k: row[k] for k in ('full_name', 'visibility', 'location') if row.get(k)},
+            'groups': [{'value': name} for name in _names(row.get('groups'))],
+        }
+        if row.get('description'):
+            resource['description'] = row['description']
+        if row.get('active'):
+            resource['active'] = row['active'].lower() not in ('false', '0', 'no')
+        return resource
+    if row.get('displayName'):
+        resource = {
+            'displayName': row['displayName'],
+            patch.GROUP_EXTENSION: {k: row[k] for k in ('full_name', 'visibility', 'location') if row.get(k)},
+            'members': [{'value': name} for name in _names(row.get('members'))],
+        }
+        if row.get('description'):
+            resource['description'] = row['description']
+        return resource
+    raise ValueError('row has neither userName nor displayName')
+
+
+def _ref_values(refs):
+    """Names in a list of {"value": ...} references, skipping anything malformed."""
+    if not isinstance(refs, list):
+        return []
+    return [ref['value'] for ref in refs if isinstance(ref, dict) and isinstance(ref.get('value'), str) and ref['value']]
+
+
+def memberships(resource):
+    """(org, username) pairs a resource declares, from a Group's members or a User's groups."""
+    kind = reconcile.resource_kind(resource)
+    if kind == 'group' and isinstance(resource.get('displayName'), str):
+        return [(resource['displayName'], name) for name in _ref_values(resource.get('members'))]
+    if kind == 'user' and isinstance(resource.get('userName'), str):
+        return [(org, resource['userName']) for org in _ref_values(resource.get('groups'))]
+    return []
+
+
+class Checkpoint:
+    """
+    Progress of an import, rewritten atomically as it advances.
+
+    `line` is the last input line below which everything in `phase` is
+    done; a resumed run skips those lines. Work finished past it is redone,
+    which is safe: creates of existing resources are counted as existing
+    and membership PUTs are idempotent.
+    """
+
+    def __init__(self, path, source) -> None:
+        self.path = path
+        self.source = os.path.abspath(source)
+        self.size = os.path.getsize(source)
+        self.phase = 'create'
+        self.line = 0
+        self.counts = {'created': 0, 'existing': 0, 'failed': 0, 'members': 0}
+
+    @classmethod
+    def load(cls, path, source):
+        checkpoint = cls(path, source)
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get('source') != checkpoint.source or state.get('size') != checkpoint.size:
+                raise ValueError(f'{path} belongs to another input ({state.get("source")}, {state.get("size")} bytes), pass --restart to discard it')
+            checkpoint.phase = state['phase']
+            checkpoint.line = state['line']
+            checkpoint.counts.update(state['counts'])
+        return checkpoint
+
+    def save(self):
+        state = {
+            'version': CHECKPOINT_VERSION, 'source': self.source, 'size': self.size,
+            'phase': self.phase, 'line': self.line, 'counts': self.counts, 'saved': time.time(),
+        }
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+class Progress:
+    """One live status line on stderr, redrawn at most every `interval` seconds."""
+
+    def __init__(self, stream=sys.stderr, interval=1.0) -> None:
+        self.stream = stream
+        self.interval = interval
+        self.started = time.monotonic()
+        self._drawn = 0.0
+
+    def update(self, checkpoint, done, force=False):
+        now = time.monotonic()
+        if not force and now - self._drawn < self.interval:
+            return
+        self._drawn = now
+        elapsed = now - self.started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        counts = checkpoint.counts
+        line = (
+            f'\r{checkpoint.phase:<7} line {checkpoint.line:>8}  created {counts["created"]}  existing {counts["existing"]}  '
+            f'members {counts["members"]}  failed {counts["failed"]}  {rate:7.1f}/s  {elapsed:6.0f}s'
+        )
+        self.stream.write(line)
+        self.stream.flush()
+
+    def finish(self, checkpoint, done):
+        self.update(checkpoint, done, force=True)
+        self.stream.write('\n')
+
+
+class Importer:
+    """
+    Onboard users and orgs from a JSONL/CSV file through a GiteaSCIMWrapper.
+
+    Two streaming passes over the input: create every user and org on a
+    bounded pool, then add the memberships in per-org batches. Memory stays
+    bounded by the pool's window and the membership batches, not the file.
+    """
+
+    def __init__(self, api, source, checkpoint, workers=None, batch_size=None, checkpoint_every=None, failures=None, progress=None) -> None:
+        self.api = api
+        self.source = source
+        self.checkpoint = checkpoint
+        self.workers = workers or settings.IMPORT_WORKERS
+        self.batch_size = batch_size or settings.IMPORT_MEMBER_BATCH
+        self.checkpoint_every = checkpoint_every or settings.IMPORT_CHECKPOINT_EVERY
+        self.failures = failures  # Open file, one JSON line per failed row
+        self.progress = progress
+        self.done = 0
+        self._ensured_orgs = set()
+
+    def _fail(self, number, detail):
+        self.checkpoint.counts['failed'] += 1
+        if self.failures is not None:
+            self.failures.write(json.dumps({'line': number, 'phase': self.checkpoint.phase, 'error': detail}) + '\n')
+            self.failures.flush()
+
+    def _report(self, force=False):
+        if self.progress is not None:
+            self.progress.update(self.checkpoint, self.done, force=force)
+
+    def run(self):
+        try:
+            if self.checkpoint.phase == 'create':
+                self._create_pass()
+                self.checkpoint.phase, self.checkpoint.line = 'members', 0
+            if self.checkpoint.phase == 'members':
+                self._member_pass()
+                self.checkpoint.phase = 'done'
+        finally:  # Also when interrupted or failing, so a resume skips what is done
+            self.checkpoint.save()
+        if self.progress is not None:
+            self.progress.finish(self.checkpoint, self.done)
+        return self.checkpoint.counts
+
+    # Pass 1: users and orgs
+
+    def _create(self, resource):
+        try:
+            kind = reconcile.resource_kind(resource)
+            if kind == 'user':
+                reconcile.create_user(self.api, resource)
+            elif kind == 'group':
+                reconcile.create_group(self.api, resource)
+                self._ensured_orgs.add(resource['displayName'].lower())
+            else:
+                return 'failed', 'not a SCIM User or Group'
+        except ConflictError:
+            return 'existing', None
+        except (RuntimeError, requests.RequestException, KeyError, TypeError, AttributeError) as e:  # Also resources missing required attributes
+            return 'failed', f'{type(e).__name__}: {e}'
+        return 'created', None
+
+    def _create_pass(self):
+        window = deque()  # (line, future) in input order, the checkpoint follows its completed head
+        last_saved = self.checkpoint.line
+
+        def settle(number, future):
+            outcome, detail = future.result()
+            if outcome == 'failed':
+                self._fail(number, detail)
+            else:
+                self.checkpoint.counts[outcome] += 1
+            self.checkpoint.line = number
+            self.done += 1
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for number, resource in self._rows():
+                if resource is None:
+                    continue
+                window.append((number, pool.submit(self._create, resource)))
+                while window and (window[0][1].done() or len(window) >= self.workers * 4):
+                    settle(*window.popleft())
+                if self.checkpoint.line - last_saved >= self.checkpoint_every:
+                    self.checkpoint.save()
+                    last_saved = self.checkpoint.line
+                self._report()
+            while window:
+                settle(*window.popleft())
+                self._report()
+
+    # Pass 2: memberships
+
+    def _ensure_org(self, org):
+        """Create an org only named by a user's groups column, with defaults. True if it was created here."""
+        if org.lower() in self._ensured_orgs:
+            return False
+        try:
+            reconcile.create_group(self.api, {'displayName': org})
+            created = True
+        except ConflictError:
+            created = False
+        self._ensured_orgs.add(org.lower())
+        return created
+
+    def _add_members(self, org, batch):
+        """Returns (org created, members added, [(line, error)])."""
+        names = [name for _, name in batch]
+        try:
+            created = self._ensure_org(org)
+            results = self.api.scim_update_org_members(org, add=names)
+        except (RuntimeError, requests.RequestException) as e:  # Also Gitea unreachable or refused by the breaker
+            return False, 0, [(number, f'{org}: {e}') for number, _ in batch]
+        failed = {r['value'].lower() for r in results if r['status'] >= 400}
+        return created, len(names) - len(failed), [(number, f'{org}: could not add {name}') for number, name in batch if name.lower() in failed]
+
+    def _member_pass(self):
+        # Batches per org are flushed when full; at every checkpoint all of them are
+        # flushed and awaited, so the saved line never runs ahead of a pending add.
+        batches = {}
+        running = []
+        since_checkpoint = 0
+
+        def flush(org):
+            batch = batches.pop(org.lower(), None)
+            if batch:
+                running.append(pool.submit(self._add_members, batch[0], batch[1]))
+
+        def settle_all():
+            for future in running:
+                created, added, failed = future.result()
+                self.checkpoint.counts['created'] += created
+                self.checkpoint.counts['members'] += added
+                for number, detail in failed:
+                    self._fail(number, detail)
+            running.clear()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for number, resource in self._rows():
+                if resource is not None:
+                    for org, name in memberships(resource):
+                        org_batch = batches.setdefault(org.lower(), (org, []))
+                        org_batch[1].append((number, name))
+                        if len(org_batch[1]) >= self.batch_size:
+                            flush(org)
+                    self.done += 1
+                since_checkpoint += 1
+                if since_checkpoint >= self.checkpoint_every:
+                    for org in list(batches):
+                        flush(org)
+                    settle_all()
+                    self.checkpoint.line = number
+                    self.checkpoint.save()
+                    since_checkpoint = 0
+                self._report()
+            for org in list(batches):
+                flush(org)
+            settle_all()
+
+    def _rows(self):
+        """Input rows past the checkpoint. Unreadable rows are recorded as failures (in the first pass) and come back as None."""
+        for number, resource, error in read_rows(self.source):
+            if number <= self.checkpoint.line:
+                continue
+            if error is not None and self.checkpoint.phase == 'create':
+                self._fail(number, f'unreadable row: {error}')
+            yield number, resource
@@ -0,0 +1,340 @@
+import json
+import random
+import sqlite3
+import threading
+import time
+
+import requests
+
+import settings
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ops (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    idempotency_key TEXT UNIQUE,
+    kind TEXT NOT NULL,
+    resource TEXT NOT NULL COLLATE NOCASE,
+    action TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    error_status INTEGER,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ops_status ON ops (status, next_attempt);
+CREATE INDEX IF NOT EXISTS ops_resource ON ops (kind, resource, seq);
+"""
+
+COLUMNS = 'seq, idempotency_key, kind, resource, action, payload, status, attempts, next_attempt, result, error, error_status, created'
+OPEN = ('pending', 'running')
+RETRYABLE_STATUSES = frozenset([408, 429, 500, 502, 503, 504])
+
+
+class RetryableError(Exception):
+    """Gitea couldn't take the write right now. `payload`/`result` carry what is left to do and what already landed."""
+
+    def __init__(self, detail, status=None, payload=None, result=None) -> None:
+        super().__init__(detail)
+        self.status = status
+        self.payload = payload
+        self.result = result
+
+
+class PermanentError(Exception):
+    """Gitea rejected the write; retrying won't help."""
+
+    def __init__(self, detail, status=None) -> None:
+        super().__init__(detail)
+        self.status = status
+
+
+class JournalEntry:
+    def __init__(self, row) -> None:
+        (self.seq, self.idempotency_key, self.kind, self.resource, self.action, payload, self.status,
+         self.attempts, self.next_attempt, result, self.error, self.error_status, self.created) = row
+        self.payload = json.loads(payload)
+        self.result = json.loads(result) if result is not None else None
+
+    @property
+    def open(self):
+        return self.status in OPEN
+
+    @property
+    def failed(self):
+        return self.status == 'failed'
+
+    def __repr__(self):
+        return f'JournalEntry({self.seq}, {self.kind}:{self.resource} {self.action} {self.status})'
+
+
+def _check(entry, response, ok, landed=()):
+    """
+    Classify a Gitea response for an entry.
+
+    `landed` are statuses that, on a retry, mean an earlier attempt already
+    went through before its response was lost (e.g. 422 on create, 404 on delete).
+    """
+    status = response.status_code
+    if status in ok or (entry.attempts > 1 and status in landed):
+        return status
+    detail = f'Gitea answered {status}: {response.text[:200]}'
+    if status in RETRYABLE_STATUSES:
+        raise RetryableError(detail, status)
+    raise PermanentError(detail, status)
+
+
+def _apply_create_user(api, entry, journal):
+    return _check(entry, api.create_user(**entry.payload), (201,), (422,))
+
+
+def _apply_edit_user(api, entry, journal):
+    return _check(entry, api.edit_user(entry.resource, **entry.payload['fields']), (200,))
+
+
+def _apply_delete_user(api, entry, journal):
+    return _check(entry, api.delete_user(entry.resource), (204,), (404,))
+
+
+def _apply_create_org(api, entry, journal):
+    return _check(entry, api.create_org(**entry.payload), (201,), (422,))  # Default team comes with the first member add
+
+
+def _apply_edit_org(api, entry, journal):
+    return _check(entry, api.edit_org(entry.resource, **entry.payload['fields']), (200,))
+
+
+def _apply_update_members(api, entry, journal):
+    results = api.scim_update_org_members(entry.resource, add=entry.payload.get('add', []), remove=entry.payload.get('remove', []))
+
+    def retry(result):
+        if result['status'] in RETRYABLE_STATUSES:
+            return True
+        # Adding a user whose own create is still queued, wait for it rather than fail
+        return result['op'] == 'add' and result['status'] == 404 and bool(journal.pending('user', result['value']))
+
+    done = (entry.result or []) + [r for r in results if not retry(r)]
+    left = [r for r in results if retry(r)]
+    if left:
+        payload = {
+            'add': [r['value'] for r in left if r['op'] == 'add'],
+            'remove': [r['value'] for r in left if r['op'] == 'remove'],
+        }
+        raise RetryableError(f'{len(left)} membership change(s) not applied yet', payload=payload, result=done)
+    return done
+
+
+ACTIONS = {
+    'create_user': _apply_create_user,
+    'edit_user': _apply_edit_user,
+    'delete_user': _apply_delete_user,
+    'create_org': _apply_create_org,
+    'edit_org': _apply_edit_org,
+    'update_members': _apply_update_members,
+}
+
+
+def fold(entry, payload):
+    """Apply a not-yet-applied entry to a Gitea user/org payload (None when absent), for read-your-writes."""
+    if entry.action == 'create_user':
+        p = entry.payload
+        return {
+            'username': p['username'], 'login_name': p.get('login_name'), 'email': p.get('email'), 'full_name': p.get('full_name'),
+            'visibility': p.get('visibility'), 'source_id': p.get('source_id'), 'active': True,
+        }
+    if entry.action == 'create_org':
+        return {key: entry.payload.get(key) for key in ('username', 'full_name', 'description', 'visibility', 'location', 'website')}
+    if entry.action in ('edit_user', 'edit_org'):
+        return {**payload, **entry.payload['fields']} if payload is not None else None
+    if entry.action == 'delete_user':
+        return None
+    return payload
+
+
+class WriteJournal:
+    """
+    Durable queue of SCIM mutations in front of Gitea.
+
+    Handlers append entries and return; a worker pool applies them in order
+    per resource, retrying with backoff while Gitea is slow or down. An entry
+    with the same Idempotency-Key, or identical to the newest queued entry for
+    its resource, is returned instead of queued twice. pending() lets reads
+    fold queued writes over what Gitea still reports.
+    """
+
+    def __init__(self, path=None, recover=True) -> None:
+        self.path = path or settings.JOURNAL_PATH
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._changed = threading.Condition()
+        self._stopping = threading.Event()
+        self._workers = []
+        self._last_prune = 0
+        with self._write_lock, self._conn() as conn:
+            conn.executescript(SCHEMA)
+            if recover:  # Only the process that will apply the journal, others may be mid-write
+                # Entries a previous process was applying when it died go back in the queue
+                conn.execute("UPDATE ops SET status = 'pending' WHERE status = 'running'")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=FULL')  # An acknowledged write must survive a crash
+            self._local.conn = conn
+        return conn
+
+    def _notify(self):
+        with self._changed:
+            self._changed.notify_all()
+
+    # Producers
+
+    def submit(self, kind: str, resource: str, action: str, payload: dict, idempotency_key=None):
+        encoded = json.dumps(payload, sort_keys=True)
+        with self._write_lock, self._conn() as conn:
+            replay = self.get_by_key(idempotency_key)
+            if replay:
+                return replay
+            row = conn.execute(
+                f"SELECT {COLUMNS} FROM ops WHERE kind = ? AND resource = ? AND status IN ('pending', 'running') ORDER BY seq DESC LIMIT 1",
+                (kind, resource),
+            ).fetchone()
+            if row and row[4] == action and row[5] == encoded and row[1] is None:  # A client retry of a write still queued
+                return JournalEntry(row)
+            now = time.time()
+            cursor = conn.execute(
+                'INSERT INTO ops (idempotency_key, kind, resource, action, payload, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (idempotency_key, kind, resource, action, encoded, now, now),
+            )
+            row = conn.execute(f'SELECT {COLUMNS} FROM ops WHERE seq = ?', (cursor.lastrowid,)).fetchone()
+        self._notify()
+        return JournalEntry(row)
+
+    def get_by_key(self, idempotency_key):
+        if idempotency_key:
+            row = self._conn().execute(f'SELECT {COLUMNS} FROM ops WHERE idempotency_key = ?', (idempotency_key,)).fetchone()
+            return JournalEntry(row) if row else None
+
+    def get(self, seq: int):
+        row = self._conn().execute(f'SELECT {COLUMNS} FROM ops WHERE seq = ?', (seq,)).fetchone()
+        return JournalEntry(row) if row else None
+
+    def wait(self, entry, timeout=None):
+        """Block until the entry is applied or failed, or `timeout` seconds pass. Returns its latest state."""
+        deadline = time.monotonic() + (settings.JOURNAL_ACK_TIMEOUT if timeout is None else timeout)
+        while True:
+            entry = self.get(entry.seq)
+            remaining = deadline - time.monotonic()
+            if not entry.open or remaining <= 0:
+                return entry
+            with self._changed:
+                self._changed.wait(min(remaining, 0.5))
+
+    def pending(self, kind: str, resource: str):
+        rows = self._conn().execute(
+            f"SELECT {COLUMNS} FROM ops WHERE kind = ? AND resource = ? AND status IN ('pending', 'running') ORDER BY seq",
+            (kind, resource),
+        ).fetchall()
+        return [JournalEntry(row) for row in rows]
+
+    def stats(self):
+        conn = self._conn()
+        counts = dict(conn.execute('SELECT status, COUNT(*) FROM ops GROUP BY status').fetchall())
+        oldest = conn.execute("SELECT MIN(created) FROM ops WHERE status IN ('pending', 'running')").fetchone()[0]
+        return {
+            'pending': counts.get('pending', 0),
+            'running': counts.get('running', 0),
+            'done': counts.get('done', 0),
+            'failed': counts.get('failed', 0),
+            'oldest_pending_age': time.time() - oldest if oldest else 0,
+        }
+
+    # Workers
+
+    def _claim(self):
+        """Take the oldest due entry whose resource has nothing earlier still open."""
+        with self._write_lock, self._conn() as conn:
+            row = conn.execute(
+                f"""SELECT {COLUMNS} FROM ops o WHERE o.status = 'pending' AND o.next_attempt <= ?
+                AND NOT EXISTS (
+                    SELECT 1 FROM ops p WHERE p.kind = o.kind AND p.resource = o.resource AND p.seq < o.seq AND p.status IN ('pending', 'running')
+                )
+                ORDER BY o.seq LIMIT 1""",
+                (time.time(),),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE ops SET status = 'running', attempts = attempts + 1, updated = ? WHERE seq = ?", (time.time(), row[0]))
+        entry = JournalEntry(row)
+        entry.status = 'running'
+        entry.attempts += 1
+        return entry
+
+    def _finish(self, entry, status, result=None, error=None, error_status=None, payload=None, next_attempt=0):
+        if status not in OPEN and 'password' in entry.payload:  # Don't keep credentials around once they're no longer needed
+            payload = {key: value for key, value in entry.payload.items() if key != 'password'}
+        with self._write_lock, self._conn() as conn:
+            conn.execute(
+                'UPDATE ops SET status = ?, result = ?, error = ?, error_status = ?, payload = COALESCE(?, payload), next_attempt = ?, updated = ? WHERE seq = ?',
+                (
+                    status, json.dumps(result) if result is not None else None, error, error_status,
+                    json.dumps(payload, sort_keys=True) if payload is not None else None, next_attempt, time.time(), entry.seq,
+                ),
+            )
+        self._notify()
+
+    def _run(self, entry):
+        try:
+            result = ACTIONS[entry.action](self.api, entry, self)
+        except (RetryableError, requests.RequestException) as e:
+            status = getattr(e, 'status', None)
+            if entry.attempts >= settings.JOURNAL_MAX_ATTEMPTS:
+                self._finish(entry, 'failed', getattr(e, 'result', None), str(e), status)
+            else:
+                backoff = random.uniform(0, min(settings.JOURNAL_MAX_BACKOFF, settings.JOURNAL_BACKOFF_BASE * 2 ** entry.attempts))
+                self._finish(entry, 'pending', getattr(e, 'result', None), str(e), status, getattr(e, 'payload', None), time.time() + backoff)
+        except PermanentError as e:
+            self._finish(entry, 'failed', error=str(e), error_status=e.status)
+        except Exception as e:
+            self._finish(entry, 'failed', error=f'{type(e).__name__}: {e}')
+        else:
+            self._finish(entry, 'done', result)
+
+    def _work(self):
+        while not self._stopping.is_set():
+            entry = self._claim()
+            if entry is not None:
+                self._run(entry)
+                continue
+            if time.time() - self._last_prune > 60:
+                self.prune()
+            with self._changed:
+                self._changed.wait(0.5)
+
+    def prune(self, retention=None):
+        """Drop finished entries (and with them their idempotency keys) older than `retention` seconds."""
+        self._last_prune = time.time()
+        cutoff = time.time() - (settings.JOURNAL_RETENTION if retention is None else retention)
+        with self._write_lock, self._conn() as conn:
+            conn.execute("DELETE FROM ops WHERE status IN ('done', 'failed') AND updated < ?", (cutoff,))
+
+    def start(self, api, workers=None):
+        """Apply queued entries against `api` (a GiteaSCIMWrapper) on `workers` daemon threads."""
+        self.api = api
+        self._stopping.clear()
+        for i in range(workers or settings.JOURNAL_WORKERS):
+            worker = threading.Thread(target=self._work, name=f'write-journal-{i}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        self._stopping.set()
+        self._notify()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
@@ -1,13 +1,116 @@
-# from flask_script import Manager
-# from flask_migrate import Migrate, MigrateCommand
-from database import db
-from app import app
-
-# # migrate = Migrate(app, db)
-# manager = Manager(app)
-
-# # manager.add_command("db", MigrateCommand)
-
-
-# if __name__ == "__main__":
-#     manager.run()
+"""
+Maintenance commands.
+
+    python manage.py reconcile SNAPSHOT [--dry-run] [--deactivate-missing] [--workers 8] [--verbose]
+    python manage.py import FILE [--checkpoint FILE.checkpoint] [--restart] [--workers 16]
+
+`reconcile` brings Gitea in line with a SCIM snapshot of the directory
+(JSON or JSONL, see reconcile.load_snapshot): it creates missing users and
+groups, edits changed attributes and fixes group memberships, applying
+only the difference. --deactivate-missing also deactivates users absent
+from the snapshot; it is refused for a snapshot without Users. --dry-run
+prints the plan and its estimated Gitea call count instead.
+
+`import` onboards a tenant from JSONL or CSV (see importer.read_rows):
+every user and org is created, then the memberships are added. Progress
+is checkpointed, running the same command again after an interruption
+resumes where it stopped. Failed rows go to FILE.failed.jsonl.
+"""
+import argparse
+import json
+import os
+import sys
+
+import importer
+import reconcile
+import settings
+from gitea import BASE_URL, TOKEN, GiteaSCIMWrapper
+from store import ShadowStore
+
+
+def command_reconcile(args):
+    settings.RECONCILE_WORKERS = args.workers
+    store = ShadowStore(settings.SHADOW_STORE_PATH) if settings.SHADOW_STORE_PATH else None  # Written through, not synced
+    G = GiteaSCIMWrapper(BASE_URL, TOKEN, store=store)
+
+    users, groups = reconcile.load_snapshot(args.snapshot)
+    print(f'Snapshot: {len(users)} users, {len(groups)} groups', file=sys.stderr)
+    try:
+        plan = reconcile.plan(G, users, groups, deactivate_missing=args.deactivate_missing)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    if args.dry_run or args.verbose:
+        for change in plan.changes:
+            print(f'  {change.describe()}', file=sys.stderr)
+    print(json.dumps(plan.summary(), indent=2))
+    if args.dry_run or not plan.changes:
+        return 0
+
+    def progress(change):
+        if args.verbose or change.status == 'failed':
+            print(f'  {change.status:<6} {change.describe()}{": " + change.error if change.error else ""}', file=sys.stderr)
+
+    failed = reconcile.apply(G, plan, workers=args.workers, progress=progress)
+    print(f'Applied {len(plan.changes) - len(failed)} of {len(plan.changes)} changes, {len(failed)} failed', file=sys.stderr)
+    return 1 if failed else 0
+
+
+def command_import(args):
+    checkpoint_path = args.checkpoint or f'{args.file}.checkpoint'
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    try:
+        checkpoint = importer.Checkpoint.load(checkpoint_path, args.file)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    if checkpoint.phase == 'done':
+        print(f'{args.file} was already imported, pass --restart to import it again', file=sys.stderr)
+        return 0
+    if checkpoint.line or checkpoint.phase != 'create':
+        print(f'Resuming the {checkpoint.phase} pass after line {checkpoint.line}', file=sys.stderr)
+
+    store = ShadowStore(settings.SHADOW_STORE_PATH) if settings.SHADOW_STORE_PATH else None
+    G = GiteaSCIMWrapper(BASE_URL, TOKEN, store=store)
+    with open(f'{args.file}.failed.jsonl', 'a', encoding='utf-8') as failures:
+        run = importer.Importer(
+            G, args.file, checkpoint, workers=args.workers, batch_size=args.batch, checkpoint_every=args.checkpoint_every,
+            failures=failures, progress=importer.Progress(),
+        )
+        try:
+            counts = run.run()
+        except KeyboardInterrupt:  # run() saved the checkpoint
+            print(f'\nInterrupted, resume with the same command (checkpoint {checkpoint_path})', file=sys.stderr)
+            return 130
+    print(json.dumps(counts, indent=2))
+    return 1 if counts['failed'] else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    reconcile_parser = commands.add_parser('reconcile', help='apply the difference between a directory snapshot and Gitea')
+    reconcile_parser.add_argument('snapshot', help='SCIM Users and Groups as JSON or JSONL')
+    reconcile_parser.add_argument('--dry-run', action='store_true', help='print the plan without writing to Gitea')
+    reconcile_parser.add_argument('--deactivate-missing', action='store_true', help='deactivate users absent from the snapshot')
+    reconcile_parser.add_argument('--workers', type=int, default=settings.RECONCILE_WORKERS)
+    reconcile_parser.add_argument('--verbose', action='store_true', help='print every change')
+    reconcile_parser.set_defaults(func=command_reconcile)
+
+    import_parser = commands.add_parser('import', help='create users, orgs and memberships from JSONL or CSV, resumably')
+    import_parser.add_argument('file', help='SCIM resources as JSONL, or CSV with userName/displayName columns')
+    import_parser.add_argument('--checkpoint', help='checkpoint file, FILE.checkpoint by default')
+    import_parser.add_argument('--restart', action='store_true', help='discard the checkpoint and start over')
+    import_parser.add_argument('--workers', type=int, default=settings.IMPORT_WORKERS)
+    import_parser.add_argument('--batch', type=int, default=settings.IMPORT_MEMBER_BATCH, help='members per org in one batch')
+    import_parser.add_argument('--checkpoint-every', type=int, default=settings.IMPORT_CHECKPOINT_EVERY, help='input lines')
+    import_parser.set_defaults(func=command_import)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == '__main__':
+    main()
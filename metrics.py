@@ -0,0 +1,246 @@
+import threading
+import time
+from bisect import bisect_left
+
+import settings
+import tracing
+
+# Seconds, upper bounds for SCIM routes and Gitea calls alike
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _Sharded:
+    """
+    Per-thread storage for one metric family.
+
+    Each thread writes only to its own dict of label tuple -> list, so the hot
+    path takes no lock. A scrape sums the shards; shards of threads that have
+    exited are folded into `_retired` so thread-per-request servers don't grow
+    the list forever.
+    """
+
+    def __init__(self, name: str, help: str, labels) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []  # (thread, shard)
+        self._retired = {}
+
+    def _new_series(self):
+        raise NotImplementedError
+
+    def _merge(self, into: dict, shard: dict):
+        for key, series in list(shard.items()):
+            total = into.get(key)
+            if total is None:
+                into[key] = list(series)
+            else:
+                for i, value in enumerate(series):
+                    total[i] += value
+
+    def _series(self, labels):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+        series = shard.get(labels)
+        if series is None:
+            series = shard[labels] = self._new_series()
+        return series
+
+    def collect(self):
+        """Totals per label tuple across every thread."""
+        with self._lock:
+            alive = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self._merge(self._retired, shard)
+            self._shards = alive
+            totals = {}
+            self._merge(totals, self._retired)
+            for _, shard in alive:
+                self._merge(totals, shard)
+        return totals
+
+
+class Counter(_Sharded):
+    kind = 'counter'
+
+    def _new_series(self):
+        return [0]
+
+    def inc(self, *labels, amount=1):
+        self._series(labels)[0] += amount
+
+    def samples(self):
+        for labels, (value,) in self.collect().items():
+            yield self.name, labels, value
+
+
+class Gauge(Counter):
+    """Up/down gauge. inc() and dec() for one unit of work must run on the same thread."""
+
+    kind = 'gauge'
+
+    def dec(self, *labels):
+        self._series(labels)[0] -= 1
+
+
+class Histogram(_Sharded):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels, buckets=DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def _new_series(self):
+        # One slot per bucket plus +Inf, then the running sum
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, value: float, *labels):
+        series = self._series(labels)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        bounds = [_number(b) for b in self.buckets] + ['+Inf']
+        for labels, series in self.collect().items():
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                yield f'{self.name}_bucket', labels + (('le', bound),), cumulative
+            yield f'{self.name}_count', labels, cumulative
+            yield f'{self.name}_sum', labels, series[-1]
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Registry:
+    """Metric families plus collectors that read stats() of other components at scrape time."""
+
+    def __init__(self) -> None:
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collect):
+        """`collect()` yields (name, kind, help, [(labels dict, value), ...]) at every scrape."""
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        """Prometheus text exposition format 0.0.4."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, values, value in metric.samples():
+                pairs = list(zip(metric.labels, values[:len(metric.labels)])) + list(values[len(metric.labels):])
+                lines.append(_sample(name, pairs, value))
+        for collect in self._collectors:
+            for name, kind, help, samples in collect():
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    lines.append(_sample(name, labels.items(), value))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def _sample(name, pairs, value):
+    labels = ','.join(f'{key}="{_escape(label)}"' for key, label in pairs)
+    return f'{name}{{{labels}}} {_number(value)}' if labels else f'{name} {_number(value)}'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REGISTRY = Registry()
+
+scim_requests = REGISTRY.histogram('scim_request_duration_seconds', 'SCIM request latency by route and status.', ('method', 'route', 'status'))
+scim_in_flight = REGISTRY.gauge('scim_requests_in_flight', 'SCIM requests being served.')
+gitea_calls = REGISTRY.histogram('gitea_call_duration_seconds', 'Gitea API call latency by client method and upstream status.', ('call', 'http_method', 'status'))
+gitea_errors = REGISTRY.counter('gitea_call_errors_total', 'Gitea API calls that raised instead of answering.', ('call', 'error'))
+gitea_in_flight = REGISTRY.gauge('gitea_calls_in_flight', 'Gitea API calls waiting on the upstream.')
+scim_fanout = REGISTRY.counter('scim_fanout_requests_total', 'SCIM requests flagged for making too many Gitea calls for their payload.', ('method', 'route'))
+
+
+class timed_call:
+    """
+    Time one Gitea call: `with metrics.timed_call(name, method, path) as call: call.response = ...`.
+
+    The upstream status comes from `response`; exceptions are counted as
+    errors. The call is also added to the current request's trace.
+    """
+
+    __slots__ = ('name', 'method', 'path', 'page', 'response', '_started')
+
+    def __init__(self, name: str, method: str, path: str, page=None) -> None:
+        self.name = name
+        self.method = method
+        self.path = path
+        self.page = page
+        self.response = None
+
+    def __enter__(self):
+        if settings.METRICS_ENABLED:
+            gitea_in_flight.inc()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self._started
+        if exc_type is not None:
+            status = 'error'
+        else:
+            status = str(self.response.status_code) if self.response is not None else 'none'
+        tracing.record(self.name, self.method, self.path, status, elapsed, self.page)
+        if not settings.METRICS_ENABLED:
+            return
+        gitea_in_flight.dec()
+        if exc_type is not None:
+            gitea_errors.inc(self.name, exc_type.__name__)
+        gitea_calls.observe(elapsed, self.name, self.method, status)
+
+
+def register_stats(prefix: str, stats, help: dict, kinds=None):
+    """
+    Export the numeric values of a component's `stats()` dict, e.g. cache hit
+    ratio or journal backlog. `help` maps key -> description and picks which
+    keys are exported; they are gauges unless `kinds` says otherwise.
+    """
+    kinds = kinds or {}
+
+    def collect():
+        values = stats()
+        if not values:
+            return
+        for key, description in help.items():
+            value = values.get(key)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield f'{prefix}_{key}', kinds.get(key, 'gauge'), description, [({}, value)]
+
+    REGISTRY.register_collector(collect)
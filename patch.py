@@ -0,0 +1,284 @@
+import copy
+
+import filters
+
+USER_EXTENSION = 'urn:ietf:params:scim:schemas:extension:Gitea:2.0:User'
+GROUP_EXTENSION = 'urn:ietf:params:scim:schemas:extension:Gitea:2.0:Group'
+
+SKIP = object()  # Coerced value meaning "no change can be sent to Gitea for this"
+
+
+class PatchError(ValueError):
+    """Raised for PATCH requests that can't be applied; maps to SCIM 400 with `scim_type`."""
+
+    def __init__(self, detail, scim_type='invalidPath') -> None:
+        super().__init__(detail)
+        self.scim_type = scim_type
+
+
+def _key(mapping: dict, name: str):
+    lowered = name.lower()
+    for key in mapping:
+        if key.lower() == lowered:
+            return key
+    return name
+
+
+def _split(resource: dict, path: str):
+    """Resolve a PATCH path to (parent dict, attribute, value filter, sub-attribute)."""
+    parent = resource
+    if path.lower().startswith('urn:'):
+        for key in sorted(resource, key=len, reverse=True):
+            if path.lower() == key.lower():
+                return resource, key, None, None
+            if path.lower().startswith(key.lower() + ':') and isinstance(resource[key], dict):
+                parent, path = resource[key], path[len(key) + 1:]
+                break
+        else:
+            raise PatchError(f'Unknown schema in path {path!r}')
+    if '[' in path:
+        try:
+            node = filters.parse(path)
+        except filters.FilterError as e:
+            raise PatchError(f'Invalid path {path!r}: {e}')
+        if not isinstance(node, filters.ValuePath):
+            raise PatchError(f'Invalid path {path!r}')
+        return parent, _key(parent, node.attr), node.filter, node.sub_attr
+    attr, _, sub = path.partition('.')
+    return parent, _key(parent, attr), None, sub or None
+
+
+def _same_item(a, b):
+    if isinstance(a, dict) and isinstance(b, dict) and 'value' in a and 'value' in b:
+        return str(a['value']).lower() == str(b['value']).lower()
+    return a == b
+
+
+def _seed(node):
+    """Attributes a new multi-valued entry gets from an `eq` filter, e.g. emails[type eq "work"]."""
+    if isinstance(node, filters.Compare) and node.op == 'eq':
+        return {node.attr: node.value}
+    if isinstance(node, filters.And):
+        left, right = _seed(node.left), _seed(node.right)
+        if left is not None and right is not None:
+            return {**left, **right}
+    return None
+
+
+def _apply_filtered(op, items, node, sub, value, path):
+    matched = [item for item in items if isinstance(item, dict) and filters.matches(node, item)]
+    if op == 'remove':
+        if sub:
+            for item in matched:
+                item.pop(_key(item, sub), None)
+            return items
+        return [item for item in items if not any(item is m for m in matched)]
+    if not matched:
+        seed = _seed(node)
+        if seed is None:
+            raise PatchError(f'No value matches {path!r}', 'noTarget')
+        entry = {**seed, sub: value} if sub else {**seed, **(value if isinstance(value, dict) else {})}
+        return items + [entry]
+    for item in matched:
+        if sub:
+            item[_key(item, sub)] = value
+        elif isinstance(value, dict):
+            item.update(value)
+    return items
+
+
+def _apply_one(resource: dict, op: str, path: str, value):
+    parent, attr, node, sub = _split(resource, path)
+    current = parent.get(attr)
+    if node is not None:
+        if not isinstance(current, list):
+            if op == 'remove':
+                return
+            current = []
+        parent[attr] = _apply_filtered(op, current, node, sub, value, path)
+        return
+    if sub:
+        if op == 'remove':
+            if isinstance(current, dict):
+                current.pop(_key(current, sub), None)
+            return
+        if not isinstance(current, dict):
+            current = parent[attr] = {}
+        current[_key(current, sub)] = value
+        return
+    if op == 'remove':
+        if isinstance(current, list) and value is not None:  # Remove only the listed values (how Azure AD drops members)
+            values = value if isinstance(value, list) else [value]
+            parent[attr] = [item for item in current if not any(_same_item(item, v) for v in values)]
+        else:
+            parent.pop(attr, None)
+        return
+    if isinstance(current, list) and op == 'add':
+        values = value if isinstance(value, list) else [value]
+        parent[attr] = current + [v for v in values if not any(_same_item(item, v) for item in current)]
+    elif isinstance(current, dict) and isinstance(value, dict):
+        current.update(value)
+    else:
+        parent[attr] = value
+
+
+def apply(resource: dict, operations):
+    """
+    Apply SCIM PATCH operations (RFC 7644 section 3.5.2) to a copy of a
+    serialized resource and return the copy. Raises PatchError.
+    """
+    resource = copy.deepcopy(resource)
+    if not isinstance(operations, list):
+        raise PatchError('Operations must be a list', 'invalidSyntax')
+    for operation in operations:
+        op = str(operation.get('op', '')).lower()
+        if op not in ('add', 'replace', 'remove'):
+            raise PatchError(f'Unsupported op {operation.get("op")!r}', 'invalidSyntax')
+        path = operation.get('path')
+        value = operation.get('value')
+        if path:
+            _apply_one(resource, op, path, value)
+        elif op == 'remove':
+            raise PatchError('remove requires a path', 'noTarget')
+        elif isinstance(value, dict):  # No path, the value holds attribute -> value pairs
+            for attr, attr_value in value.items():
+                schema = _key(resource, attr)
+                if attr.lower().startswith('urn:') and isinstance(attr_value, dict) and isinstance(resource.get(schema), dict):
+                    for sub_attr, sub_value in attr_value.items():
+                        _apply_one(resource, op, f'{schema}:{sub_attr}', sub_value)
+                else:
+                    _apply_one(resource, op, attr, attr_value)
+        else:
+            raise PatchError('An operation without a path needs an object value', 'invalidValue')
+    return resource
+
+
+# Gitea field <- SCIM attribute table. Each row is (Gitea field, getter over a
+# serialized resource, coerce to what Gitea expects or SKIP when unsendable).
+
+def _text(value):
+    return '' if value is None else str(value)
+
+
+def _required(value):
+    return SKIP if value in (None, '') else value
+
+
+def _bool(value):
+    if isinstance(value, str):
+        return {'true': True, 'false': False}.get(value.lower(), SKIP)
+    return SKIP if value is None else bool(value)
+
+
+def _extension(schema, attr):
+    def get(resource):
+        extension = resource.get(_key(resource, schema)) or {}
+        return extension.get(_key(extension, attr))
+    return get
+
+
+def primary_email(resource):
+    emails = resource.get(_key(resource, 'emails')) or []
+    entries = [e for e in emails if isinstance(e, dict)]
+    for entry in entries:
+        if entry.get('primary') is True or str(entry.get('primary')).lower() == 'true':
+            return entry.get('value')
+    for entry in entries:
+        if entry.get('type') == 'work':
+            return entry.get('value')
+    return entries[0].get('value') if entries else None
+
+
+USER_FIELDS = (
+    ('email', primary_email, _required),
+    ('description', lambda r: r.get('description'), _text),
+    ('active', lambda r: r.get('active'), _bool),
+    ('full_name', _extension(USER_EXTENSION, 'full_name'), _text),
+    ('visibility', _extension(USER_EXTENSION, 'visibility'), _required),
+    ('location', _extension(USER_EXTENSION, 'location'), _text),
+)
+
+GROUP_FIELDS = (
+    ('description', lambda r: r.get('description'), _text),
+    ('full_name', _extension(GROUP_EXTENSION, 'full_name'), _text),
+    ('visibility', _extension(GROUP_EXTENSION, 'visibility'), _required),
+    ('location', _extension(GROUP_EXTENSION, 'location'), _text),
+)
+
+
+def diff(fields, current: dict, patched: dict):
+    """The Gitea fields whose value differs between two serialized resources."""
+    delta = {}
+    for field, get, coerce in fields:
+        new = coerce(get(patched))
+        if new is not SKIP and new != coerce(get(current)):
+            delta[field] = new
+    return delta
+
+
+def member_changes(current: dict, patched: dict):
+    """(add, remove) member names between two serialized Groups."""
+    def values(resource):
+        return {str(m['value']).lower(): m['value'] for m in resource.get('members') or [] if isinstance(m, dict) and m.get('value')}
+
+    before, after = values(current), values(patched)
+    return [after[k] for k in after if k not in before], [before[k] for k in before if k not in after]
+
+
+def _named_values(value):
+    values = value if isinstance(value, list) else [value]
+    return [str(v['value']) for v in values if isinstance(v, dict) and v.get('value') not in (None, '')]
+
+
+def member_operations(operations):
+    """
+    Split a Group PATCH into (add, remove, other operations) when every
+    member change names its members: add/remove with a list of {"value"}
+    or remove with a members[value eq "..."] path. None when one needs the
+    current member list, e.g. a replace of members or a remove of all.
+    """
+    if not isinstance(operations, list):
+        raise PatchError('Operations must be a list', 'invalidSyntax')
+    changes = {}  # lowercase name -> (name, 'add' | 'remove'), later operations win
+    rest = []
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise PatchError('Each operation must be an object', 'invalidSyntax')
+        op = str(operation.get('op', '')).lower()
+        path = operation.get('path')
+        value = operation.get('value')
+        if path:
+            attr = path.split('[', 1)[0].split('.', 1)[0]
+            if attr.lower() != 'members':
+                rest.append(operation)
+                continue
+            if '[' in path:
+                try:
+                    node = filters.parse(path)
+                except filters.FilterError as e:
+                    raise PatchError(f'Invalid path {path!r}: {e}')
+                if not isinstance(node, filters.ValuePath) or node.sub_attr or op != 'remove':
+                    return None
+                target = node.filter
+                if not (isinstance(target, filters.Compare) and target.op == 'eq' and target.attr.lower() == 'value'):
+                    return None
+                names = [str(target.value)]
+            elif op in ('add', 'remove') and value is not None:
+                names = _named_values(value)
+            else:
+                return None
+        elif isinstance(value, dict) and _key(value, 'members') in value:
+            if op != 'add':
+                return None
+            names = _named_values(value[_key(value, 'members')])
+            others = {k: v for k, v in value.items() if k != _key(value, 'members')}
+            if others:
+                rest.append({**operation, 'value': others})
+        else:
+            rest.append(operation)
+            continue
+        for name in names:
+            changes[name.lower()] = (name, op)
+    add = [name for name, op in changes.values() if op == 'add']
+    remove = [name for name, op in changes.values() if op == 'remove']
+    return add, remove, rest
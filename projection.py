@@ -0,0 +1,98 @@
+ALWAYS_RETURNED = frozenset(['id', 'schemas'])
+
+
+def _split_path(resource: dict, path: str):
+    """Split an attribute path into (top-level key, sub-attribute or None) for a resource."""
+    lowered = path.lower()
+    if lowered.startswith('urn:'):
+        for key in sorted(resource, key=len, reverse=True):
+            if lowered == key.lower():
+                return key, None
+            if lowered.startswith(key.lower() + ':'):
+                return key, path[len(key) + 1:]
+        return None, None
+    top, _, sub = path.partition('.')
+    for key in resource:
+        if key.lower() == top.lower():
+            return key, sub or None
+    return None, None
+
+
+def _pick(value, sub: str):
+    if isinstance(value, list):
+        return [_pick(v, sub) for v in value]
+    if isinstance(value, dict):
+        return {k: v for k, v in value.items() if k.lower() == sub.lower()}
+    return value
+
+
+def _drop(value, sub: str):
+    if isinstance(value, list):
+        return [_drop(v, sub) for v in value]
+    if isinstance(value, dict):
+        return {k: v for k, v in value.items() if k.lower() != sub.lower()}
+    return value
+
+
+class Projection:
+    """
+    SCIM attributes/excludedAttributes (RFC 7644 section 3.4.2.5).
+
+    apply() prunes serialized resources; needs() tells the fetch path which
+    expensive attributes (e.g. Group members) it can skip loading at all.
+    """
+
+    def __init__(self, attributes=None, excluded=None) -> None:
+        self.attributes = [a.strip() for a in (attributes or []) if a.strip()]
+        self.excluded = [a.strip() for a in (excluded or []) if a.strip()]
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            attributes=args.get('attributes', '').split(','),
+            excluded=args.get('excludedAttributes', '').split(','),
+        )
+
+    def __bool__(self):
+        return bool(self.attributes or self.excluded)
+
+    def needs(self, attr: str) -> bool:
+        attr = attr.lower()
+
+        def covers(path):
+            path = path.lower()
+            return path == attr or path.startswith(attr + '.') or path.endswith(':' + attr) or (':' + attr + '.') in path
+
+        if self.attributes:
+            return any(covers(a) for a in self.attributes)
+        return not any(a.lower() == attr for a in self.excluded)
+
+    def apply(self, resource):
+        if not resource or not self:
+            return resource
+        if self.attributes:
+            projected = {key: resource[key] for key in resource if key in ALWAYS_RETURNED}
+            for path in self.attributes:
+                key, sub = _split_path(resource, path)
+                if key is None:
+                    continue
+                if sub is None:
+                    projected[key] = resource[key]
+                elif key not in projected or projected[key] is not resource[key]:
+                    picked = _pick(resource[key], sub)
+                    if isinstance(picked, dict) and isinstance(projected.get(key), dict):
+                        projected[key] = {**projected[key], **picked}
+                    elif isinstance(picked, list) and isinstance(projected.get(key), list):
+                        projected[key] = [{**a, **b} for a, b in zip(projected[key], picked)]
+                    else:
+                        projected[key] = picked
+            resource = projected
+        for path in self.excluded:
+            key, sub = _split_path(resource, path)
+            if key is None or key in ALWAYS_RETURNED:
+                continue
+            if sub is None:
+                resource = {k: v for k, v in resource.items() if k != key}
+            else:
+                resource = {**resource, key: _drop(resource[key], sub)}
+        return resource
@@ -0,0 +1,288 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import helpers
+import patch
+import settings
+from gitea import ConflictError, GiteaOrg, GiteaUser
+
+USER_SCHEMA = 'urn:ietf:params:scim:schemas:core:2.0:User'
+GROUP_SCHEMA = 'urn:ietf:params:scim:schemas:core:2.0:Group'
+
+
+class Change:
+    """One write of a reconcile plan, with the Gitea calls it is expected to cost."""
+
+    __slots__ = ('kind', 'action', 'name', 'fields', 'add', 'remove', 'calls', 'resource', 'status', 'error')
+
+    def __init__(self, kind, action, name, fields=None, add=(), remove=(), calls=1, resource=None) -> None:
+        self.kind = kind  # user | group
+        self.action = action  # create | edit | deactivate | members
+        self.name = name
+        self.fields = fields or {}
+        self.add = list(add)
+        self.remove = list(remove)
+        self.calls = calls
+        self.resource = resource  # Desired SCIM resource, for creates
+        self.status = None  # done | failed, once applied
+        self.error = None
+
+    def describe(self):
+        parts = [f'{self.kind} {self.action} {self.name}']
+        if self.fields:
+            parts.append(json.dumps(self.fields, sort_keys=True))
+        if self.add:
+            parts.append(f'+{len(self.add)} members')
+        if self.remove:
+            parts.append(f'-{len(self.remove)} members')
+        return ' '.join(parts)
+
+    def __repr__(self) -> str:
+        return f'Change({self.describe()})'
+
+
+class Plan:
+    def __init__(self) -> None:
+        self.changes = []
+        self.read_calls = 0  # Gitea calls spent building the plan
+
+    def add(self, change):
+        self.changes.append(change)
+
+    def of(self, *actions):
+        return [c for c in self.changes if c.action in actions]
+
+    @property
+    def write_calls(self):
+        return sum(c.calls for c in self.changes)
+
+    def summary(self):
+        counts = {}
+        for change in self.changes:
+            key = f'{change.kind} {change.action}'
+            counts[key] = counts.get(key, 0) + 1
+        members = self.of('members')
+        return {
+            'changes': counts,
+            'member_adds': sum(len(c.add) for c in members),
+            'member_removes': sum(len(c.remove) for c in members),
+            'read_calls': self.read_calls,
+            'estimated_write_calls': self.write_calls,
+        }
+
+
+def resource_kind(resource):
+    schemas = resource.get('schemas')
+    schemas = schemas if isinstance(schemas, list) else []
+    if USER_SCHEMA in schemas or 'userName' in resource:
+        return 'user'
+    if GROUP_SCHEMA in schemas or 'displayName' in resource:
+        return 'group'
+    return None
+
+
+def _resources(path):
+    with open(path, encoding='utf-8') as f:
+        if path.endswith(('.jsonl', '.ndjson')):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        document = json.load(f)
+    if isinstance(document, list):
+        yield from document
+    elif 'Resources' in document:  # A SCIM ListResponse
+        yield from document['Resources']
+    else:
+        yield from document.get('users') or []
+        yield from document.get('groups') or []
+
+
+def load_snapshot(path):
+    """
+    Read a directory snapshot: a JSON list, a SCIM ListResponse, an object
+    with "users" and "groups" lists, or JSONL with one resource per line.
+    Returns ({username: User}, {name: Group}) keyed by lowercase name.
+    """
+    users, groups = {}, {}
+    for resource in _resources(path):
+        kind = resource_kind(resource)
+        if kind == 'user':
+            users[resource['userName'].lower()] = resource
+        elif kind == 'group':
+            groups[resource['displayName'].lower()] = resource
+        else:
+            raise ValueError(f'Not a SCIM User or Group: {json.dumps(resource)[:200]}')
+    return users, groups
+
+
+def _managed_diff(fields, current, desired):
+    """patch.diff limited to the attributes the snapshot actually carries, absent ones are left alone."""
+    return patch.diff([row for row in fields if row[1](desired) is not None], current, desired)
+
+
+def _member_names(resource):
+    return {str(m['value']).lower(): m['value'] for m in resource.get('members') or [] if isinstance(m, dict) and m.get('value')}
+
+
+def plan(api, users, groups, deactivate_missing=False):
+    """
+    Diff a snapshot against Gitea. `api` is a GiteaSCIMWrapper; users and
+    orgs are streamed page by page so memory stays proportional to the
+    snapshot. Orgs missing from the snapshot are left alone, Gitea has no
+    way to disable one.
+
+    With deactivate_missing, users absent from the snapshot are deactivated;
+    a snapshot without any User raises ValueError rather than disabling
+    everyone.
+    """
+    if deactivate_missing and not users:
+        raise ValueError('The snapshot has no Users, refusing to deactivate every user in Gitea')
+    result = Plan()
+    started = api.transport.stats()['requests']
+    seen, admins = set(), set()
+
+    _, pages = api.iter_users()
+    for page in pages or ():
+        for gitea_user in page:
+            name = gitea_user['username'].lower()
+            if gitea_user.get('is_admin'):
+                admins.add(name)
+            desired = users.get(name)
+            if desired is None:
+                if deactivate_missing and gitea_user.get('active') and name not in admins:
+                    result.add(Change('user', 'deactivate', gitea_user['username'], {'active': False}))
+                continue
+            seen.add(name)
+            delta = _managed_diff(patch.USER_FIELDS, GiteaUser.from_json(gitea_user).serialize(), desired)
+            if delta:
+                result.add(Change('user', 'edit', gitea_user['username'], delta))
+    for name, desired in users.items():
+        if name not in seen:
+            # The create POST only takes the email and full name, anything else costs an edit right after
+            created = GiteaUser.from_json({
+                'username': desired['userName'], 'email': patch.primary_email(desired), 'active': True, 'visibility': 'public',
+                'full_name': (desired.get(patch.USER_EXTENSION) or {}).get('full_name'), 'description': '', 'location': '',
+            }).serialize()
+            calls = 2 if _managed_diff(patch.USER_FIELDS, created, desired) else 1
+            result.add(Change('user', 'create', desired['userName'], calls=calls, resource=desired))
+
+    existing = {}
+    _, pages = api.iter_orgs()
+    for page in pages or ():
+        for gitea_org in page:
+            if gitea_org['username'].lower() in groups:
+                existing[gitea_org['username'].lower()] = gitea_org
+
+    def plan_group(item):
+        name, desired = item
+        gitea_org = existing.get(name)
+        if gitea_org is None:
+            changes = [Change('group', 'create', desired['displayName'], resource=desired)]
+            add = list(_member_names(desired).values())
+            if add:  # List the new org's teams, create its Default team, one PUT per member
+                changes.append(Change('group', 'members', desired['displayName'], add=add, calls=2 + len(add)))
+            return changes
+        org = gitea_org['username']
+        changes = []
+        delta = _managed_diff(patch.GROUP_FIELDS, GiteaOrg.from_json(gitea_org).serialize(), desired)
+        if delta:
+            changes.append(Change('group', 'edit', org, delta))
+        if 'members' in desired:
+            wanted = _member_names(desired)
+            current = _member_names({'members': api.scim_get_org_member_refs(org)})
+            add = [wanted[n] for n in wanted if n not in current]
+            remove = [current[n] for n in current if n not in wanted and n not in admins]  # Never strip an admin out of an org
+            if add or remove:
+                team_ids, default_team_id = api.org_teams(org)
+                calls = len(add) + len(remove) * max(len(team_ids), 1)  # Removes go to every team
+                if add and default_team_id is None:
+                    calls += 1
+                changes.append(Change('group', 'members', org, add=add, remove=remove, calls=calls))
+        return changes
+
+    with ThreadPoolExecutor(max_workers=settings.RECONCILE_WORKERS) as pool:
+        for changes in pool.map(plan_group, groups.items()):
+            for change in changes:
+                result.add(change)
+
+    result.read_calls = api.transport.stats()['requests'] - started
+    return result
+
+
+def create_user(api, desired):
+    """
+    Create a user from a SCIM resource, then edit in what the create POST
+    can't set. Returns the resource; raises ConflictError or RuntimeError.
+    """
+    if not desired.get('userName') or not patch.primary_email(desired):
+        raise RuntimeError('userName and an email are required')  # Gitea answers 422 for these too, which reads as a conflict
+    extension = desired.get(patch.USER_EXTENSION) or {}
+    created = api.scim_create_user(
+        email=patch.primary_email(desired), full_name=extension.get('full_name'), username=desired['userName'],
+        login_name=desired['userName'], source_id=extension.get('source_id'), visibility=extension.get('visibility'),
+        password=helpers.generate_password(),
+    )
+    if not created:
+        raise RuntimeError('Gitea could not create the user')
+    delta = _managed_diff(patch.USER_FIELDS, created, desired)
+    if delta:
+        created = api.scim_edit_user(created['id'], login_name=created['id'], **delta)
+        if not created:
+            raise RuntimeError('created, but Gitea refused the remaining attributes')
+    return created
+
+
+def create_group(api, desired):
+    """Create an org from a SCIM Group resource. Returns the resource; raises ConflictError or RuntimeError."""
+    extension = desired.get(patch.GROUP_EXTENSION) or {}
+    created = api.scim_create_org(
+        username=desired['displayName'], visibility=extension.get('visibility'), full_name=extension.get('full_name'),
+        description=desired.get('description'), location=extension.get('location'),
+    )
+    if not created:
+        raise RuntimeError('Gitea could not create the group')
+    return created
+
+
+def _apply(api, change):
+    try:
+        if change.kind == 'user' and change.action == 'create':
+            create_user(api, change.resource)
+        elif change.kind == 'user':  # edit, deactivate
+            if not api.scim_edit_user(change.name, login_name=change.name, **change.fields):
+                raise RuntimeError('Gitea refused the edit')
+        elif change.action == 'create':
+            create_group(api, change.resource)
+        elif change.action == 'edit':
+            if not api.scim_edit_org(change.name, members=False, **change.fields):
+                raise RuntimeError('Gitea refused the edit')
+        else:
+            failed = [r for r in api.scim_update_org_members(change.name, add=change.add, remove=change.remove) if r['status'] >= 400]
+            if failed:
+                raise RuntimeError(f'{len(failed)} member changes failed, first {failed[0]["op"]} {failed[0]["value"]}: {failed[0]["status"]}')
+        change.status = 'done'
+    except (ConflictError, RuntimeError, requests.RequestException) as e:  # Also Gitea unreachable or refused by the breaker
+        change.status, change.error = 'failed', str(e)
+    return change
+
+
+def apply(api, plan, workers=None, progress=None):
+    """
+    Apply a plan on a bounded pool: creates and edits first, then
+    memberships (which need the users and orgs to exist), then
+    deactivations. Each Change gets status done/failed; returns the failed ones.
+    """
+    phases = [
+        plan.of('create', 'edit'),
+        plan.of('members'),
+        plan.of('deactivate'),
+    ]
+    with ThreadPoolExecutor(max_workers=workers or settings.RECONCILE_WORKERS) as pool:
+        for changes in phases:
+            for change in pool.map(lambda c: _apply(api, c), changes):
+                if progress is not None:
+                    progress(change)
+    return [c for c in plan.changes if c.status == 'failed']
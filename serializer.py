@@ -0,0 +1,36 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # Optional speed-up, the stdlib encoder works the same way only slower
+    orjson = None
+
+LIST_RESPONSE_SCHEMA = 'urn:ietf:params:scim:api:messages:2.0:ListResponse'
+
+# json.dumps() builds a new encoder on every call with non-default options, reuse one instead
+_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+
+
+def dumps(obj) -> bytes:
+    """Compact UTF-8 JSON, through orjson when it's installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return _encoder.encode(obj).encode()
+
+
+def list_response(resources, start_index: int, total_results: int) -> bytes:
+    """
+    Encode a SCIM ListResponse.
+
+    The envelope is written by hand and each resource is encoded once and
+    spliced in, so a large page never goes through Flask's jsonify (which
+    sorts every key of every resource).
+    """
+    body = b','.join(dumps(resource) for resource in resources)
+    return b''.join((
+        b'{"schemas":["', LIST_RESPONSE_SCHEMA.encode(), b'"],',
+        b'"totalResults":', dumps(total_results), b',',
+        b'"startIndex":', dumps(start_index), b',',
+        b'"itemsPerPage":', str(len(resources)).encode(), b',',
+        b'"Resources":[', body, b']}',
+    ))
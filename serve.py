@@ -0,0 +1,179 @@
+"""
+Production entry point: a pre-fork server running app.py (or asgi.py) on every core.
+
+    python serve.py [--host 0.0.0.0] [--port 5000] [--workers 4] [--threads 16] [--asgi]
+
+The parent binds the socket, forks --workers processes that each import
+app.py and serve it from a pool of --threads threads, and replaces any
+worker that dies. With more than one worker the lookup cache moves to a
+SQLite file (SHARED_CACHE_PATH, a temporary file by default) so workers
+share one copy and see each other's invalidations. Worker 0 also runs the
+shadow store sync and applies the write journal. /metrics reports the
+worker that answers the scrape.
+
+--asgi serves asgi.py through Hypercorn's own worker processes instead; see its
+docstring for what it leaves out (cache, shadow store, journal, Bulk).
+"""
+import argparse
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+import settings
+
+RESPAWN_DELAY = 1.0  # Seconds before replacing a worker that died right after starting
+
+
+class RequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = settings.SERVE_KEEPALIVE_TIMEOUT
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """BaseWSGIServer handing each connection to a fixed pool of threads rather than a thread of its own."""
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads, fd=None) -> None:
+        super().__init__(host, port, app, handler=RequestHandler, fd=fd)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='scim-request')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        self.pool.shutdown(wait=True)  # Let requests in progress finish
+        super().server_close()
+
+
+def _run_worker(worker_id, listener, host, port, threads):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent handles Ctrl-C and sends SIGTERM
+    settings.WORKER_ID = worker_id
+    os.environ['WORKER_ID'] = str(worker_id)
+    from app import app  # After fork(), so the Gitea client, pools and threads belong to this process
+
+    server = PooledWSGIServer(host, port, app, threads, fd=listener.fileno())
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown, daemon=True).start())
+    server.serve_forever()  # Closes the server, draining the pool, once shut down
+
+
+def serve(host, port, workers, threads):
+    """Fork `workers` processes serving app.py on one listening socket; returns when stopped by SIGINT/SIGTERM."""
+    if workers > 1 and not settings.SHARED_CACHE_PATH:
+        fd, path = tempfile.mkstemp(prefix='scim-cache-', suffix='.sqlite')
+        os.close(fd)
+        settings.SHARED_CACHE_PATH = os.environ['SHARED_CACHE_PATH'] = path
+        owned_cache = path
+    else:
+        owned_cache = None
+    if settings.SHARED_CACHE_PATH:
+        from cache import SharedCache
+        shared = SharedCache(settings.SHARED_CACHE_PATH)
+        shared.clear()  # Nothing from a previous run, its entries may be stale
+        shared.close()
+
+    listener = socket.create_server((host, port), backlog=1024)
+    listener.setblocking(False)  # Workers race for each connection; the losers go back to select() instead of blocking in accept()
+    children = {}  # pid -> (worker id, started)
+    stopping = False
+
+    def spawn(worker_id):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _run_worker(worker_id, listener, host, port, threads)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = (worker_id, time.monotonic())
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    print(f'Serving on http://{host}:{port}/ with {workers} workers x {threads} threads', file=sys.stderr)
+    for worker_id in range(workers):
+        spawn(worker_id)
+    try:
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            worker_id, started = children.pop(pid, (None, 0))
+            if worker_id is None or stopping:
+                continue
+            print(f'Worker {worker_id} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}, restarting', file=sys.stderr)
+            if time.monotonic() - started < RESPAWN_DELAY:
+                time.sleep(RESPAWN_DELAY)
+            if not stopping:
+                spawn(worker_id)
+    finally:
+        listener.close()
+        if owned_cache is not None:
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.remove(owned_cache + suffix)
+                except FileNotFoundError:
+                    pass
+
+
+def serve_asgi(host, port, workers):
+    from hypercorn.config import Config
+    from hypercorn.run import run
+
+    config = Config()
+    config.application_path = 'asgi:app'
+    config.bind = [f'{host}:{port}']
+    config.workers = workers
+    config.keep_alive_timeout = settings.SERVE_KEEPALIVE_TIMEOUT
+    run(config)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=settings.SERVE_WORKERS, help='processes (default: SERVE_WORKERS, the CPU count)')
+    parser.add_argument('--threads', type=int, default=settings.SERVE_THREADS, help='request threads per process (default: SERVE_THREADS)')
+    parser.add_argument('--asgi', action='store_true', help='serve asgi.py with Hypercorn instead of app.py')
+    args = parser.parse_args()
+
+    if args.workers < 1 or args.threads < 1:
+        parser.error('--workers and --threads must be at least 1')
+    if args.asgi:
+        serve_asgi(args.host, args.port, args.workers)
+    else:
+        serve(args.host, args.port, args.workers, args.threads)
+
+
+if __name__ == '__main__':
+    main()
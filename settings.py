@@ -1,5 +1,78 @@
-import os
-
-TOKEN = os.environ['TOKEN']
-BASE_URL = os.environ['BASE_URL']
-DEFAULT_TEAM_NEW_ORG_PERMISSIONS = ["repo.code", "repo.issues", "repo.ext_issues", "repo.wiki", "repo.pulls", "repo.releases", "repo.projects", "repo.ext_wiki"]
+import os
+
+TOKEN = os.environ['TOKEN']
+BASE_URL = os.environ['BASE_URL']
+DEFAULT_TEAM_NEW_ORG_PERMISSIONS = ["repo.code", "repo.issues", "repo.ext_issues", "repo.wiki", "repo.pulls", "repo.releases", "repo.projects", "repo.ext_wiki"]
+
+# Gitea HTTP transport
+GITEA_POOL_SIZE = int(os.environ.get('GITEA_POOL_SIZE', 20))  # Connections kept alive per host
+GITEA_CONNECT_TIMEOUT = float(os.environ.get('GITEA_CONNECT_TIMEOUT', 3.05))
+GITEA_READ_TIMEOUT = float(os.environ.get('GITEA_READ_TIMEOUT', 30))
+GITEA_RETRIES = int(os.environ.get('GITEA_RETRIES', 3))  # Idempotent verbs only
+GITEA_BACKOFF_FACTOR = float(os.environ.get('GITEA_BACKOFF_FACTOR', 0.3))
+GITEA_MAX_CONCURRENCY = int(os.environ.get('GITEA_MAX_CONCURRENCY', 100))  # In-flight calls per upstream (async client)
+GITEA_COALESCE_READS = os.environ.get('GITEA_COALESCE_READS', 'true').lower() == 'true'  # Share one upstream call between identical concurrent GETs
+
+# Adaptive concurrency limit and circuit breaker in front of Gitea
+GITEA_LIMITER_ENABLED = os.environ.get('GITEA_LIMITER_ENABLED', 'true').lower() == 'true'
+GITEA_LIMIT_MAX = int(os.environ.get('GITEA_LIMIT_MAX', GITEA_POOL_SIZE))  # In-flight calls while Gitea is healthy, also where the limit starts
+GITEA_LIMIT_MIN = int(os.environ.get('GITEA_LIMIT_MIN', 2))
+GITEA_LIMIT_LATENCY_TOLERANCE = float(os.environ.get('GITEA_LIMIT_LATENCY_TOLERANCE', 2))  # Back off once calls run this many times slower than their usual latency
+GITEA_LIMIT_QUEUE_TIMEOUT = float(os.environ.get('GITEA_LIMIT_QUEUE_TIMEOUT', 5))  # Seconds a call waits for a slot before the request gets a 503
+GITEA_BREAKER_WINDOW = int(os.environ.get('GITEA_BREAKER_WINDOW', 20))  # Recent calls the failure ratio is taken over
+GITEA_BREAKER_MIN_CALLS = int(os.environ.get('GITEA_BREAKER_MIN_CALLS', 10))
+GITEA_BREAKER_FAILURE_RATIO = float(os.environ.get('GITEA_BREAKER_FAILURE_RATIO', 0.5))  # Open once this share of the window failed
+GITEA_BREAKER_COOLDOWN = float(os.environ.get('GITEA_BREAKER_COOLDOWN', 10))  # Seconds open before one probe call is let through
+
+# Read-through cache for user/org lookups
+CACHE_TTL = float(os.environ.get('CACHE_TTL', 30))  # Seconds, 0 disables
+CACHE_MAXSIZE = int(os.environ.get('CACHE_MAXSIZE', 10000))  # Entries, 0 disables
+SHARED_CACHE_PATH = os.environ.get('SHARED_CACHE_PATH', '')  # SQLite file shared by every worker process, empty keeps the cache in memory
+
+# SCIM /Bulk
+BULK_MAX_OPERATIONS = int(os.environ.get('BULK_MAX_OPERATIONS', 1000))
+BULK_MAX_PAYLOAD_SIZE = int(os.environ.get('BULK_MAX_PAYLOAD_SIZE', 1048576))  # Bytes
+BULK_MAX_WORKERS = int(os.environ.get('BULK_MAX_WORKERS', 8))
+
+# Group membership changes
+GROUP_MEMBER_MAX_WORKERS = int(os.environ.get('GROUP_MEMBER_MAX_WORKERS', 8))
+
+# manage.py reconcile and import
+RECONCILE_WORKERS = int(os.environ.get('RECONCILE_WORKERS', 8))  # Concurrent group listings while planning, concurrent writes while applying
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', 16))  # Concurrent creates / membership batches
+IMPORT_MEMBER_BATCH = int(os.environ.get('IMPORT_MEMBER_BATCH', 100))  # Members added per org in one scim_update_org_members call
+IMPORT_CHECKPOINT_EVERY = int(os.environ.get('IMPORT_CHECKPOINT_EVERY', 500))  # Input lines between checkpoint writes
+
+# serve.py pre-fork server
+SERVE_WORKERS = int(os.environ.get('SERVE_WORKERS', os.cpu_count() or 1))  # Processes
+SERVE_THREADS = int(os.environ.get('SERVE_THREADS', 16))  # Request threads per process
+SERVE_KEEPALIVE_TIMEOUT = float(os.environ.get('SERVE_KEEPALIVE_TIMEOUT', 5))  # Seconds an idle keep-alive connection may hold a thread
+WORKER_ID = int(os.environ.get('WORKER_ID', 0))  # Set per worker by serve.py; worker 0 also runs the store sync and the journal
+
+# Paging
+SCIM_MAX_PAGE_SIZE = int(os.environ.get('SCIM_MAX_PAGE_SIZE', 100))  # Cap on SCIM count
+GITEA_MAX_PAGE_SIZE = int(os.environ.get('GITEA_MAX_PAGE_SIZE', 50))  # Gitea's [api] MAX_RESPONSE_ITEMS
+SCIM_STREAM_UNPAGINATED = os.environ.get('SCIM_STREAM_UNPAGINATED', 'true').lower() == 'true'  # Stream the full directory when count is omitted
+SCIM_PUBLIC_URL = os.environ.get('SCIM_PUBLIC_URL', '').rstrip('/')  # Prefix for member $ref links, relative when empty
+
+# Optional SQLite shadow directory for read traffic
+SHADOW_STORE_PATH = os.environ.get('SHADOW_STORE_PATH', '')  # Empty disables
+SHADOW_STORE_SYNC_INTERVAL = int(os.environ.get('SHADOW_STORE_SYNC_INTERVAL', 300))  # Seconds
+
+# Optional durable write journal, mutations are queued on disk and applied to Gitea by a worker pool
+JOURNAL_PATH = os.environ.get('JOURNAL_PATH', '')  # Empty disables
+JOURNAL_WORKERS = int(os.environ.get('JOURNAL_WORKERS', 8))
+JOURNAL_ACK_TIMEOUT = float(os.environ.get('JOURNAL_ACK_TIMEOUT', 2))  # Seconds a request waits for its write before answering from the journal
+JOURNAL_MAX_ATTEMPTS = int(os.environ.get('JOURNAL_MAX_ATTEMPTS', 10))
+JOURNAL_BACKOFF_BASE = float(os.environ.get('JOURNAL_BACKOFF_BASE', 0.5))  # Seconds, doubled per attempt with full jitter
+JOURNAL_MAX_BACKOFF = float(os.environ.get('JOURNAL_MAX_BACKOFF', 300))
+JOURNAL_RETENTION = int(os.environ.get('JOURNAL_RETENTION', 86400))  # Seconds finished entries and their idempotency keys are kept
+
+# Prometheus /metrics
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+# Per-request tracing of Gitea calls
+TRACE_ENABLED = os.environ.get('TRACE_ENABLED', 'true').lower() == 'true'
+TRACE_SLOW_REQUEST_MS = float(os.environ.get('TRACE_SLOW_REQUEST_MS', 1000))  # Requests at least this slow are logged with their trace, 0 disables
+TRACE_FANOUT_FACTOR = float(os.environ.get('TRACE_FANOUT_FACTOR', 4))  # Flag requests making more Gitea calls than this per payload item, 0 disables
+TRACE_SERVER_TIMING = os.environ.get('TRACE_SERVER_TIMING', 'false').lower() == 'true'  # Report Gitea calls to the client in a Server-Timing header
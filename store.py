@@ -0,0 +1,296 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import filters
+import settings
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    user_name TEXT NOT NULL COLLATE NOCASE UNIQUE,
+    email TEXT COLLATE NOCASE,
+    display_name TEXT COLLATE NOCASE,
+    active INTEGER,
+    payload TEXT NOT NULL,
+    synced_at REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS users_email ON users (email);
+CREATE INDEX IF NOT EXISTS users_display_name ON users (display_name);
+CREATE TABLE IF NOT EXISTS orgs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL COLLATE NOCASE UNIQUE,
+    display_name TEXT COLLATE NOCASE,
+    payload TEXT NOT NULL,
+    synced_at REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS orgs_display_name ON orgs (display_name);
+CREATE TABLE IF NOT EXISTS memberships (
+    org TEXT NOT NULL COLLATE NOCASE,
+    user_name TEXT NOT NULL COLLATE NOCASE,
+    synced_at REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (org, user_name)
+);
+CREATE INDEX IF NOT EXISTS memberships_user ON memberships (user_name);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# SCIM attribute -> indexed column, used to push filters down into SQL
+USER_COLUMNS = {
+    'id': 'user_name',
+    'username': 'user_name',
+    'emails': 'email',
+    'emails.value': 'email',
+    'urn:ietf:params:scim:schemas:extension:gitea:2.0:user:full_name': 'display_name',
+    'active': 'active',
+}
+ORG_COLUMNS = {
+    'id': 'name',
+    'displayname': 'name',
+    'urn:ietf:params:scim:schemas:extension:gitea:2.0:group:full_name': 'display_name',
+}
+
+
+def _like_escape(value: str):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _to_sql(node, columns):
+    """
+    Translate a filter AST into (where, params), or None when a node has no
+    indexed column. Callers re-check the full filter on the returned rows, so
+    a translation only has to return a superset of the matches.
+    """
+    if isinstance(node, filters.And):
+        left, right = _to_sql(node.left, columns), _to_sql(node.right, columns)
+        if left and right:
+            return f'({left[0]} AND {right[0]})', left[1] + right[1]
+        return left or right
+    if isinstance(node, filters.Or):
+        left, right = _to_sql(node.left, columns), _to_sql(node.right, columns)
+        if left and right:
+            return f'({left[0]} OR {right[0]})', left[1] + right[1]
+        return None
+    if isinstance(node, filters.Present):
+        column = columns.get(node.attr.lower())
+        return (f"({column} IS NOT NULL AND {column} != '')", []) if column else None
+    if isinstance(node, filters.Compare):
+        column = columns.get(node.attr.lower())
+        if column is None:
+            return None
+        value = node.value
+        if isinstance(value, bool):
+            value = int(value)
+        if node.op == 'eq':
+            return f'{column} = ?', [value]
+        if isinstance(value, str) and node.op in ('co', 'sw', 'ew'):
+            pattern = {'co': '%{}%', 'sw': '{}%', 'ew': '%{}'}[node.op].format(_like_escape(value))
+            return f"{column} LIKE ? ESCAPE '\\'", [pattern]
+    return None
+
+
+class ShadowStore:
+    """
+    Local SQLite copy of Gitea users, orgs and memberships for read traffic.
+
+    Filled by an initial bulk load, kept current by write-through from
+    GiteaSCIMWrapper mutations and re-synced against Gitea periodically.
+    """
+
+    def __init__(self, path=None) -> None:
+        self.path = path or settings.SHADOW_STORE_PATH
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        with self._write_lock, self._conn() as conn:
+            conn.executescript(SCHEMA)
+            for table in ('users', 'orgs', 'memberships'):  # Stores created before rows carried synced_at
+                if 'synced_at' not in {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}:
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN synced_at REAL NOT NULL DEFAULT 0')
+        self._sync_thread = None
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @property
+    def loaded(self):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'synced_at'").fetchone()
+        return row is not None
+
+    # Write-through. Every row written is stamped with synced_at, which is what
+    # lets a sync tell rows it didn't see from rows written while it was walking.
+
+    def upsert_users(self, users):
+        now = time.time()
+        rows = [(u['id'], u['username'], u.get('email'), u.get('full_name'), int(bool(u.get('active', True))), json.dumps(u), now) for u in users]
+        with self._write_lock, self._conn() as conn:
+            # REPLACE also clears a stale row holding the same name under an old id
+            conn.executemany('INSERT OR REPLACE INTO users (id, user_name, email, display_name, active, payload, synced_at) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def upsert_user(self, user: dict):
+        self.upsert_users([user])
+
+    def delete_user(self, username: str):
+        with self._write_lock, self._conn() as conn:
+            conn.execute('DELETE FROM users WHERE user_name = ?', (username,))
+            conn.execute('DELETE FROM memberships WHERE user_name = ?', (username,))
+
+    def upsert_orgs(self, orgs):
+        now = time.time()
+        rows = [(o['id'], o['username'], o.get('full_name'), json.dumps(o), now) for o in orgs]
+        with self._write_lock, self._conn() as conn:
+            conn.executemany('INSERT OR REPLACE INTO orgs (id, name, display_name, payload, synced_at) VALUES (?, ?, ?, ?, ?)', rows)
+
+    def upsert_org(self, org: dict):
+        self.upsert_orgs([org])
+
+    def delete_org(self, org: str):
+        with self._write_lock, self._conn() as conn:
+            conn.execute('DELETE FROM orgs WHERE name = ?', (org,))
+            conn.execute('DELETE FROM memberships WHERE org = ?', (org,))
+
+    def add_members(self, org: str, usernames):
+        now = time.time()
+        with self._write_lock, self._conn() as conn:
+            conn.executemany('INSERT OR REPLACE INTO memberships (org, user_name, synced_at) VALUES (?, ?, ?)', [(org, u, now) for u in usernames])
+
+    def remove_members(self, org: str, usernames):
+        with self._write_lock, self._conn() as conn:
+            conn.executemany('DELETE FROM memberships WHERE org = ? AND user_name = ?', [(org, u) for u in usernames])
+
+    def set_members(self, org: str, usernames, since=None):
+        """Make `usernames` the members of `org`, keeping other members written at or after `since` if given."""
+        now = time.time()
+        with self._write_lock, self._conn() as conn:
+            if since is None:
+                conn.execute('DELETE FROM memberships WHERE org = ?', (org,))
+            else:
+                conn.execute('DELETE FROM memberships WHERE org = ? AND synced_at < ?', (org, since))
+            conn.executemany('INSERT OR REPLACE INTO memberships (org, user_name, synced_at) VALUES (?, ?, ?)', [(org, u, now) for u in usernames])
+
+    # Reads, returning raw Gitea payloads like the live API
+
+    def _range(self, table, start_index: int, count: int):
+        conn = self._conn()
+        total = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        rows = conn.execute(f'SELECT payload FROM {table} ORDER BY id LIMIT ? OFFSET ?', (count, start_index - 1)).fetchall()
+        return [json.loads(payload) for payload, in rows], total
+
+    def _iter(self, table, start_index: int, where=None, params=()):
+        conn = self._conn()
+        clause = f' WHERE {where}' if where else ''
+        cursor = conn.execute(f'SELECT payload FROM {table}{clause} ORDER BY id LIMIT -1 OFFSET ?', (*params, start_index - 1))
+        while True:
+            rows = cursor.fetchmany(settings.GITEA_MAX_PAGE_SIZE)
+            if not rows:
+                return
+            yield [json.loads(payload) for payload, in rows]
+
+    def users_range(self, start_index=1, count=None):
+        return self._range('users', start_index, settings.SCIM_MAX_PAGE_SIZE if count is None else count)
+
+    def orgs_range(self, start_index=1, count=None):
+        return self._range('orgs', start_index, settings.SCIM_MAX_PAGE_SIZE if count is None else count)
+
+    def iter_users(self, start_index=1):
+        total = self._conn().execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        return total, self._iter('users', start_index)
+
+    def iter_orgs(self, start_index=1):
+        total = self._conn().execute('SELECT COUNT(*) FROM orgs').fetchone()[0]
+        return total, self._iter('orgs', start_index)
+
+    def filter_users(self, node):
+        """Pages of candidate users for a filter AST, narrowed by indexed columns."""
+        where, params = _to_sql(node, USER_COLUMNS) or (None, [])
+        return self._iter('users', 1, where, params)
+
+    def filter_orgs(self, node):
+        where, params = _to_sql(node, ORG_COLUMNS) or (None, [])
+        return self._iter('orgs', 1, where, params)
+
+    def org_member_users(self, org: str):
+        rows = self._conn().execute(
+            'SELECT u.payload FROM memberships m JOIN users u ON u.user_name = m.user_name WHERE m.org = ? ORDER BY m.user_name',
+            (org,),
+        ).fetchall()
+        return [json.loads(payload) for payload, in rows]
+
+    def org_members(self, org: str):
+        rows = self._conn().execute('SELECT user_name FROM memberships WHERE org = ? ORDER BY user_name', (org,)).fetchall()
+        return [user_name for user_name, in rows]
+
+    # Sync against Gitea
+
+    def sync(self, api):
+        """
+        Bring the store in line with Gitea.
+
+        Walks the paged user/org/member listings, upserts what changed and
+        drops rows Gitea no longer has. The first run is the initial bulk load.
+        Every run is a full walk: Gitea has no change feed or updated-since
+        filter on these listings to make it incremental. A row is only dropped
+        when neither the walk nor a write-through touched it since the walk
+        started, so writes made meanwhile survive.
+        """
+        from gitea import GiteaAPI  # Read live state, never a cached or shadowed view
+
+        started = time.time()
+        seen_users = set()
+        total, pages = GiteaAPI.iter_users(api)
+        for page in pages or ():
+            self.upsert_users(page)
+            seen_users.update(u['id'] for u in page)
+        users_complete = pages is not None and (total is None or len(seen_users) >= total)
+
+        seen_orgs = set()
+        org_names = []
+        total, pages = GiteaAPI.iter_orgs(api)
+        for page in pages or ():
+            self.upsert_orgs(page)
+            seen_orgs.update(o['id'] for o in page)
+            org_names.extend(o['username'] for o in page)
+        orgs_complete = pages is not None and (total is None or len(seen_orgs) >= total)
+
+        for org in org_names:
+            listed_at = time.time()
+            total, pages = api.iter_org_members(org)
+            if pages is not None:
+                members = [u['username'] for page in pages for u in page]
+                if total is None or len(members) >= total:
+                    self.set_members(org, members, since=listed_at)
+
+        # Only drop rows when the listing was walked completely, a failed page must not look like a deletion
+        with self._write_lock, self._conn() as conn:
+            for table, seen, complete in (('users', seen_users, users_complete), ('orgs', seen_orgs, orgs_complete)):
+                if complete:
+                    stale = {row[0] for row in conn.execute(f'SELECT id FROM {table} WHERE synced_at < ?', (started,))} - seen
+                    conn.executemany(f'DELETE FROM {table} WHERE id = ?', [(i,) for i in stale])
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('synced_at', ?)", (str(time.time()),))
+
+    def start_sync(self, api, interval=None):
+        """Run sync in a daemon thread now and then every `interval` seconds."""
+        interval = interval or settings.SHADOW_STORE_SYNC_INTERVAL
+
+        def run():
+            while True:
+                try:
+                    self.sync(api)
+                except Exception:
+                    logger.exception('Shadow store sync failed')
+                time.sleep(interval)
+
+        self._sync_thread = threading.Thread(target=run, name='shadow-store-sync', daemon=True)
+        self._sync_thread.start()
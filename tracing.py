@@ -0,0 +1,139 @@
+import contextvars
+import logging
+import math
+import time
+
+import serializer
+import settings
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('scim_trace', default=None)
+
+
+class Trace:
+    """
+    The Gitea calls made while serving one SCIM request.
+
+    `units` is the size of the request's payload (items it asks to change or
+    pages it asks to read); a request making more than TRACE_FANOUT_FACTOR
+    calls per unit is flagged as fan-out. Continuation pages of a listing
+    scale with the data rather than the payload and aren't counted.
+    """
+
+    __slots__ = ('method', 'route', 'path', 'units', 'started', 'calls', 'token')
+
+    def __init__(self, method: str, route: str, path: str, units: int) -> None:
+        self.method = method
+        self.route = route
+        self.path = path
+        self.units = units
+        self.started = time.perf_counter()
+        self.calls = []  # list.append is atomic, calls from worker threads land here too
+        self.token = None
+
+    def record(self, call: str, method: str, path: str, status, duration: float, page=None):
+        self.calls.append((call, method, path, status, duration, page))
+
+    @property
+    def fanout(self):
+        return sum(1 for c in self.calls if not (c[5] and c[5] > 1))
+
+    def flagged(self):
+        factor = settings.TRACE_FANOUT_FACTOR
+        return factor > 0 and self.fanout > factor * self.units
+
+    def server_timing(self):
+        """Server-Timing header value for the Gitea calls made so far."""
+        return f'gitea;desc="{len(self.calls)} calls";dur={sum(c[4] for c in self.calls) * 1000:.3f}'
+
+    def as_dict(self, status, duration: float):
+        return {
+            'method': self.method,
+            'route': self.route,
+            'path': self.path,
+            'status': status,
+            'duration_ms': round(duration * 1000, 3),
+            'units': self.units,
+            'upstream_calls': len(self.calls),
+            'upstream_ms': round(sum(c[4] for c in self.calls) * 1000, 3),
+            'calls': [
+                {'call': c[0], 'method': c[1], 'path': c[2], 'status': c[3], 'duration_ms': round(c[4] * 1000, 3)}
+                for c in self.calls
+            ],
+        }
+
+
+def payload_units(body, count=None) -> int:
+    """
+    Items a request body asks to change: members of a Group, values of each
+    PATCH operation, operations of a BulkRequest. `count` adds the Gitea
+    pages a list read covers.
+    """
+    units = 0
+    if isinstance(body, dict):
+        members = body.get('members')
+        if isinstance(members, list):
+            units += len(members)
+        for operation in body.get('Operations') or ():
+            if not isinstance(operation, dict):
+                continue
+            if 'data' in operation:  # Bulk operation
+                units += payload_units(operation['data'])
+            elif isinstance(operation.get('value'), list):
+                units += len(operation['value'])
+            else:
+                units += 1
+    if count:
+        units += math.ceil(count / settings.GITEA_MAX_PAGE_SIZE)
+    return max(units, 1)
+
+
+def begin(method: str, route: str, path: str, units: int):
+    """Start tracing the current request; hand the returned Trace to finish()."""
+    trace = Trace(method, route, path, units)
+    trace.token = _current.set(trace)
+    return trace
+
+
+def current():
+    return _current.get()
+
+
+def record(call: str, method: str, path: str, status, duration: float, page=None):
+    trace = _current.get()
+    if trace is not None:
+        trace.record(call, method, path, status, duration, page)
+
+
+def bind(fn):
+    """Carry the current trace into a worker thread, e.g. fn handed to a ThreadPoolExecutor."""
+    trace = _current.get()
+    if trace is None:
+        return fn
+
+    def run(*args, **kwargs):
+        token = _current.set(trace)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+
+    return run
+
+
+def finish(trace, status):
+    """Stop tracing and log the trace if the request was slow or fanned out."""
+    try:
+        _current.reset(trace.token)
+    except ValueError:  # Finished from another context than it began in, e.g. the tail of a streamed response
+        _current.set(None)
+    duration = time.perf_counter() - trace.started
+    slow = settings.TRACE_SLOW_REQUEST_MS > 0 and duration * 1000 >= settings.TRACE_SLOW_REQUEST_MS
+    flagged = trace.flagged()
+    if slow or flagged:
+        entry = trace.as_dict(status, duration)
+        entry['slow'] = slow
+        entry['fanout'] = flagged
+        logger.warning('%s', serializer.dumps(entry).decode())
+    return flagged
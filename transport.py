@@ -0,0 +1,312 @@
+import math
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import settings
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+RETRY_STATUSES = (502, 503, 504)
+FAILURE_STATUSES = frozenset([429, 500, 502, 503, 504])  # Gitea answers that count against its health
+
+
+class JitteredRetry(Retry):
+    """Retry with full jitter so a burst of failed calls doesn't retry in lockstep."""
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        if backoff <= 0:
+            return 0
+        return random.uniform(0, backoff)
+
+
+class HTTPTransport:
+    """
+    Pooled keep-alive transport used by GiteaAPI.
+
+    One requests.Session is shared by every call so TCP/TLS connections are
+    reused. Only idempotent verbs are retried; POST and PATCH go out once.
+    """
+
+    def __init__(self, pool_size=None, connect_timeout=None, read_timeout=None, retries=None, backoff_factor=None) -> None:
+        self.pool_size = pool_size or settings.GITEA_POOL_SIZE
+        self.timeout = (
+            connect_timeout or settings.GITEA_CONNECT_TIMEOUT,
+            read_timeout or settings.GITEA_READ_TIMEOUT,
+        )
+        retry = JitteredRetry(
+            total=settings.GITEA_RETRIES if retries is None else retries,
+            allowed_methods=IDEMPOTENT_METHODS,
+            status_forcelist=RETRY_STATUSES,
+            backoff_factor=settings.GITEA_BACKOFF_FACTOR if backoff_factor is None else backoff_factor,
+            raise_on_status=False,
+        )
+        self._adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry, pool_block=True)
+        self.session = requests.Session()
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._requests = 0
+
+    def request(self, method: str, url: str, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with self._lock:
+            self._in_flight += 1
+            self._requests += 1
+        try:
+            return self.session.request(method, url, **kwargs)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def stats(self):
+        """Pool utilisation per upstream host."""
+        pools = {}
+        manager = self._adapter.poolmanager
+        for key in list(manager.pools.keys()):
+            pool = manager.pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            available = pool.pool.qsize()  # Idle connections plus slots never opened
+            pools[f'{pool.scheme}://{pool.host}:{pool.port}'] = {
+                'maxsize': pool.pool.maxsize,
+                'in_use': pool.pool.maxsize - available,
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+            }
+        return {
+            'in_flight': self._in_flight,
+            'requests': self._requests,
+            'pools': pools,
+        }
+
+    def close(self):
+        self.session.close()
+
+
+class SingleFlight:
+    """
+    Collapse concurrent identical calls into one.
+
+    The first caller for a key runs the call; callers arriving while it is in
+    flight wait for and share its result (or exception). Nothing is kept once
+    the call returns, this is not a cache.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._executed = 0
+        self._coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+                self._executed += 1
+            else:
+                self._coalesced += 1
+        if leader:
+            try:
+                call.set_result(fn())
+            except BaseException as e:
+                call.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._calls[key]
+        return call.result()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'executed': self._executed,
+                'coalesced': self._coalesced,
+                'in_flight': len(self._calls),
+            }
+
+
+class GiteaUnavailable(requests.RequestException):
+    """Raised instead of calling Gitea while it is unhealthy or saturated; maps to SCIM 503 with Retry-After."""
+
+    def __init__(self, detail, retry_after=1) -> None:
+        super().__init__(detail)
+        self.retry_after = max(1, math.ceil(retry_after))  # Whole seconds, as the header wants
+
+
+class AdaptiveLimiter:
+    """
+    AIMD cap on concurrent Gitea calls.
+
+    Each healthy call adds 1/limit, about one more slot per round of calls,
+    up to `maximum`. A failed call halves the limit, and calls running
+    `tolerance` times slower than usual for their kind cut it by a tenth;
+    either cut happens at most once per round trip, only for calls started
+    after the previous one. Callers past the limit wait up to `queue_timeout`
+    seconds for a slot, then get GiteaUnavailable.
+    """
+
+    def __init__(self, maximum=None, minimum=None, tolerance=None, queue_timeout=None) -> None:
+        self.maximum = maximum or settings.GITEA_LIMIT_MAX
+        self.minimum = min(minimum or settings.GITEA_LIMIT_MIN, self.maximum)
+        self.tolerance = tolerance or settings.GITEA_LIMIT_LATENCY_TOLERANCE
+        self.queue_timeout = settings.GITEA_LIMIT_QUEUE_TIMEOUT if queue_timeout is None else queue_timeout
+        self.limit = float(self.maximum)
+        self.in_flight = 0
+        self.rejected = 0
+        self._baselines = {}  # call -> long-run latency average
+        self._slowdown = 1.0  # Recent latency over baseline, averaged across calls
+        self._last_cut = 0.0
+        self._changed = threading.Condition()
+
+    def acquire(self):
+        deadline = time.monotonic() + self.queue_timeout
+        with self._changed:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise GiteaUnavailable(f'Gitea is saturated, {self.in_flight} calls in flight at the limit of {int(self.limit)}')
+                self._changed.wait(remaining)
+            self.in_flight += 1
+
+    def release(self, call: str, started: float, latency: float, failed: bool):
+        with self._changed:
+            self.in_flight -= 1
+            if failed:
+                self._cut(started, 0.5)
+            else:
+                baseline = self._baselines.get(call, latency)
+                self._baselines[call] = baseline + 0.01 * (latency - baseline)
+                if baseline > 0:
+                    self._slowdown += 0.1 * (latency / baseline - self._slowdown)
+                if self._slowdown > self.tolerance:
+                    self._cut(started, 0.9)
+                elif self.limit < self.maximum:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._changed.notify(max(int(self.limit) - self.in_flight, 0))
+
+    def _cut(self, started: float, factor: float):
+        if started < self._last_cut:  # Already answered for, this call went out under the old limit
+            return
+        self._last_cut = time.monotonic()
+        self.limit = max(self.minimum, self.limit * factor)
+
+
+class CircuitBreaker:
+    """
+    Stop calling Gitea while most calls fail.
+
+    Opens once `failure_ratio` of the last `window` calls (and at least
+    `min_calls`) failed; calls then fail fast with GiteaUnavailable. After
+    `cooldown` seconds one probe call goes through: success closes the
+    breaker, failure opens it for another cooldown.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2  # Also the values of its state metric
+
+    def __init__(self, window=None, min_calls=None, failure_ratio=None, cooldown=None) -> None:
+        self.min_calls = min_calls or settings.GITEA_BREAKER_MIN_CALLS
+        self.failure_ratio = failure_ratio or settings.GITEA_BREAKER_FAILURE_RATIO
+        self.cooldown = settings.GITEA_BREAKER_COOLDOWN if cooldown is None else cooldown
+        self.state = self.CLOSED
+        self.opened = 0
+        self.rejected = 0
+        self._outcomes = deque(maxlen=window or settings.GITEA_BREAKER_WINDOW)
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before(self):
+        """Raise GiteaUnavailable unless a call may go out now."""
+        if self.state == self.CLOSED:
+            return
+        with self._lock:
+            remaining = self._opened_at + self.cooldown - time.monotonic()
+            if self.state == self.OPEN and remaining <= 0:
+                self.state = self.HALF_OPEN
+            if self.state == self.CLOSED or (self.state == self.HALF_OPEN and not self._probing):
+                self._probing = self.state == self.HALF_OPEN
+                return
+            self.rejected += 1
+        raise GiteaUnavailable('Gitea is failing, calls to it are suspended', retry_after=remaining)
+
+    def cancel(self):
+        """The call allowed by before() never went out."""
+        with self._lock:
+            self._probing = False
+
+    def record(self, failed: bool):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if failed:
+                    self._open()
+                else:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+            elif self.state == self.CLOSED:
+                self._outcomes.append(failed)
+                if len(self._outcomes) >= self.min_calls and sum(self._outcomes) >= self.failure_ratio * len(self._outcomes):
+                    self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened += 1
+        self._opened_at = time.monotonic()
+
+
+class UpstreamGuard:
+    """
+    Circuit breaker, then adaptive limiter, around each Gitea call:
+    `with guard.slot(name) as slot: slot.response = ...`. Exceptions and
+    FAILURE_STATUSES answers count as failures.
+    """
+
+    def __init__(self, limiter=None, breaker=None) -> None:
+        self.limiter = limiter or AdaptiveLimiter()
+        self.breaker = breaker or CircuitBreaker()
+
+    def slot(self, call: str):
+        return _Slot(self, call)
+
+    def stats(self):
+        return {
+            'limit': int(self.limiter.limit),
+            'in_flight': self.limiter.in_flight,
+            'breaker_state': self.breaker.state,
+            'breaker_opened': self.breaker.opened,
+            'rejected': self.limiter.rejected + self.breaker.rejected,
+        }
+
+
+class _Slot:
+    __slots__ = ('guard', 'call', 'response', '_started')
+
+    def __init__(self, guard, call: str) -> None:
+        self.guard = guard
+        self.call = call
+        self.response = None
+
+    def __enter__(self):
+        self.guard.breaker.before()
+        try:
+            self.guard.limiter.acquire()
+        except GiteaUnavailable:
+            self.guard.breaker.cancel()
+            raise
+        self._started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        failed = exc_type is not None or self.response is None or self.response.status_code in FAILURE_STATUSES
+        self.guard.limiter.release(self.call, self._started, time.monotonic() - self._started, failed)
+        self.guard.breaker.record(failed)